@@ -4,8 +4,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
+from app.database import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 login = LoginManager()
 mail = Mail()
@@ -14,17 +15,33 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
-    db.init_app(app)
+    from app import database
+    database.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
 
+    from app.payments.entitlements import entitlement_cache
+    from app.payments.features import feature_registry
+    from app.payments.inbox import webhook_inbox
+    from app.payments.ledger import event_ledger
+    from app.payments.stripe_client import stripe_client
+    stripe_client.init_app(app)
+    entitlement_cache.init_app(app)
+    feature_registry.init_app(app)
+    webhook_inbox.init_app(app)
+    event_ledger.init_app(app)
+
     from app.auth import bp as auth_bp
     app.register_blueprint(auth_bp ,url_prefix='/auth')
     from app.general import bp as general_bp
     app.register_blueprint(general_bp)
     from app.payments import bp as payments_bp
     app.register_blueprint(payments_bp ,url_prefix='/payments')
+    from app.analytics import bp as analytics_bp
+    app.register_blueprint(analytics_bp, url_prefix='/analytics')
+    from app.cli import bp as cli_bp
+    app.register_blueprint(cli_bp)
 
     return app
 
@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint('analytics', __name__, cli_group='analytics')
+
+from app.analytics import cli, routes
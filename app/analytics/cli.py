@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta, timezone
+
+import click
+from app.analytics import bp
+from app.analytics.cohorts import read_cohorts, retention_matrix, update_cohorts
+from app.analytics.export import FORMATS, export_chunks, parse_cursor
+from app.analytics.revenue import PERIODS, parse_date, revenue_report
+from app.analytics.rollups import rebuild_rollups
+from app.payments.persistence import unit_of_work
+
+
+@bp.cli.command('revenue')
+@click.option('--start', help='First day of the range, YYYY-MM-DD. Defaults to 30 days before --end.')
+@click.option('--end', help='Day after the range, YYYY-MM-DD. Defaults to today.')
+@click.option('--by', type=click.Choice(list(PERIODS)), help='Break the range down by day, week or month.')
+def revenue_command(start, end, by):
+    """Show MRR, ARR, MRR movements and logo churn for a date range."""
+    try:
+        end = parse_date(end) or datetime.now(timezone.utc).date()
+        start = parse_date(start) or end - timedelta(days=30)
+        periods = revenue_report(start, end, by)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+    if not periods:
+        click.echo(f'No recurring revenue between {start} and {end}.')
+        return
+
+    click.echo(
+        f"{'currency':<8} {'start':<10} {'end':<10} {'mrr':>12} {'arr':>14} {'new':>10} {'expansion':>10} "
+        f"{'contraction':>11} {'churned':>10} {'customers':>9} {'logo churn':>10}"
+    )
+    for period in periods:
+        logo_churn = f"{period['logo_churn']:.1%}" if period['logo_churn'] is not None else '-'
+        click.echo(
+            f"{period['currency']:<8} {period['start']:<10} {period['end']:<10} {period['mrr_end']:>12.2f} "
+            f"{period['arr']:>14.2f} {period['new_mrr']:>10.2f} {period['expansion_mrr']:>10.2f} "
+            f"{period['contraction_mrr']:>11.2f} {period['churned_mrr']:>10.2f} {period['customers_end']:>9} "
+            f"{logo_churn:>10}"
+        )
+
+
+@bp.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the daily revenue rollups from every subscription."""
+    with unit_of_work():
+        rows = rebuild_rollups()
+    click.echo(f'Rebuilt the daily revenue rollups: {rows} rows.')
+
+
+@bp.cli.command('cohorts')
+@click.option('--path', help='Snapshot directory. Defaults to COHORTS_PATH or instance/cohorts.')
+@click.option('--rebuild', is_flag=True, help='Delete the snapshots and write every month again.')
+def cohorts_command(path, rebuild):
+    """Snapshot cohort retention for the closed months since the last run, then show the matrix."""
+    months = update_cohorts(path, rebuild=rebuild)
+    click.echo(f"Wrote snapshots for {', '.join(months)}." if months else 'The snapshots are up to date.')
+    matrix = retention_matrix(read_cohorts(path))
+    if matrix.is_empty():
+        click.echo('No customers yet.')
+        return
+
+    offsets = matrix.columns[2:]
+    click.echo(f"{'cohort':<7} {'customers':>10} " + ' '.join(f'{offset:>5}' for offset in offsets))
+    for row in matrix.iter_rows():
+        cohort, customers, *retention = row
+        cells = ' '.join(f'{value:>5.0%}' if value is not None else f"{'':>5}" for value in retention)
+        click.echo(f"{cohort:%Y-%m} {customers:>10} {cells}")
+
+
+@bp.cli.command('export')
+@click.option('--format', 'output_format', type=click.Choice(list(FORMATS)), default='csv', show_default=True)
+@click.option('--after', help='Resume after the row with this cursor, the first column of every row. '
+                               'The CSV header is left out.')
+@click.option('--output', type=click.File('a', lazy=True), default='-',
+              help='File to append the rows to. Defaults to standard output.')
+def export_command(output_format, after, output):
+    """Stream every customer joined to their subscriptions as CSV or NDJSON."""
+    try:
+        after = parse_cursor(after) if after else None
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='--after')
+    for chunk in export_chunks(output_format, after, header=after is None):
+        output.write(chunk)
@@ -0,0 +1,226 @@
+"""
+Cohort retention, kept as Parquet snapshots partitioned by month.
+
+Customers are grouped into cohorts by the month of Customer.created_at. A
+customer is retained in a month if any of their subscriptions was billed
+during it, over the spans billing_spans works out. For every closed month and
+every cohort up to it, the snapshots hold the cohort's size and how many of its
+customers were retained that month. Each customer's overlapping spans are
+merged, and the counts are running sums of the customers joining and leaving
+each cohort, computed with vectorized group-bys rather than per customer and month.
+
+Snapshots are written with pyarrow under COHORTS_PATH, instance/cohorts by
+default, in one hive partition per month: month=2026-01/cohorts-0.parquet.
+A closed month's counts do not change, so each run only computes the months
+after the latest partition, from the subscriptions that may have been billed
+in them, and leaves the earlier partitions as they are. A cohort's size is
+counted once, when its first partition is written, and read back from the
+snapshots for later months, so every partition agrees on it even if customers
+are added or removed afterwards. Analysts read the
+directory with read_cohorts, which memory-maps the files, or with any Parquet
+reader, rather than querying the production database.
+"""
+import os
+import shutil
+from datetime import date, datetime, timezone
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from flask import current_app
+from app.analytics.revenue import billing_spans, load_customers, load_subscriptions
+
+SNAPSHOT_SCHEMA = pa.schema([
+    ('cohort', pa.date32()),
+    ('month', pa.string()),
+    ('months_since', pa.int64()),
+    ('customers', pa.int64()),
+    ('retained', pa.int64()),
+])
+
+PARTITIONING = ds.partitioning(pa.schema([('month', pa.string())]), flavor='hive')
+
+
+def cohorts_path():
+    """The snapshot directory, COHORTS_PATH or instance/cohorts."""
+    return current_app.config.get('COHORTS_PATH') or os.path.join(current_app.instance_path, 'cohorts')
+
+
+def month_index(day):
+    """Months since year 0 of a date, so consecutive months are consecutive integers."""
+    return day.year * 12 + day.month - 1
+
+
+def _month_of(seconds):
+    moment = pl.from_epoch(seconds, time_unit='s')
+    return moment.dt.year().cast(pl.Int64) * 12 + moment.dt.month().cast(pl.Int64) - 1
+
+
+def _month_start(index):
+    return pl.date(index // 12, index % 12 + 1, 1)
+
+
+def retention_counts(customers, subscriptions, first, last, sizes=None):
+    """
+    Each cohort's size and retained customers in each month of a range.
+
+    Args:
+        customers (polars.DataFrame): As returned by load_customers
+        subscriptions (polars.DataFrame): As returned by load_subscriptions, with
+            at least every subscription billed in the range
+        first (int): month_index of the first month
+        last (int): month_index of the last month
+        sizes (polars.DataFrame): Cohorts whose size is already known, as returned
+            by snapshot_sizes. The other cohorts are counted from customers.
+
+    Returns:
+        polars.DataFrame: A row per month and every cohort up to it, in SNAPSHOT_SCHEMA's columns
+    """
+    spans = billing_spans(subscriptions).select(
+        'customer',
+        start=pl.max_horizontal(_month_of(pl.col('start')), pl.lit(first)),
+        # Spans end before their end second, which may be the first of a month
+        stop=pl.min_horizontal(_month_of(pl.col('end') - 1).fill_null(last), pl.lit(last)),
+    ).filter(pl.col('start') <= pl.col('stop')).sort('customer', 'start')
+    # Merge each customer's overlapping and adjacent spans, so every month they were billed in is counted once
+    reach = pl.col('stop').cum_max().shift(1).over('customer')
+    billed = (
+        spans.with_columns(island=(reach.is_null() | (pl.col('start') > reach + 1)).cum_sum())
+        .group_by('island').agg(pl.col('customer').first(), pl.col('start').min(), pl.col('stop').max())
+    )
+    cohorts = customers.select('customer', cohort=_month_of(pl.col('customer_created')))
+    counted = cohorts.group_by('cohort').agg(customers=pl.len().cast(pl.Int64))
+    if sizes is None:
+        sizes = counted
+    else:
+        sizes = pl.concat([sizes, counted.join(sizes, on='cohort', how='anti')])
+    # Each customer joins the retained count in the month their billing starts and leaves it the month after it stops
+    changes = (
+        pl.concat([
+            billed.select('customer', month='start', change=pl.lit(1)),
+            billed.filter(pl.col('stop') < last).select('customer', month=pl.col('stop') + 1, change=pl.lit(-1)),
+        ])
+        .join(cohorts, on='customer')
+        .group_by('cohort', 'month').agg(pl.col('change').sum())
+    )
+    months = pl.DataFrame({'month': range(first, last + 1)}, schema={'month': pl.Int64})
+
+    return (
+        sizes.join(months, how='cross')
+        .join(changes, on=['cohort', 'month'], how='left')
+        .sort('cohort', 'month')
+        .with_columns(retained=pl.col('change').fill_null(0).cum_sum().over('cohort'))
+        .filter(pl.col('cohort') <= pl.col('month'))
+        .sort('month', 'cohort')
+        .select(
+            cohort=_month_start(pl.col('cohort')),
+            month=_month_start(pl.col('month')).dt.strftime('%Y-%m'),
+            months_since=pl.col('month') - pl.col('cohort'),
+            customers='customers',
+            retained=pl.col('retained').cast(pl.Int64)
+        )
+    )
+
+
+def snapshot_months(path):
+    """The months with a snapshot under path, as sorted YYYY-MM strings."""
+    if not os.path.isdir(path):
+        return []
+    return sorted(
+        entry.name.split('=', 1)[1]
+        for entry in os.scandir(path)
+        if entry.is_dir() and entry.name.startswith('month=')
+    )
+
+
+def snapshot_sizes(path):
+    """
+    The size of every cohort with a snapshot under path, as written with its first partition.
+
+    Returns:
+        polars.DataFrame: cohort as a month_index and customers
+    """
+    table = pq.read_table(path, columns=['cohort', 'months_since', 'customers'], partitioning=PARTITIONING)
+    return (
+        pl.from_arrow(table)
+        .sort('months_since')
+        .group_by('cohort').agg(pl.col('customers').first())
+        .select(
+            cohort=pl.col('cohort').dt.year().cast(pl.Int64) * 12 + pl.col('cohort').dt.month().cast(pl.Int64) - 1,
+            customers='customers'
+        )
+    )
+
+
+def update_cohorts(path=None, as_of=None, rebuild=False):
+    """
+    Write the snapshots of the closed months after the latest one.
+
+    Args:
+        path (str): The snapshot directory. Defaults to cohorts_path().
+        as_of (datetime.date): Months before this date's month are closed. Defaults to today in UTC.
+        rebuild (bool): Delete the snapshots and write every month again
+
+    Returns:
+        list: The months written, as YYYY-MM strings
+    """
+    path = path or cohorts_path()
+    as_of = as_of or datetime.now(timezone.utc).date()
+    last = month_index(as_of) - 1
+
+    customers = load_customers()
+    if customers.is_empty():
+        return []
+    first = month_index(datetime.fromtimestamp(customers['customer_created'].min(), timezone.utc))
+    done = [] if rebuild else snapshot_months(path)
+    if done:
+        year, month = map(int, done[-1].split('-'))
+        first = max(first, month_index(date(year, month, 1)) + 1)
+    if first > last:
+        return []
+
+    billed_since = datetime(first // 12, first % 12 + 1, 1)
+    sizes = snapshot_sizes(path) if done else None
+    counts = retention_counts(customers, load_subscriptions(customers, billed_since), first, last, sizes)
+    if rebuild:
+        shutil.rmtree(path, ignore_errors=True)
+    ds.write_dataset(
+        counts.to_arrow().cast(SNAPSHOT_SCHEMA),
+        path,
+        format='parquet',
+        partitioning=PARTITIONING,
+        basename_template='cohorts-{i}.parquet',
+        existing_data_behavior='delete_matching'
+    )
+    return counts['month'].unique(maintain_order=True).to_list()
+
+
+def read_cohorts(path=None):
+    """
+    Every snapshot under a directory, memory-mapped, with each cohort's retention as a fraction of its size.
+
+    Returns:
+        polars.DataFrame: SNAPSHOT_SCHEMA's columns and retention, sorted by cohort and month
+    """
+    path = path or cohorts_path()
+    if not snapshot_months(path):
+        return pl.from_arrow(SNAPSHOT_SCHEMA.empty_table()).with_columns(retention=pl.lit(None, pl.Float64))
+    table = pq.read_table(path, memory_map=True, partitioning=PARTITIONING)
+    return (
+        pl.from_arrow(table)
+        .with_columns(retention=pl.col('retained') / pl.col('customers'))
+        .sort('cohort', 'months_since')
+    )
+
+
+def retention_matrix(cohorts):
+    """
+    Cohorts as rows and months since each started as columns, from read_cohorts.
+
+    Returns:
+        polars.DataFrame: cohort, customers, then the retention in month 0, 1 and so on
+    """
+    return cohorts.sort('months_since', 'cohort').pivot(
+        on='months_since', index=['cohort', 'customers'], values='retention'
+    ).sort('cohort')
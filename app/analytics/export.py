@@ -0,0 +1,128 @@
+"""
+Streaming export of every customer joined to their subscriptions, as CSV or NDJSON.
+
+Rows are read through a server-side cursor on databases that have one, in
+batches of BATCH_SIZE with yield_per, and each batch is formatted and yielded
+as one chunk before the next is fetched. No ORM object is made and at most one
+batch is held in memory, however many rows there are.
+
+Rows are ordered by the customer's row ID, then the subscription's, and each
+carries that pair as its cursor, "customer_id:subscription_id" with 0 for a
+customer without subscriptions. An export that stopped part way resumes from
+the cursor of the last row received, which is matched with a keyset condition
+rather than an OFFSET, so the rows before it are not read again. The order is
+the one the customers' primary key and the subscriptions' (customer, ID) index
+already give, so the database neither sorts nor reads ahead to find the cursor.
+"""
+import csv
+import io
+import json
+
+from app import db
+from app.models import Customer, Subscription
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+BATCH_SIZE = 1000
+
+COLUMNS = {
+    'customer_id': Customer.id,
+    'stripe_customer_id': Customer.stripe_customer_id,
+    'customer_name': Customer.customer_name,
+    'customer_created_at': Customer.created_at,
+    'stripe_subscription_id': Subscription.stripe_subscription_id,
+    'status': Subscription.status,
+    'product_id': Subscription.product_id,
+    'price_id': Subscription.price_id,
+    'amount': Subscription.amount,
+    'currency': Subscription.currency,
+    'billing_interval': Subscription.billing_interval,
+    'billing_interval_count': Subscription.billing_interval_count,
+    'created_at': Subscription.created_at,
+    'current_period_start': Subscription.current_period_start,
+    'current_period_end': Subscription.current_period_end,
+    'cancel_at_period_end': Subscription.cancel_at_period_end,
+    'trial_end': Subscription.trial_end,
+    'ended_at': Subscription.ended_at,
+}
+
+HEADER = ['cursor', *COLUMNS]
+
+
+def parse_cursor(value):
+    """
+    The (customer_id, subscription_id) keyset of a cursor string.
+
+    Raises:
+        ValueError: If value is not a cursor
+    """
+    try:
+        customer_id, subscription_id = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise ValueError(f"Invalid cursor {value!r}, expected customer_id:subscription_id") from None
+    return customer_id, subscription_id
+
+
+def export_statement(after=None, limit=None):
+    """The select for the export, starting after a (customer_id, subscription_id) keyset."""
+    statement = (
+        db.select(Subscription.id, *COLUMNS.values())
+        .select_from(Customer)
+        .outerjoin(Subscription, Subscription.stripe_customer_id == Customer.stripe_customer_id)
+        # Walks the customers' primary key and ix_subscriptions_customer_id, with no sort
+        .order_by(Customer.id, Subscription.id.asc().nulls_first())
+    )
+    if after is not None:
+        customer_id, subscription_id = after
+        # The first bound lets the database seek to the cursor's customer. A customer without
+        # subscriptions has one row, whose NULL subscription ID is never greater
+        statement = statement.where(
+            Customer.id >= customer_id,
+            db.or_(Customer.id > customer_id, Subscription.id > subscription_id)
+        )
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def _value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def export_chunks(output_format='csv', after=None, limit=None, header=True):
+    """
+    Generate the export as text chunks, one per batch of rows.
+
+    Args:
+        output_format (str): 'csv' or 'ndjson'
+        after (tuple): Resume after this (customer_id, subscription_id) keyset, from parse_cursor
+        limit (int): Stop after this many rows
+        header (bool): Start a CSV export with its header row
+
+    Yields:
+        str: Lines of CSV or NDJSON, each row starting with its cursor
+    """
+    result = db.session.execute(
+        export_statement(after, limit),
+        execution_options={'stream_results': True, 'yield_per': BATCH_SIZE}
+    )
+    try:
+        if output_format == 'csv' and header:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(HEADER)
+            yield buffer.getvalue()
+        for rows in result.partitions():
+            buffer = io.StringIO()
+            lines = [
+                [f'{customer_id}:{subscription_id or 0}', customer_id, *(_value(value) for value in values)]
+                for subscription_id, customer_id, *values in rows
+            ]
+            if output_format == 'csv':
+                csv.writer(buffer).writerows(lines)
+            else:
+                for line in lines:
+                    buffer.write(json.dumps(dict(zip(HEADER, line))))
+                    buffer.write('\n')
+            yield buffer.getvalue()
+    finally:
+        result.close()
@@ -0,0 +1,425 @@
+"""
+Recurring revenue metrics over the subscriptions table, computed with Polars.
+
+Subscriptions and customers are read in batches of plain DBAPI rows, with
+timestamps as Unix seconds, into columnar frames joined by Polars. No ORM
+object, SQLAlchemy row or Python datetime is made per row. Every metric is then
+a vectorized expression over the joined frame:
+
+- Each subscription is billed from its creation, or the end of its trial, until it ended.
+- A subscription whose plan changed bills each plan in its price history from
+  when it took effect until the next one did.
+- Its monthly recurring revenue (MRR) is its amount spread over its billing interval.
+- A customer's MRR at an instant is the sum over the subscriptions billed at that instant.
+- Movements between two instants are classified per customer:
+  - new: MRR from customers with none at the start, including returning ones
+  - expansion and contraction: a change for customers with MRR at both instants
+  - churned: MRR lost from customers with none at the end
+
+Amounts are in the smallest unit of each currency and are never summed across
+currencies. A plan changed in place on a subscription moves its customer's MRR
+when the change took effect, so it shows up as expansion or contraction.
+"""
+import calendar
+import math
+from datetime import datetime, time
+
+import polars as pl
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import GenericFunction
+from app import db
+from app.models import Customer, Subscription, SubscriptionPrice
+
+# Months in one billing interval, to spread an amount billed every interval over months
+MONTHS_PER_INTERVAL = {'day': 12 / 365, 'week': 12 / 52, 'month': 1.0, 'year': 12.0}
+
+# Subscriptions in these statuses were never billed
+NEVER_BILLED = ('incomplete', 'incomplete_expired')
+
+# Period lengths for breaking a date range down, as Polars durations
+PERIODS = {'day': '1d', 'week': '1w', 'month': '1mo'}
+
+# MRR is summed as integer hundredths of the smallest currency unit, so customers who churn come back to exactly 0
+MRR_SCALE = 100
+
+BATCH_SIZE = 50_000
+
+CUSTOMERS_SCHEMA = {
+    'customer': pl.Int64,
+    'stripe_customer_id': pl.String,
+    'customer_created': pl.Int64,
+}
+
+# What a subscription bills, as recorded on it and in its price history
+PLAN_SCHEMA = {
+    'product_id': pl.String,
+    'price_id': pl.String,
+    'amount': pl.Int64,
+    'currency': pl.String,
+    'billing_interval': pl.String,
+    'billing_interval_count': pl.Int64,
+}
+
+# Subscriptions as read, before their customer is joined
+_SUBSCRIPTION_ROWS_SCHEMA = {
+    'stripe_customer_id': pl.String,
+    'subscription': pl.String,
+    'status': pl.String,
+    **PLAN_SCHEMA,
+    'created': pl.Int64,
+    'trial_end': pl.Int64,
+    'ended': pl.Int64,
+    'period_end': pl.Int64,
+}
+
+# Subscriptions as load_subscriptions returns them, keyed by the customer's row ID. A subscription
+# bills its plan from plan_from until plan_until, or throughout where they are null.
+SUBSCRIPTIONS_SCHEMA = {
+    'customer': pl.Int64,
+    'customer_created': pl.Int64,
+    **{name: dtype for name, dtype in _SUBSCRIPTION_ROWS_SCHEMA.items() if name != 'stripe_customer_id'},
+    'plan_from': pl.Int64,
+    'plan_until': pl.Int64,
+}
+
+# Rows of the subscription_prices table
+PLAN_CHANGES_SCHEMA = {
+    'subscription': pl.String,
+    'effective': pl.Int64,
+    **PLAN_SCHEMA,
+}
+
+METRIC_COLUMNS = [
+    'mrr_start', 'mrr_end', 'arr', 'new_mrr', 'expansion_mrr', 'contraction_mrr', 'churned_mrr',
+    'customers_start', 'customers_end', 'new_customers', 'churned_customers', 'logo_churn'
+]
+
+
+class epoch(GenericFunction):
+    """Unix seconds of a naive UTC DateTime column, computed by the database."""
+    type = sa.BigInteger()
+    inherit_cache = True
+
+
+@compiles(epoch)
+def _epoch_sqlite(element, compiler, **kw):
+    return f"CAST(strftime('%s', {compiler.process(element.clauses, **kw)}) AS INTEGER)"
+
+
+@compiles(epoch, 'postgresql')
+def _epoch_postgresql(element, compiler, **kw):
+    return f"CAST(EXTRACT(EPOCH FROM {compiler.process(element.clauses, **kw)}) AS BIGINT)"
+
+
+def read_frame(statement, schema):
+    """
+    Run a select and collect its rows into a frame, BATCH_SIZE rows at a time.
+
+    SQLAlchemy runs the statement, so its parameters go through the column
+    types' bind processors. The rows are then fetched from the result's DBAPI
+    cursor as plain tuples, without the Row object SQLAlchemy makes for each
+    one, which takes longer than the fetch. The connection comes from
+    db.session, so the read goes to a replica when one would serve the
+    current request.
+    """
+    if db.session.autoflush:
+        # As an ORM query would, since the connection bypasses the session
+        db.session.flush()
+    connection = db.session.connection(bind_arguments={'clause': statement})
+    result = connection.execute(statement)
+    try:
+        frames = []
+        while rows := result.cursor.fetchmany(BATCH_SIZE):
+            frames.append(pl.DataFrame(rows, schema=schema, orient='row'))
+    finally:
+        result.close()
+    return pl.concat(frames) if frames else pl.DataFrame(schema=schema)
+
+
+def load_customers():
+    """Every customer's row ID, Stripe ID and creation time, in CUSTOMERS_SCHEMA."""
+    return read_frame(
+        sa.select(Customer.id, Customer.stripe_customer_id, epoch(Customer.created_at)),
+        CUSTOMERS_SCHEMA
+    )
+
+
+def load_subscriptions(customers=None, billed_since=None):
+    """
+    Every subscription with its customer, as one frame.
+
+    Args:
+        customers (polars.DataFrame): As returned by load_customers, which is called if not given
+        billed_since (datetime.datetime): Leave out subscriptions that ended before this naive UTC time.
+            Rows that may still have been billed after it are kept, so billing_spans must be filtered too.
+
+    Returns:
+        polars.DataFrame: One row per subscription, in SUBSCRIPTIONS_SCHEMA, billing its current plan throughout
+    """
+    statement = sa.select(
+        Subscription.stripe_customer_id, Subscription.stripe_subscription_id, Subscription.status,
+        Subscription.product_id, Subscription.price_id,
+        Subscription.amount, Subscription.currency,
+        Subscription.billing_interval, Subscription.billing_interval_count, epoch(Subscription.created_at),
+        epoch(Subscription.trial_end), epoch(Subscription.ended_at), epoch(Subscription.current_period_end)
+    )
+    if billed_since is not None:
+        statement = statement.where(_billed_since(billed_since))
+    subscriptions = read_frame(statement, _SUBSCRIPTION_ROWS_SCHEMA)
+    customers = load_customers() if customers is None else customers
+    return (
+        subscriptions.join(customers, on='stripe_customer_id')
+        .with_columns(plan_from=pl.lit(None, pl.Int64), plan_until=pl.lit(None, pl.Int64))
+        .select(list(SUBSCRIPTIONS_SCHEMA))
+    )
+
+
+def _billed_since(billed_since):
+    return sa.or_(Subscription.ended_at.is_(None), Subscription.ended_at >= billed_since)
+
+
+def load_plan_changes(billed_since=None):
+    """
+    Every subscription's price history, in PLAN_CHANGES_SCHEMA.
+
+    Args:
+        billed_since (datetime.datetime): Leave out the history of subscriptions
+            load_subscriptions leaves out for the same time
+    """
+    statement = sa.select(
+        SubscriptionPrice.stripe_subscription_id, epoch(SubscriptionPrice.effective_at),
+        *[getattr(SubscriptionPrice, name) for name in PLAN_SCHEMA]
+    )
+    if billed_since is not None:
+        statement = statement.join(
+            Subscription, Subscription.stripe_subscription_id == SubscriptionPrice.stripe_subscription_id
+        ).where(_billed_since(billed_since))
+    return read_frame(statement, PLAN_CHANGES_SCHEMA)
+
+
+def split_at_plan_changes(subscriptions, changes):
+    """
+    The subscriptions with one row for each plan in their price history.
+
+    Each plan is billed from when it took effect until the next one did.
+    Subscriptions with no history keep their one row.
+
+    Args:
+        subscriptions (polars.DataFrame): As returned by load_subscriptions
+        changes (polars.DataFrame): As returned by load_plan_changes
+
+    Returns:
+        polars.DataFrame: In SUBSCRIPTIONS_SCHEMA
+    """
+    plans = changes.sort('subscription', 'effective').select(
+        'subscription', *PLAN_SCHEMA,
+        plan_from='effective',
+        plan_until=pl.col('effective').shift(-1).over('subscription')
+    )
+    changed = subscriptions.drop(*PLAN_SCHEMA, 'plan_from', 'plan_until').join(plans, on='subscription')
+    return pl.concat([
+        subscriptions.join(plans, on='subscription', how='anti'),
+        changed.select(list(SUBSCRIPTIONS_SCHEMA)),
+    ])
+
+
+def unix_seconds(day):
+    """Unix seconds of midnight UTC at the start of a date."""
+    return calendar.timegm(day.timetuple())
+
+
+def billing_spans(subscriptions):
+    """
+    The MRR of each subscription that was billed and the span it was billed for.
+
+    billing_span works out the same for one subscription.
+
+    Returns:
+        polars.DataFrame: currency, customer, product_id, price_id, mrr in
+        hundredths of the smallest currency unit, and start and end in Unix
+        seconds, end null while it lasts
+    """
+    billed = pl.coalesce('trial_end', 'created')
+    # Cancelled rows stored before end times were recorded ended when their last period did, if that is known
+    ended = pl.when(pl.col('status') == 'cancelled').then(pl.coalesce('ended', 'period_end', billed)).otherwise('ended')
+    # Only the part billed on the row's plan
+    start = pl.max_horizontal(billed, 'plan_from')
+    end = pl.min_horizontal(ended, 'plan_until')
+    months = pl.col('billing_interval_count') * pl.col('billing_interval').replace_strict(
+        MONTHS_PER_INTERVAL, default=None, return_dtype=pl.Float64
+    )
+    return (
+        subscriptions
+        .filter(~pl.col('status').is_in(NEVER_BILLED), pl.col('currency').is_not_null())
+        .select(
+            'currency', 'customer', 'product_id', 'price_id',
+            # Rounded half up, as billing_span rounds
+            mrr=(pl.col('amount') * MRR_SCALE / months + 0.5).floor().cast(pl.Int64),
+            start=start,
+            end=end
+        )
+        .filter(pl.col('mrr') > 0, pl.col('end').is_null() | (pl.col('end') > pl.col('start')))
+    )
+
+
+def billing_span(subscription):
+    """
+    The MRR of one subscription and the span it was billed for, as billing_spans works them out.
+
+    Args:
+        subscription: A Subscription, or a row with its status, amount, currency,
+            billing_interval, billing_interval_count, created_at, trial_end,
+            ended_at and current_period_end. For one plan of a subscription split
+            at its plan changes, the row also has the naive UTC plan_from and
+            plan_until the plan was billed between, either of which may be None.
+
+    Returns:
+        tuple: (mrr, start, end), with the start and end as naive UTC datetimes
+        and end None while it lasts, or None if the subscription was never billed
+    """
+    months = MONTHS_PER_INTERVAL.get(subscription.billing_interval)
+    if (subscription.status in NEVER_BILLED or subscription.currency is None or subscription.amount is None
+            or months is None or subscription.billing_interval_count is None):
+        return None
+    mrr = math.floor(subscription.amount * MRR_SCALE / (subscription.billing_interval_count * months) + 0.5)
+    start = subscription.trial_end or subscription.created_at
+    end = subscription.ended_at
+    if subscription.status == 'cancelled':
+        end = subscription.ended_at or subscription.current_period_end or start
+    plan_from, plan_until = getattr(subscription, 'plan_from', None), getattr(subscription, 'plan_until', None)
+    if plan_from is not None:
+        start = max(start, plan_from)
+    if plan_until is not None:
+        end = plan_until if end is None else min(end, plan_until)
+    if mrr <= 0 or (end is not None and end <= start):
+        return None
+    return mrr, start, end
+
+
+def boundaries(start, end, by=None):
+    """The instants the date range is broken down at: start, the start of each later period, then end."""
+    if start >= end:
+        raise ValueError('The start date must be before the end date.')
+    if by is None:
+        return [start, end]
+    if by not in PERIODS:
+        raise ValueError(f"Unknown period {by!r}, expected one of {', '.join(PERIODS)}")
+    days = pl.date_range(start, end, PERIODS[by], eager=True).to_list()
+    return days if days[-1] == end else days + [end]
+
+
+def revenue_movements(subscriptions, start, end, by=None):
+    """
+    MRR, ARR, MRR movements and logo churn for each period of a date range, per currency.
+
+    Only changes are materialized. Each subscription adds its MRR to its
+    customer at the first boundary it is billed at, and takes it away at the
+    first boundary after it ended. A running sum of those changes per customer
+    gives their MRR before and after each change, which classifies it.
+
+    Args:
+        subscriptions (polars.DataFrame): As returned by load_subscriptions
+        start (datetime.date): First day of the range
+        end (datetime.date): Day after the range
+        by (str): Break the range down by 'day', 'week' or 'month'. The whole range is one period by default.
+
+    Returns:
+        polars.DataFrame: One row per currency and period, with the period's
+        start and end dates and METRIC_COLUMNS. Amounts are in the smallest
+        currency unit, MRR at the start and end instants and movements in between.
+
+    Raises:
+        ValueError: If the range is empty or the period is unknown
+    """
+    days = boundaries(start, end, by)
+    points = pl.Series([unix_seconds(day) for day in days], dtype=pl.Int64)
+    last = len(points) - 1
+
+    spans = billing_spans(subscriptions)
+    # A span is billed at boundaries first <= i < stop: the boundaries at or after its start and before its end
+    spans = spans.with_columns(
+        first=points.search_sorted(spans['start'], 'left').cast(pl.Int64),
+        stop=points.search_sorted(spans['end'].fill_null(points[last] + 1), 'left').cast(pl.Int64)
+    ).filter(pl.col('first') < pl.col('stop'))
+
+    keys = ['currency', 'customer']
+    changes = (
+        pl.concat([
+            spans.select(*keys, point='first', delta='mrr'),
+            spans.filter(pl.col('stop') <= last).select(*keys, point='stop', delta=-pl.col('mrr')),
+        ])
+        .group_by(*keys, 'point').agg(pl.col('delta').sum())
+        .sort(*keys, 'point')
+        .with_columns(after=pl.col('delta').cum_sum().over(keys))
+        .with_columns(before=pl.col('after') - pl.col('delta'))
+    )
+    before, after = pl.col('before'), pl.col('after')
+    joined, left = (before == 0) & (after > 0), (before > 0) & (after == 0)
+    per_point = changes.group_by('currency', 'point').agg(
+        mrr_change=pl.col('delta').sum(),
+        customers_change=joined.sum().cast(pl.Int64) - left.sum().cast(pl.Int64),
+        new_mrr=pl.when(before == 0).then(after).otherwise(0).sum(),
+        expansion_mrr=pl.when((before > 0) & (after > before)).then(after - before).otherwise(0).sum(),
+        contraction_mrr=pl.when((after > 0) & (after < before)).then(before - after).otherwise(0).sum(),
+        churned_mrr=pl.when(left).then(before).otherwise(0).sum(),
+        new_customers=joined.sum().cast(pl.Int64),
+        churned_customers=left.sum().cast(pl.Int64)
+    )
+
+    periods = pl.DataFrame({'point': range(last + 1), 'start': [None] + days[:-1], 'end': days},
+                           schema={'point': pl.Int64, 'start': pl.Date, 'end': pl.Date})
+    counted = ['mrr_change', 'customers_change', 'new_mrr', 'expansion_mrr', 'contraction_mrr', 'churned_mrr',
+               'new_customers', 'churned_customers']
+    return (
+        per_point.select('currency').unique().join(periods, how='cross')
+        .join(per_point, on=['currency', 'point'], how='left')
+        .with_columns(pl.col(counted).fill_null(0).cast(pl.Int64))
+        .sort('currency', 'point')
+        .with_columns(
+            mrr_end=pl.col('mrr_change').cum_sum().over('currency'),
+            customers_end=pl.col('customers_change').cum_sum().over('currency')
+        )
+        .with_columns(
+            mrr_start=pl.col('mrr_end').shift(1).over('currency'),
+            customers_start=pl.col('customers_end').shift(1).over('currency')
+        )
+        .filter(pl.col('point') > 0)
+        .select(
+            'currency', 'start', 'end',
+            mrr_start=_amount('mrr_start'),
+            mrr_end=_amount('mrr_end'),
+            arr=_amount('mrr_end') * 12,
+            new_mrr=_amount('new_mrr'),
+            expansion_mrr=_amount('expansion_mrr'),
+            contraction_mrr=_amount('contraction_mrr'),
+            churned_mrr=_amount('churned_mrr'),
+            customers_start='customers_start',
+            customers_end='customers_end',
+            new_customers='new_customers',
+            churned_customers='churned_customers',
+            logo_churn=pl.when(pl.col('customers_start') > 0)
+            .then(pl.col('churned_customers') / pl.col('customers_start'))
+        )
+    )
+
+
+def _amount(column):
+    return pl.col(column) / MRR_SCALE
+
+
+def revenue_report(start, end, by=None):
+    """revenue_movements over every subscription billed since the start, as JSON-ready dicts."""
+    billed_since = datetime.combine(start, time())
+    subscriptions = split_at_plan_changes(load_subscriptions(billed_since=billed_since),
+                                          load_plan_changes(billed_since))
+    report = revenue_movements(subscriptions, start, end, by)
+    return [
+        {**row, 'start': row['start'].isoformat(), 'end': row['end'].isoformat()}
+        for row in report.to_dicts()
+    ]
+
+
+def parse_date(value):
+    """A YYYY-MM-DD date, or None if value is empty."""
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
@@ -0,0 +1,227 @@
+"""
+Daily revenue rollups, kept up to date by the webhook handlers.
+
+The daily_revenue table holds, for each day and plan (currency, product and
+price), the change that day in MRR and in the number of subscriptions billed.
+A subscription is billed as billing_spans works it out, counted from the day its
+billing starts until the day it ends. The changes summed up to a day give the
+MRR and active subscriptions of each plan at the end of that day, so dashboards
+read a row per day and plan rather than every subscription.
+
+Webhook handlers read a subscription's billing before and after they write it
+and record the difference with record_change, in the same transaction as the
+write. A subscription whose plan changed is billed on each plan in its price
+history from when that plan took effect, so a plan change ends the old plan's
+span on the day of the change and starts the new one's, and leaves earlier days
+as they were. Changes are added to the rows rather than overwriting them, so webhook
+workers handling different customers can update the same day and plan
+concurrently. `flask analytics rebuild-rollups` recomputes the table from the
+subscriptions, for example after upgrading to the migration that added it.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from types import SimpleNamespace
+
+import polars as pl
+from app import db
+from app.analytics.revenue import (
+    MRR_SCALE,
+    PLAN_SCHEMA,
+    billing_span,
+    billing_spans,
+    load_plan_changes,
+    load_subscriptions,
+    split_at_plan_changes
+)
+from app.models import DailyRevenue, Subscription, SubscriptionPrice
+from app.payments.persistence import upsert
+
+PLAN_COLUMNS = ['currency', 'product_id', 'price_id']
+ROLLUP_KEY = ['day', *PLAN_COLUMNS]
+
+# The Subscription columns billing_span reads. Updates that set none of them leave the rollups as they are.
+BILLING_COLUMNS = (
+    Subscription.status, Subscription.product_id, Subscription.price_id, Subscription.amount, Subscription.currency,
+    Subscription.billing_interval, Subscription.billing_interval_count, Subscription.created_at,
+    Subscription.trial_end, Subscription.ended_at, Subscription.current_period_end
+)
+BILLING_KEYS = frozenset(column.key for column in BILLING_COLUMNS)
+
+
+def billing_state(stripe_subscription_id):
+    """
+    The columns billing_span reads for a subscription, or None if it is not in the database.
+
+    The row is locked until the transaction ends on databases that support it,
+    so its billing cannot change between this read and the handler's write.
+    A subscription with a price history has a row for each plan in it, as
+    split_at_plan_changes splits it, with the plan's own columns and the
+    plan_from and plan_until it was billed between.
+
+    Returns:
+        list: The rows, or None
+    """
+    subscription = db.session.execute(
+        db.select(*BILLING_COLUMNS)
+        .where(Subscription.stripe_subscription_id == stripe_subscription_id)
+        .with_for_update()
+    ).first()
+    if subscription is None:
+        return None
+    plans = db.session.execute(
+        db.select(SubscriptionPrice.effective_at, *[getattr(SubscriptionPrice, name) for name in PLAN_SCHEMA])
+        .where(SubscriptionPrice.stripe_subscription_id == stripe_subscription_id)
+        .order_by(SubscriptionPrice.effective_at)
+    ).all()
+    if not plans:
+        return [subscription]
+    ends = [plan.effective_at for plan in plans[1:]] + [None]
+    return [
+        SimpleNamespace(**{**subscription._asdict(), **plan._asdict()}, plan_from=plan.effective_at, plan_until=end)
+        for plan, end in zip(plans, ends)
+    ]
+
+
+def _changes(state, sign):
+    """The (day, plan) changes the spans of a subscription's billing_state add to the rollups, negated for a sign of -1."""
+    return [change for subscription in state or () for change in _span_changes(subscription, sign)]
+
+
+def _span_changes(subscription, sign):
+    span = billing_span(subscription)
+    if span is None:
+        return []
+    mrr, start, end = span
+    plan = (subscription.currency, subscription.product_id, subscription.price_id)
+    if end is not None and end.date() <= start.date():
+        # Billed for part of a day at most, which no day's end sees
+        return []
+    changes = [((start.date(), *plan), sign * mrr, sign)]
+    if end is not None:
+        changes.append(((end.date(), *plan), -sign * mrr, -sign))
+    return changes
+
+
+def record_change(before, after):
+    """
+    Move a subscription's contribution to the rollups from its billing before a write to its billing after.
+
+    Does not commit; it is written in the caller's transaction.
+
+    Args:
+        before: The subscription's billing_state before the write, or None if it was new
+        after: Its billing_state after the write, or a list of the Subscription if it was new
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for key, mrr, subscriptions in _changes(before, -1) + _changes(after, 1):
+        totals[key][0] += mrr
+        totals[key][1] += subscriptions
+    for key, (mrr, subscriptions) in totals.items():
+        if mrr or subscriptions:
+            upsert(
+                DailyRevenue,
+                dict(zip(ROLLUP_KEY, key), mrr_change=mrr, subscriptions_change=subscriptions),
+                index_elements=ROLLUP_KEY,
+                increment_columns=['mrr_change', 'subscriptions_change']
+            )
+
+
+def rebuild_rollups():
+    """
+    Recompute the daily_revenue table from every subscription.
+
+    Does not commit. The rows are replaced in the caller's transaction, so
+    dashboards see the old rollups until it commits. A webhook applied while
+    the subscriptions are read may be missed by the rebuild, so run it while
+    the webhook workers are quiet.
+
+    Returns:
+        int: The number of rows written
+    """
+    subscriptions = split_at_plan_changes(load_subscriptions(), load_plan_changes())
+    spans = billing_spans(subscriptions).with_columns(
+        start=pl.from_epoch('start', time_unit='s').dt.date(),
+        end=pl.from_epoch('end', time_unit='s').dt.date()
+    ).filter(pl.col('end').is_null() | (pl.col('end') > pl.col('start')))
+    rows = (
+        pl.concat([
+            spans.select(*PLAN_COLUMNS, day='start', mrr_change='mrr', subscriptions_change=pl.lit(1)),
+            spans.filter(pl.col('end').is_not_null()).select(
+                *PLAN_COLUMNS, day='end', mrr_change=-pl.col('mrr'), subscriptions_change=pl.lit(-1)
+            ),
+        ])
+        .group_by(ROLLUP_KEY).agg(pl.col('mrr_change', 'subscriptions_change').sum())
+        .filter((pl.col('mrr_change') != 0) | (pl.col('subscriptions_change') != 0))
+    )
+
+    db.session.execute(db.delete(DailyRevenue))
+    if rows.height:
+        db.session.execute(db.insert(DailyRevenue), rows.to_dicts())
+    return rows.height
+
+
+def daily_revenue(start, end, per_plan=False):
+    """
+    MRR, ARR and active subscriptions at the end of each day of a date range, per currency, from the rollups.
+
+    Reads the rollup rows before the end of the range, one per day and plan
+    that changed, and none of the subscriptions. Changes before the range are
+    summed into its first day by the database.
+
+    Args:
+        start (datetime.date): First day of the range
+        end (datetime.date): Day after the range
+        per_plan (bool): Break each currency down by product and price
+
+    Returns:
+        polars.DataFrame: day, currency, product_id and price_id if per_plan,
+        mrr and arr in the smallest currency unit, and subscriptions. Plans
+        with no revenue in the range are left out.
+
+    Raises:
+        ValueError: If the range is empty
+    """
+    if start >= end:
+        raise ValueError('The start date must be before the end date.')
+    keys = PLAN_COLUMNS if per_plan else ['currency']
+    columns = [getattr(DailyRevenue, key) for key in keys]
+    day = db.case((DailyRevenue.day < start, start), else_=DailyRevenue.day)
+    rows = db.session.execute(
+        db.select(
+            day, *columns,
+            # Postgres sums integers as numerics
+            db.cast(db.func.sum(DailyRevenue.mrr_change), db.BigInteger),
+            db.cast(db.func.sum(DailyRevenue.subscriptions_change), db.BigInteger)
+        )
+        .where(DailyRevenue.day < end)
+        .group_by(day, *columns)
+    ).all()
+    changes = pl.DataFrame(
+        rows,
+        schema={'day': pl.Date, **{key: pl.String for key in keys}, 'mrr': pl.Int64, 'subscriptions': pl.Int64},
+        orient='row'
+    )
+
+    days = pl.DataFrame({'day': pl.date_range(start, end - timedelta(days=1), '1d', eager=True)})
+    return (
+        changes.select(keys).unique().join(days, how='cross')
+        .join(changes, on=['day', *keys], how='left')
+        .with_columns(pl.col('mrr', 'subscriptions').fill_null(0))
+        .sort(*keys, 'day')
+        .with_columns(pl.col('mrr', 'subscriptions').cum_sum().over(keys))
+        .filter(((pl.col('mrr') != 0) | (pl.col('subscriptions') != 0)).any().over(keys))
+        .select(
+            'day', *keys,
+            mrr=pl.col('mrr') / MRR_SCALE,
+            arr=pl.col('mrr') / MRR_SCALE * 12,
+            subscriptions='subscriptions'
+        )
+    )
+
+
+def daily_report(start, end, per_plan=False):
+    """daily_revenue as JSON-ready dicts."""
+    return [
+        {**row, 'day': row['day'].isoformat()}
+        for row in daily_revenue(start, end, per_plan).to_dicts()
+    ]
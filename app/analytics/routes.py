@@ -0,0 +1,74 @@
+from flask import Response, jsonify, request, stream_with_context
+from app.analytics import bp
+from app.analytics.export import FORMATS, export_chunks, parse_cursor
+from app.analytics.revenue import parse_date, revenue_report
+from app.analytics.rollups import daily_report
+from app.auth.decorators import admin_required
+
+
+@bp.route('/revenue')
+@admin_required
+def revenue():
+    """
+    MRR, ARR, MRR movements and logo churn, see app/analytics/revenue.py.
+
+    Query parameters:
+        start, end: YYYY-MM-DD, the first day and the day after the range. Required.
+        by: 'day', 'week' or 'month' to break the range down. Optional.
+    """
+    try:
+        start, end = parse_date(request.args.get('start')), parse_date(request.args.get('end'))
+        if start is None or end is None:
+            raise ValueError('start and end are required.')
+        periods = revenue_report(start, end, request.args.get('by') or None)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'start': start.isoformat(), 'end': end.isoformat(), 'periods': periods})
+
+
+@bp.route('/daily')
+@admin_required
+def daily():
+    """
+    MRR, ARR and active subscriptions at the end of each day, from the daily rollups, see app/analytics/rollups.py.
+
+    Query parameters:
+        start, end: YYYY-MM-DD, the first day and the day after the range. Required.
+        per_plan: '1' to break each currency down by product and price. Optional.
+    """
+    try:
+        start, end = parse_date(request.args.get('start')), parse_date(request.args.get('end'))
+        if start is None or end is None:
+            raise ValueError('start and end are required.')
+        days = daily_report(start, end, per_plan=request.args.get('per_plan') == '1')
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'start': start.isoformat(), 'end': end.isoformat(), 'days': days})
+
+
+@bp.route('/export')
+@admin_required
+def export():
+    """
+    Every customer joined to their subscriptions, streamed as CSV or NDJSON, see app/analytics/export.py.
+
+    Query parameters:
+        format: 'csv' (default) or 'ndjson'.
+        after: Resume after the row with this cursor, the first column of every row. The CSV header is left out.
+        limit: Stop after this many rows. Optional.
+    """
+    output_format = request.args.get('format') or 'csv'
+    try:
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown format {output_format!r}, expected one of {', '.join(FORMATS)}")
+        after = parse_cursor(request.args['after']) if request.args.get('after') else None
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be positive.')
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return Response(
+        stream_with_context(export_chunks(output_format, after, limit, header=after is None)),
+        mimetype=FORMATS[output_format],
+        headers={'Content-Disposition': f'attachment; filename=customers.{output_format}'}
+    )
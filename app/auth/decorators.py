@@ -0,0 +1,18 @@
+from functools import wraps
+from flask import current_app, jsonify
+from flask_login import current_user
+
+
+def admin_required(f):
+    """
+    Flask decorator for JSON endpoints only the users listed in ADMIN_EMAILS may call.
+    Answers 401 to anonymous users and 403 to everyone else.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'Authentication required.'}), 401
+        if current_user.email.lower() not in current_app.config['ADMIN_EMAILS']:
+            return jsonify({'error': 'Admin access required.'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
@@ -7,6 +7,7 @@ from app.auth import bp
 from app.auth.forms import LoginForm, RegistrationForm
 from app import db
 from app.models import User
+from app.payments.billing import SNAPSHOT_KEY
 
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -54,5 +55,6 @@ def register():
 @login_required
 def logout():
     logout_user()
+    session.pop(SNAPSHOT_KEY, None)
     flash('You have been signed out.')
     return redirect(url_for('general.index'))
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+
+import click
+import sqlalchemy as sa
+from flask import Blueprint, current_app
+from app import db
+from app.models import WebhookEvent
+from app.payments.catchup import catch_up
+from app.payments.dispatcher import LatencyHistogram, summarise_slowest
+from app.payments.entitlements import sync_entitlements
+from app.payments.inbox import FAILED
+
+bp = Blueprint('stripe_cli', __name__, cli_group='stripe')
+
+
+@bp.cli.command('slowest')
+@click.option('--hours', default=24, show_default=True, help='Only include events received in this many hours.')
+@click.option('--limit', default=10, show_default=True, help='Number of event types to show.')
+def slowest(hours, limit):
+    """Show the webhook event types with the slowest handlers."""
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    rows = db.session.execute(
+        sa.select(WebhookEvent.event_type, WebhookEvent.duration_ms, WebhookEvent.status)
+        .where(WebhookEvent.received_at >= since)
+    )
+
+    histograms = {}
+    failures = {}
+    for event_type, duration_ms, status in rows:
+        if duration_ms is not None:
+            histograms.setdefault(event_type, LatencyHistogram()).observe(duration_ms)
+        if status == FAILED:
+            failures[event_type] = failures.get(event_type, 0) + 1
+
+    stats = {event_type: histogram.summary() for event_type, histogram in histograms.items()}
+    if not stats:
+        click.echo(f'No handled webhook events in the last {hours} hours.')
+        return
+
+    click.echo(f"{'event type':<45} {'count':>7} {'failed':>7} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for event_type, summary in summarise_slowest(stats, limit):
+        click.echo(
+            f"{event_type:<45} {summary['count']:>7} {failures.get(event_type, 0):>7} "
+            f"{summary['mean_ms']:>9.1f} {summary['p50_ms']:>9.1f} {summary['p99_ms']:>9.1f} {summary['max_ms']:>9.1f}"
+        )
+
+
+@bp.cli.command('catch-up')
+@click.option('--hours', type=int, help='Replay events from this many hours ago instead of the stored cursor.')
+@click.option('--windows', default=8, show_default=True, help='Number of time ranges to fetch concurrently.')
+@click.option('--workers', type=int, help='Number of customers to apply concurrently. Defaults to WEBHOOK_WORKERS.')
+def catch_up_command(hours, windows, workers):
+    """Replay Stripe events missed since the last catch-up."""
+    since = None
+    if hours is not None:
+        since = int((datetime.now(timezone.utc) - timedelta(hours=hours)).timestamp())
+    if workers is None:
+        workers = max(1, current_app.config['WEBHOOK_WORKERS'])
+
+    try:
+        result = catch_up(since=since, windows=windows, workers=workers)
+    except ValueError as exc:
+        raise click.UsageError(f'{exc} Use --hours for the first run.')
+
+    click.echo(
+        f"Fetched {result['fetched']} events in {result['seconds']:.1f}s: "
+        f"{result['applied']} applied, {result['skipped']} already handled, {result['failed']} failed."
+    )
+
+
+@bp.cli.command('sync-entitlements')
+@click.option('--stale-only', is_flag=True, help='Only sync customers never synced or marked stale by a subscription change.')
+@click.option('--workers', default=4, show_default=True, help='Number of customers to sync concurrently.')
+def sync_entitlements_command(stale_only, workers):
+    """Resync every customer's stored entitlements from Stripe."""
+    result = sync_entitlements(stale_only=stale_only, workers=workers)
+    click.echo(
+        f"Synced entitlements for {result['synced']} customers in {result['seconds']:.1f}s, "
+        f"{result['failed']} failed."
+    )
@@ -0,0 +1,181 @@
+"""
+Named database engine profiles.
+
+DATABASE_PROFILE picks one of ENGINE_PROFILES, which sets the connection
+pool, statement timeouts and, on SQLite, the pragmas run on every new
+connection. Settings a database does not support are skipped, so any profile
+can be used with any URL. SQLALCHEMY_ENGINE_OPTIONS in the config override the
+profile's options.
+
+The Postgres timeouts only apply to requests. They are set with SET LOCAL at
+the start of each transaction db.session begins in a request, so migrations,
+CLI commands such as `flask analytics rebuild-rollups` and the webhook
+workers can run as long as they need.
+
+REPLICA_DATABASE_URIS adds read-only replicas of the primary as binds named
+replica_0, replica_1 and so on, with the same profile. RoutingSession sends the
+reads of GET, HEAD and OPTIONS requests to one of them, picked per request.
+Everything else goes to the primary: writes, reads after a write in the same
+request, other methods such as the webhook endpoint's POST, and anything run
+outside a request, such as webhook workers and CLI commands. A user's requests
+stick to the primary for REPLICA_STICKY_SECONDS after one of them writes or
+stick_to_primary is called, for example after their billing changes, so they
+read their own writes while the replicas catch up.
+"""
+import random
+import time
+from functools import partial
+
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+ENGINE_PROFILES = {
+    # SQLAlchemy's defaults
+    'default': {},
+    # A SQLite file shared by a host's web workers and webhook threads. In WAL mode readers carry on while
+    # a webhook writes, and writers queue for busy_timeout ms instead of failing with "database is locked".
+    # synchronous=NORMAL only fsyncs at checkpoints, which WAL keeps consistent across a crash.
+    'sqlite': {
+        'sqlite_pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000},
+    },
+    # Postgres behind several gunicorn workers, each with its own pool: at most 15 connections a worker.
+    # Connections are checked before use and replaced every 30 minutes, so restarts and idle timeouts
+    # on the server or a pooler do not surface as errors, and no query or lock wait holds a request for long.
+    'postgres': {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'statement_timeout_ms': 5000,
+        'lock_timeout_ms': 2000,
+    },
+}
+
+# Only for pools that hold connections, which in-memory SQLite databases do not use
+POOL_SIZE_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+POOL_OPTIONS = ('pool_pre_ping', 'pool_recycle')
+
+# Profile keys set per request transaction on Postgres, and the setting each one is
+REQUEST_SETTINGS = (('statement_timeout_ms', 'statement_timeout'), ('lock_timeout_ms', 'lock_timeout'))
+
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Session cookie key holding when the user's requests may read from the replicas again
+STICKY_KEY = '_primary_until'
+
+
+def engine_profile(name):
+    try:
+        return ENGINE_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown DATABASE_PROFILE {name!r}, expected one of {', '.join(ENGINE_PROFILES)}") from None
+
+
+def engine_options(profile, url):
+    """The create_engine options a profile gives for a database URL."""
+    url = sa.engine.make_url(url)
+    backend = url.get_backend_name()
+    options = {key: profile[key] for key in POOL_OPTIONS if key in profile}
+    if not (backend == 'sqlite' and url.database in (None, '', ':memory:')):
+        options.update((key, profile[key]) for key in POOL_SIZE_OPTIONS if key in profile)
+    return options
+
+
+def request_settings(profile):
+    """The Postgres settings a profile gives each transaction begun in a request, as (name, value) pairs."""
+    return [(setting, int(profile[key])) for key, setting in REQUEST_SETTINGS if key in profile]
+
+
+def _set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def _is_read(clause):
+    return getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None
+
+
+def _replica():
+    """The replica bind key for the current request's reads, or None if they go to the primary."""
+    replicas = current_app.extensions['database_replicas']
+    if (not replicas or request.method not in READ_ONLY_METHODS or g.get('db_primary')
+            or session.get(STICKY_KEY, 0) > time.time()):
+        return None
+    if 'db_replica' not in g:
+        g.db_replica = random.choice(replicas)
+    return g.db_replica
+
+
+class RoutingSession(Session):
+    """db.session, sending the reads of read-only requests to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or (clause is not None and not _is_read(clause)):
+                # Read the rest of the request from the primary too, and stick the user to it
+                g.db_primary = True
+            elif _is_read(clause):
+                replica = _replica()
+                if replica is not None:
+                    return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def stick_to_primary():
+    """Read from the primary for the rest of this request and the user's requests in the next REPLICA_STICKY_SECONDS."""
+    g.db_primary = True
+
+
+@sa.event.listens_for(RoutingSession, 'after_begin')
+def _set_request_timeouts(session, transaction, connection):
+    if has_request_context() and connection.dialect.name == 'postgresql':
+        for setting, value in current_app.extensions['database_request_settings']:
+            connection.exec_driver_sql(f'SET LOCAL {setting} = {value}')
+
+
+def _stick_after_writes(response):
+    if g.get('db_primary') and '_user_id' in session:
+        session[STICKY_KEY] = int(time.time()) + current_app.config['REPLICA_STICKY_SECONDS']
+    return response
+
+
+def _reset_routing(exc):
+    g.pop('db_primary', None)
+    g.pop('db_replica', None)
+
+
+def init_app(app):
+    """Initialize db for the app with the engine profile named by DATABASE_PROFILE, and its replicas."""
+    from app import db
+
+    app.config.setdefault('DATABASE_PROFILE', 'default')
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 30)
+    profile = engine_profile(app.config['DATABASE_PROFILE'])
+    configured = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(profile, app.config['SQLALCHEMY_DATABASE_URI']),
+        **configured
+    }
+    replicas = {
+        f'replica_{index}': {'url': url, **engine_options(profile, url), **configured}
+        for index, url in enumerate(app.config.get('REPLICA_DATABASE_URIS') or ())
+    }
+    app.config['SQLALCHEMY_BINDS'] = {**replicas, **app.config.get('SQLALCHEMY_BINDS', {})}
+    app.extensions['database_replicas'] = list(replicas)
+    app.extensions['database_request_settings'] = request_settings(profile)
+    db.init_app(app)
+    for key in replicas:
+        # Replicas copy the primary's tables, so create_all and migrations leave them alone
+        db.metadatas.pop(key, None)
+    app.after_request(_stick_after_writes)
+    app.teardown_request(_reset_routing)
+
+    pragmas = profile.get('sqlite_pragmas')
+    if pragmas:
+        with app.app_context():
+            for engine in db.engines.values():
+                if engine.dialect.name == 'sqlite':
+                    sa.event.listen(engine, 'connect', partial(_set_pragmas, pragmas))
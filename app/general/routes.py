@@ -1,9 +1,10 @@
 import os
 import stripe
 from flask import render_template, current_app
-from flask_login import login_required, current_user
+from flask_login import login_required
 from app.general import bp
 from app.payments.decorators import requires_feature
+from app.payments.billing import billing_context, has_active_access
 
 
 @bp.route('/')
@@ -24,35 +25,25 @@ def access():
             error="Stripe API key is not configured."
         )
 
-    customer = current_user.customer
-    if not customer:
+    billing = billing_context()
+    if not billing.customer:
         return render_template(
             'access.html',
             title='Access',
             error="No Stripe customer is linked to your account."
         )
 
-    try:
-        entitlements = stripe.entitlements.ActiveEntitlement.list(
-            customer=customer.stripe_customer_id,
-            limit=100
-        )
-    except stripe.error.StripeError as exc:
-        current_app.logger.error(f"Stripe error checking entitlements: {exc}")
-        return render_template(
-            'access.html',
-            title='Access',
-            error="There was a problem checking your subscription status."
-        )
-
-    entitlement_keys = sorted({e.lookup_key for e in entitlements.data if e.lookup_key})
-    has_test_access = "test-access" in entitlement_keys
-    has_test_access_2 = "test-access-2" in entitlement_keys
+    entitlement_keys = sorted(billing.lookup_keys())
+    # Features are only usable while the subscription is paid up, as in requires_feature
+    has_active_subscription = has_active_access(billing.user)
+    has_test_access = has_active_subscription and billing.has_feature("test-access")
+    has_test_access_2 = has_active_subscription and billing.has_feature("test-access-2")
 
     return render_template(
         'access.html',
         title='Access',
         entitlement_keys=entitlement_keys,
+        has_active_subscription=has_active_subscription,
         has_test_access=has_test_access,
         has_test_access_2=has_test_access_2
     )
@@ -1,6 +1,6 @@
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, login
@@ -30,32 +30,178 @@ class User(UserMixin, db.Model):
 def load_user(user_id: str) -> Optional["User"]:
     if not user_id:
         return None
-    return db.session.get(User, int(user_id))
+    # Loads the customer, subscription and entitlements in the same query, or from the session, see app/payments/billing.py
+    from app.payments.billing import load_user_context
+    return load_user_context(int(user_id)).user
 
 class Customer(db.Model):
     __tablename__ = 'customers'
 
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('users.id'), nullable=False)
+    # Indexed for the login manager's user loader, which finds the customer by user on every request
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('users.id'), index=True, nullable=False)
     stripe_customer_id: so.Mapped[str] = so.mapped_column(sa.String(255), unique=True, nullable=False)
     created_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
     customer_name: so.Mapped[str] = so.mapped_column(sa.String(255), nullable=True)
+    # When the entitlements table last matched Stripe for this customer. NULL until the first
+    # entitlement summary webhook or sync, or after a subscription change that has not been synced yet.
+    entitlements_synced_at: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime, nullable=True)
+    # The customer's active entitlements as one bit per Feature, see app/payments/features.py
+    entitlement_mask: so.Mapped[int] = so.mapped_column(sa.BigInteger, default=0, server_default='0', nullable=False)
     # Relationship
     user: so.Mapped["User"] = so.relationship(back_populates="customer")
     subscriptions: so.Mapped[list["Subscription"]] = so.relationship(back_populates="customer")
+    entitlements: so.Mapped[list["Entitlement"]] = so.relationship(back_populates="customer")
 
 
 class Subscription(db.Model):
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        # A customer's subscriptions, optionally with a given status and paid up to a given time,
+        # for the relationship, the billing context and has_active_access
+        sa.Index('ix_subscriptions_customer_status_period_end', 'stripe_customer_id', 'status', 'current_period_end'),
+        # A customer's subscriptions in ID order, for the keyset of the export
+        sa.Index('ix_subscriptions_customer_id', 'stripe_customer_id', 'id'),
+    )
 
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     stripe_customer_id: so.Mapped[str] = so.mapped_column(sa.ForeignKey('customers.stripe_customer_id'), nullable=False)
     stripe_subscription_id: so.Mapped[str] = so.mapped_column(sa.String(255), unique=True, nullable=False)
-    status: so.Mapped[str] = so.mapped_column(sa.String(50), nullable=False)
+    # Indexed for queries across all active subscribers
+    status: so.Mapped[str] = so.mapped_column(sa.String(50), index=True, nullable=False)
     product_id: so.Mapped[str] = so.mapped_column(sa.String(255), nullable=False)
     price_id: so.Mapped[str] = so.mapped_column(sa.String(255), nullable=False)
     created_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+    # Unix timestamp of the newest Stripe event applied to this row, so older events delivered late are skipped
+    last_event_created: so.Mapped[Optional[int]] = so.mapped_column(sa.BigInteger, nullable=True)
+    # The period paid for or in trial, in naive UTC, kept up to date by invoice and subscription webhooks.
+    # NULL for rows created before they were recorded, until the next such webhook.
+    current_period_start: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime, nullable=True)
+    current_period_end: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime, nullable=True)
+    cancel_at_period_end: so.Mapped[bool] = so.mapped_column(sa.Boolean, default=False, server_default=sa.false(), nullable=False)
+    trial_end: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime, nullable=True)
+    # When a cancelled subscription ended, in naive UTC
+    ended_at: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime, nullable=True)
+    # What the subscription bills every billing_interval_count billing_intervals ('day', 'week', 'month' or 'year'),
+    # in the smallest unit of the currency, summed over its items. NULL for rows stored before prices were recorded.
+    amount: so.Mapped[Optional[int]] = so.mapped_column(sa.BigInteger, nullable=True)
+    currency: so.Mapped[Optional[str]] = so.mapped_column(sa.String(3), nullable=True)
+    billing_interval: so.Mapped[Optional[str]] = so.mapped_column(sa.String(10), nullable=True)
+    billing_interval_count: so.Mapped[Optional[int]] = so.mapped_column(sa.Integer, nullable=True)
    
     # Relationship
     customer: so.Mapped["Customer"] = so.relationship(back_populates="subscriptions")
 
+
+class SubscriptionPrice(db.Model):
+    """
+    A plan a subscription billed from a given time, recorded by the webhook handlers when its plan changes.
+
+    A subscription bills each of its rows from when it took effect until the next
+    one did, and the last until it ends, see app/analytics/revenue.py.
+    Subscriptions whose plan never changed have no rows and bill their own plan throughout.
+    """
+    __tablename__ = 'subscription_prices'
+    __table_args__ = (
+        sa.UniqueConstraint('stripe_subscription_id', 'effective_at', name='uq_subscription_prices_subscription_effective_at'),
+    )
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    stripe_subscription_id: so.Mapped[str] = so.mapped_column(sa.ForeignKey('subscriptions.stripe_subscription_id'), nullable=False)
+    # When the subscription started billing this plan, in naive UTC
+    effective_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, nullable=False)
+    # As on Subscription
+    product_id: so.Mapped[str] = so.mapped_column(sa.String(255), nullable=False)
+    price_id: so.Mapped[str] = so.mapped_column(sa.String(255), nullable=False)
+    amount: so.Mapped[Optional[int]] = so.mapped_column(sa.BigInteger, nullable=True)
+    currency: so.Mapped[Optional[str]] = so.mapped_column(sa.String(3), nullable=True)
+    billing_interval: so.Mapped[Optional[str]] = so.mapped_column(sa.String(10), nullable=True)
+    billing_interval_count: so.Mapped[Optional[int]] = so.mapped_column(sa.Integer, nullable=True)
+
+
+class DailyRevenue(db.Model):
+    """
+    The change on a day in MRR and subscriptions billed for one plan, kept up to date by the webhook handlers.
+
+    Summed over the days up to one, they give its MRR and active subscriptions, see app/analytics/rollups.py.
+    """
+    __tablename__ = 'daily_revenue'
+
+    day: so.Mapped[date] = so.mapped_column(sa.Date, primary_key=True)
+    currency: so.Mapped[str] = so.mapped_column(sa.String(3), primary_key=True)
+    product_id: so.Mapped[str] = so.mapped_column(sa.String(255), primary_key=True)
+    price_id: so.Mapped[str] = so.mapped_column(sa.String(255), primary_key=True)
+    # In hundredths of the smallest currency unit, as MRR is summed in app/analytics/revenue.py
+    mrr_change: so.Mapped[int] = so.mapped_column(sa.BigInteger, default=0, nullable=False)
+    subscriptions_change: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, nullable=False)
+
+
+
+class Entitlement(db.Model):
+    """A customer's active entitlement, materialized from Stripe so access checks stay local."""
+    __tablename__ = 'entitlements'
+    __table_args__ = (
+        sa.UniqueConstraint('stripe_customer_id', 'lookup_key', name='uq_entitlements_customer_lookup_key'),
+    )
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    stripe_customer_id: so.Mapped[str] = so.mapped_column(sa.ForeignKey('customers.stripe_customer_id'), nullable=False)
+    lookup_key: so.Mapped[str] = so.mapped_column(sa.String(255), nullable=False)
+    stripe_entitlement_id: so.Mapped[Optional[str]] = so.mapped_column(sa.String(255), nullable=True)
+    feature_id: so.Mapped[Optional[str]] = so.mapped_column(sa.String(255), nullable=True)
+
+    # Relationship
+    customer: so.Mapped["Customer"] = so.relationship(back_populates="entitlements")
+
+
+class Feature(db.Model):
+    """A feature lookup key interned to a bit position of Customer.entitlement_mask. Rows are never deleted."""
+    __tablename__ = 'features'
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    lookup_key: so.Mapped[str] = so.mapped_column(sa.String(255), unique=True, nullable=False)
+    bit: so.Mapped[int] = so.mapped_column(sa.Integer, unique=True, nullable=False)
+    created_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+
+class WebhookEvent(db.Model):
+    __tablename__ = 'webhook_events'
+    __table_args__ = (
+        sa.Index('ix_webhook_events_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    stripe_event_id: so.Mapped[str] = so.mapped_column(sa.String(255), unique=True, nullable=False)
+    event_type: so.Mapped[str] = so.mapped_column(sa.String(100), nullable=False)
+    payload: so.Mapped[str] = so.mapped_column(sa.Text, nullable=False)
+    # The customer the event belongs to and when Stripe created it, used to shard and order processing
+    stripe_customer_id: so.Mapped[Optional[str]] = so.mapped_column(sa.String(255), nullable=True)
+    event_created: so.Mapped[Optional[int]] = so.mapped_column(sa.BigInteger, nullable=True)
+    status: so.Mapped[str] = so.mapped_column(sa.String(20), default='pending', nullable=False)
+    attempts: so.Mapped[int] = so.mapped_column(default=0, nullable=False)
+    last_error: so.Mapped[Optional[str]] = so.mapped_column(sa.Text, nullable=True)
+    received_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+    # When the event is next eligible for a worker: retry backoff for pending rows, lease expiry for processing rows
+    next_attempt_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+    processed_at: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime, nullable=True)
+    # Handler run time of the successful attempt, used by `flask stripe slowest`
+    duration_ms: so.Mapped[Optional[float]] = so.mapped_column(sa.Float, nullable=True)
+
+
+class ProcessedEvent(db.Model):
+    __tablename__ = 'processed_events'
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    stripe_event_id: so.Mapped[str] = so.mapped_column(sa.String(255), unique=True, nullable=False)
+    event_type: so.Mapped[str] = so.mapped_column(sa.String(100), nullable=False)
+    processed_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+
+class SyncCursor(db.Model):
+    __tablename__ = 'sync_cursors'
+
+    name: so.Mapped[str] = so.mapped_column(sa.String(50), primary_key=True)
+    stripe_event_id: so.Mapped[str] = so.mapped_column(sa.String(255), nullable=False)
+    # Unix timestamp of the event, as Stripe reports it
+    event_created: so.Mapped[int] = so.mapped_column(sa.BigInteger, nullable=False)
+    updated_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
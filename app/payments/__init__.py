@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('payments', __name__)
 
-from app.payments import routes, webhook
\ No newline at end of file
+from app.payments import billing, routes, webhook, webhook_helpers
\ No newline at end of file
@@ -0,0 +1,278 @@
+"""
+Request-scoped billing context.
+
+A request for a gated page used to load the user, lazily load their customer,
+look the customer up again in requires_feature and then read their
+entitlements, and stacked decorators or templates repeated all of it. The
+user, their customer, their current subscription and their entitlement mask
+are now loaded together in one query the first time any of them is needed,
+normally by the login manager's user loader, and kept on ``flask.g`` until
+the request ends.
+
+When BILLING_SNAPSHOT_TTL is set, the user loader also keeps a snapshot of
+the context in the signed session cookie for that many seconds, and page views
+answered from it run no queries at all. Only users with a customer are
+snapshotted, since a user without one has no version to check and their first
+checkout must be seen straight away. Webhooks that change a customer's billing
+state invalidate their cached entitlements once their transaction commits,
+which bumps the version the snapshot was taken at, so the next request loads
+the context again. With the memory entitlement cache backend only
+invalidations in the same process are seen, and a snapshot can be up to
+BILLING_SNAPSHOT_TTL seconds out of date. The cookie is signed, not encrypted,
+so the snapshot holds nothing the user may not see.
+
+A context restored from a snapshot holds plain SnapshotUser, SnapshotCustomer
+and SnapshotSubscription values rather than rows, so nothing from the cookie
+can reach the database session. Views that write load the rows they change.
+"""
+import time
+from datetime import timezone
+
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app, g, has_request_context, session
+from flask_login import UserMixin, current_user
+from app import database, db
+from app.models import Customer, Subscription, User
+from app.payments import bp
+from app.payments.entitlements import entitlement_cache, utc_datetime
+from app.payments.features import feature_registry
+
+# Subscription statuses that give access, preferred when picking a customer's current subscription
+ACTIVE_STATUSES = ('active', 'trialing')
+
+SNAPSHOT_KEY = '_billing'
+# Bumped when the snapshot's layout changes, so cookies in the old layout are ignored
+SNAPSHOT_FORMAT = 2
+
+
+class SnapshotUser(UserMixin):
+    """The user in a session snapshot, for the login manager. Not a User row."""
+
+    def __init__(self, id, email, name):
+        self.id = id
+        self.email = email
+        self.name = name
+
+
+class SnapshotCustomer:
+    """The customer in a session snapshot. Not a Customer row."""
+
+    def __init__(self, stripe_customer_id, customer_name, entitlement_mask):
+        self.stripe_customer_id = stripe_customer_id
+        self.customer_name = customer_name
+        self.entitlement_mask = entitlement_mask
+
+
+class SnapshotSubscription:
+    """The current subscription in a session snapshot. Not a Subscription row."""
+
+    def __init__(self, stripe_subscription_id, status, product_id, price_id, current_period_end):
+        self.stripe_subscription_id = stripe_subscription_id
+        self.status = status
+        self.product_id = product_id
+        self.price_id = price_id
+        self.current_period_end = current_period_end
+
+
+class BillingContext:
+    """The current user with their customer, current subscription and entitlements."""
+
+    def __init__(self, user=None, customer=None, subscription=None, mask=None):
+        self.user = user
+        self.customer = customer
+        self.subscription = subscription
+        self._mask = mask
+
+    @property
+    def stripe_customer_id(self):
+        return self.customer.stripe_customer_id if self.customer else None
+
+    @property
+    def active_subscription(self):
+        """The current subscription if it gives access, otherwise None."""
+        if self.subscription is not None and _gives_access(self.subscription, utc_datetime()):
+            return self.subscription
+        return None
+
+    def entitlement_mask(self):
+        """
+        The customer's entitlement mask, see app/payments/features.py.
+
+        Comes with the customer row when their entitlements are in sync. Otherwise
+        it is read through the entitlement cache, which schedules a refresh from Stripe.
+        """
+        if self._mask is None:
+            if self.customer is None:
+                self._mask = 0
+            elif self.customer.entitlements_synced_at is not None:
+                self._mask = self.customer.entitlement_mask
+            else:
+                self._mask = entitlement_cache.mask(self.customer.stripe_customer_id)
+        return self._mask
+
+    def has_feature(self, *feature_lookup_keys):
+        """True if the customer has every one of the given features."""
+        return feature_registry.has(self.entitlement_mask(), *feature_lookup_keys)
+
+    def lookup_keys(self):
+        return feature_registry.lookup_keys(self.entitlement_mask())
+
+
+def _gives_access(subscription, at):
+    """Python twin of the condition in has_active_access, for a subscription already loaded."""
+    return subscription.status in ACTIVE_STATUSES and (
+        subscription.current_period_end is None or subscription.current_period_end > at
+    )
+
+
+def has_active_access(user, at=None):
+    """
+    True if the user has a subscription that is active or trialing and paid up at the given time, or now.
+
+    For the current request's user the billing context already holds their
+    current subscription, so no query is run. Otherwise it is answered from the
+    database alone in one query, an index range scan of the user's customer's
+    subscriptions by status and period end. Subscriptions whose period has not
+    been recorded yet go by their status alone.
+    """
+    if user is None or getattr(user, 'id', None) is None:
+        return False
+    billing = g.get('billing')
+    if at is None and billing is not None and billing.user is not None and billing.user.id == user.id:
+        return billing.active_subscription is not None
+    at = at or utc_datetime()
+    return db.session.scalar(sa.select(
+        sa.exists()
+        .where(
+            Customer.user_id == user.id,
+            Subscription.stripe_customer_id == Customer.stripe_customer_id,
+            Subscription.status.in_(ACTIVE_STATUSES),
+            sa.or_(Subscription.current_period_end > at, Subscription.current_period_end.is_(None))
+        )
+    ))
+
+
+def _current_subscription_id():
+    """Correlated subquery picking a customer's active subscription, or else their newest one."""
+    candidate = so.aliased(Subscription)
+    return (
+        sa.select(candidate.id)
+        .where(candidate.stripe_customer_id == Customer.stripe_customer_id)
+        .order_by(
+            sa.case((candidate.status.in_(ACTIVE_STATUSES), 0), else_=1),
+            candidate.created_at.desc(),
+            candidate.id.desc()
+        )
+        .limit(1)
+        .correlate(Customer)
+        .scalar_subquery()
+    )
+
+
+def load_billing_context(user_id):
+    """
+    Load a user's billing context in one query and keep it for the rest of the request.
+
+    Returns:
+        BillingContext: With user None if there is no such user
+    """
+    row = db.session.execute(
+        sa.select(User, Subscription)
+        .outerjoin(User.customer)
+        .outerjoin(Subscription, Subscription.id == _current_subscription_id())
+        .where(User.id == user_id)
+        .options(so.contains_eager(User.customer))
+        # Refresh rows the session already holds, so the context is never older than the database
+        .execution_options(populate_existing=True)
+    ).first()
+    context = BillingContext() if row is None else BillingContext(row.User, row.User.customer, row.Subscription)
+    g.billing = context
+    return context
+
+
+def _save_snapshot(context):
+    """Keep the context in the session, if the user has a customer whose entitlements came from the database."""
+    customer = context.customer
+    if context.user is None or customer is None or customer.entitlements_synced_at is None:
+        if SNAPSHOT_KEY in session:
+            del session[SNAPSHOT_KEY]
+        return
+
+    user, subscription = context.user, context.subscription
+    session[SNAPSHOT_KEY] = {
+        'format': SNAPSHOT_FORMAT,
+        'user': [user.id, user.email, user.name],
+        'customer': [customer.stripe_customer_id, customer.customer_name],
+        'subscription': [
+            subscription.stripe_subscription_id, subscription.status, subscription.product_id, subscription.price_id,
+            int(subscription.current_period_end.replace(tzinfo=timezone.utc).timestamp())
+            if subscription.current_period_end else None
+        ] if subscription else None,
+        'mask': context.entitlement_mask(),
+        'version': entitlement_cache.version(customer.stripe_customer_id),
+        'expires': int(time.time()) + current_app.config['BILLING_SNAPSHOT_TTL']
+    }
+
+
+def _restore_snapshot(user_id):
+    """The billing context kept in the session, or None if there is none for the user or it is out of date."""
+    snapshot = session.get(SNAPSHOT_KEY)
+    if not snapshot or snapshot.get('format') != SNAPSHOT_FORMAT or snapshot['user'][0] != user_id or snapshot['expires'] <= time.time():
+        return None
+    if entitlement_cache.version(snapshot['customer'][0]) != snapshot['version']:
+        return None
+
+    customer = SnapshotCustomer(*snapshot['customer'], entitlement_mask=snapshot['mask'])
+    subscription = None
+    if snapshot['subscription']:
+        *fields, period_end = snapshot['subscription']
+        subscription = SnapshotSubscription(*fields, utc_datetime(period_end) if period_end is not None else None)
+    return BillingContext(SnapshotUser(*snapshot['user']), customer, subscription, mask=snapshot['mask'])
+
+
+def _billing_changed(user_id):
+    """True if the session holds a snapshot of the user from before a webhook changed their billing."""
+    snapshot = session.get(SNAPSHOT_KEY)
+    return bool(
+        snapshot and snapshot.get('format') == SNAPSHOT_FORMAT and snapshot['user'][0] == user_id
+        and entitlement_cache.version(snapshot['customer'][0]) != snapshot['version']
+    )
+
+
+def load_user_context(user_id):
+    """
+    The billing context for the login manager's user loader.
+
+    Served from the session snapshot while it is valid, otherwise loaded with
+    load_billing_context and snapshotted for the following requests. When the
+    snapshot is out of date because the user's billing changed, it is loaded
+    from the primary database, which replicas may not have caught up with.
+    """
+    snapshots = current_app.config['BILLING_SNAPSHOT_TTL'] and has_request_context()
+    context = _restore_snapshot(user_id) if snapshots else None
+    if context is None:
+        if snapshots and _billing_changed(user_id):
+            database.stick_to_primary()
+        context = load_billing_context(user_id)
+        if snapshots:
+            _save_snapshot(context)
+    g.billing = context
+    return context
+
+
+def billing_context():
+    """The billing context for the current request's user, loaded on first use."""
+    # Loading the user normally loads the context along with it, see load_user
+    user = current_user._get_current_object()
+    if 'billing' not in g:
+        if user is None or not user.is_authenticated:
+            g.billing = BillingContext()
+        else:
+            load_billing_context(user.id)
+    return g.billing
+
+
+@bp.teardown_app_request
+def _drop_billing_context(exc):
+    g.pop('billing', None)
@@ -0,0 +1,185 @@
+"""
+Replay Stripe events that were missed while the webhook endpoint was down.
+
+The events list is read from the stored cursor up to now. Cursor pagination
+is sequential by nature, so the time range is split into windows that are
+paged concurrently. The fetched events are then fed through the inbox, which
+means the ledger skips anything already handled and failures are retried by
+the webhook workers like any live event. Events are applied oldest first,
+one customer per thread, so each customer sees its events in order.
+
+The cursor is also moved forward by the webhook workers as they handle live
+events, see advance_cursor, so a run only replays from the last event handled
+before a gap, not from the previous run. Stripe only keeps events for 30 days,
+which bounds how far back this can go.
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from flask import current_app
+from app import db
+from app.models import SyncCursor
+from app.payments.dispatcher import dispatcher
+from app.payments.hydration import event_customer_id
+from app.payments.inbox import CURSOR_NAME, process_event, record_event
+from app.payments.ledger import event_ledger
+from app.payments.stripe_client import stripe_client
+
+PAGE_SIZE = 100
+# Stripe rejects event list requests filtering on more types than this
+MAX_TYPE_FILTERS = 20
+
+
+def load_cursor():
+    """The last event replayed by catch-up or handled after it, or None before the first run."""
+    return db.session.get(SyncCursor, CURSOR_NAME)
+
+
+def save_cursor(event):
+    """Move the cursor forward to the given event."""
+    cursor = load_cursor()
+    if cursor is None:
+        cursor = SyncCursor(name=CURSOR_NAME)
+        db.session.add(cursor)
+    cursor.stripe_event_id = event['id']
+    cursor.event_created = event['created']
+    db.session.commit()
+    return cursor
+
+
+def _windows(since, until, count):
+    """Split [since, until) into at most count contiguous ranges of whole seconds."""
+    count = max(1, min(count, until - since))
+    step, remainder = divmod(until - since, count)
+    bounds = [since]
+    for i in range(count):
+        bounds.append(bounds[-1] + step + (1 if i < remainder else 0))
+    return list(zip(bounds, bounds[1:]))
+
+
+def _fetch_window(app, since, until, types):
+    """Page through every event created in [since, until). Runs in its own app context."""
+    params = {'created': {'gte': since, 'lt': until}, 'limit': PAGE_SIZE}
+    if types:
+        params['types'] = types
+
+    events = []
+    with app.app_context():
+        while True:
+            page = stripe_client.list_events(**params)
+            events.extend(page['data'])
+            if not page['has_more'] or not page['data']:
+                return events
+            params['starting_after'] = page['data'][-1]['id']
+
+
+def fetch_events(since, until, windows=8):
+    """
+    Fetch all events created between two Unix timestamps, oldest first.
+
+    Args:
+        since (int): Include events created at or after this time
+        until (int): Include events created before this time
+        windows (int): Number of time ranges to page through concurrently
+
+    Returns:
+        list: Stripe event objects sorted by creation time
+    """
+    # Only ask for the types we handle, when Stripe lets us filter on all of them
+    types = sorted(dispatcher.handlers)
+    if len(types) > MAX_TYPE_FILTERS:
+        types = None
+
+    app = current_app._get_current_object()
+    ranges = _windows(since, until, windows)
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        pages = executor.map(lambda bounds: _fetch_window(app, *bounds, types), ranges)
+        events = {event['id']: event for page in pages for event in page}
+    return sorted(events.values(), key=lambda event: (event['created'], event['id']))
+
+
+def _apply(app, events):
+    """Apply one customer's events in order. Runs in its own app context."""
+    counts = {'applied': 0, 'skipped': 0, 'failed': 0}
+    with app.app_context():
+        for event in events:
+            if event_ledger.is_processed(event['id']):
+                counts['skipped'] += 1
+                continue
+            webhook_event = record_event(
+                event['id'], event['type'], json.dumps(event),
+                customer_id=event_customer_id(event), created=event['created']
+            )
+            if webhook_event is None:
+                # Already in the inbox, where the webhook workers will finish it
+                counts['skipped'] += 1
+            elif process_event(webhook_event.id):
+                counts['applied'] += 1
+            else:
+                counts['failed'] += 1
+        db.session.remove()
+    return counts
+
+
+def apply_events(events, workers=4):
+    """
+    Feed fetched events through the inbox and the registered handlers.
+
+    Events are grouped by customer and each group is applied in order on one
+    thread. Events that fail stay in the inbox for the webhook workers to retry.
+
+    Args:
+        events (list): Stripe events sorted oldest first
+        workers (int): Number of customers to apply concurrently
+
+    Returns:
+        dict: Counts of applied, skipped and failed events
+    """
+    by_customer = {}
+    for event in events:
+        by_customer.setdefault(event_customer_id(event), []).append(event)
+
+    app = current_app._get_current_object()
+    totals = {'applied': 0, 'skipped': 0, 'failed': 0}
+    if workers <= 1:
+        results = [_apply(app, group) for group in by_customer.values()]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda group: _apply(app, group), by_customer.values()))
+    for counts in results:
+        for key, value in counts.items():
+            totals[key] += value
+    return totals
+
+
+def catch_up(since=None, windows=8, workers=4):
+    """
+    Replay every event created since the cursor (or since a given time) and advance the cursor.
+
+    Args:
+        since (int): Unix timestamp to replay from instead of the stored cursor
+        windows (int): Number of time ranges to fetch concurrently
+        workers (int): Number of customers to apply concurrently
+
+    Returns:
+        dict: Counts of fetched, applied, skipped and failed events, and the elapsed seconds
+    """
+    if since is None:
+        cursor = load_cursor()
+        if cursor is None:
+            raise ValueError('No catch-up cursor is stored yet; give a time to replay from.')
+        # Inclusive, as other events can share the cursor's second; the ledger skips the cursor itself
+        since = cursor.event_created
+
+    started = time.perf_counter()
+    until = int(datetime.now(timezone.utc).timestamp()) + 1
+    events = fetch_events(since, until, windows)
+    result = apply_events(events, workers)
+    if events:
+        save_cursor(events[-1])
+
+    result['fetched'] = len(events)
+    result['seconds'] = time.perf_counter() - started
+    return result
@@ -1,8 +1,7 @@
 from functools import wraps
-from flask import current_app, redirect, url_for, flash
+from flask import redirect, url_for, flash
 from flask_login import current_user
-from app.models import Customer
-import stripe
+from app.payments.billing import billing_context, has_active_access
 
 def requires_feature(feature_lookup_key):
     """
@@ -20,35 +19,27 @@ def requires_feature(feature_lookup_key):
                 flash('Please log in to access this feature.')
                 return redirect(url_for('auth.login'))
             
-            # Get the Stripe customer ID for this user
-            stripe_customer = Customer.query.filter_by(user_id=user.id).first()
+            # Get the Stripe customer for this user, loaded once per request with the user
+            billing = billing_context()
             
-            if not stripe_customer:
+            if not billing.customer:
                 flash('You need a subscription to access this feature.')
                 return redirect(url_for('auth.login'))
+
+            # A lapsed or unpaid subscription ends access before Stripe drops its entitlements
+            if not has_active_access(user):
+                flash('Your subscription is not active. Update your payment details to continue.')
+                return redirect(url_for('payments.billing_portal'))
             
-            try:
-                # Check if user has this entitlement
-                entitlements = stripe.entitlements.ActiveEntitlement.list(
-                    customer=stripe_customer.stripe_customer_id
-                )
-                
-                # Check if the requested feature is in the active entitlements
-                has_feature = any(
-                    e.lookup_key == feature_lookup_key
-                    for e in entitlements.data
-                )
-                
-                if not has_feature:
-                    flash(f'Your subscription doesn\'t include access to this feature.')
-                    return redirect(url_for('upgrade'))
-                    
-                return f(*args, **kwargs)
+            # Check if user has this entitlement. Answered from the database without
+            # calling Stripe, see app/payments/entitlements.py
+            has_feature = billing.has_feature(feature_lookup_key)
+            
+            if not has_feature:
+                flash(f'Your subscription doesn\'t include access to this feature.')
+                return redirect(url_for('upgrade'))
                 
-            except stripe.error.StripeError as e:
-                current_app.logger.error(f"Stripe error checking entitlements: {e}")
-                flash('There was a problem checking your subscription status.')
-                return redirect(url_for('account'))
+            return f(*args, **kwargs)
                 
         return decorated_function
     return decorator
\ No newline at end of file
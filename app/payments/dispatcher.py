@@ -0,0 +1,176 @@
+"""
+Table-driven dispatch of Stripe events to their handlers.
+
+Handlers register for one or more event types with ``@dispatcher.on(...)``.
+Every call is timed into a per-event-type latency histogram together with
+success and failure counts, so we can see which handlers to optimise.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import current_app
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+_current_event = ContextVar('current_event', default=None)
+
+
+class EventNotReady(Exception):
+    """
+    Raised by a handler when an event arrived before the state it applies to.
+
+    For example a subscription deletion delivered before the checkout that
+    created the subscription. The inbox retries the event with backoff.
+    """
+
+
+def current_event():
+    """The event whose handler is running, or None outside of dispatch."""
+    return _current_event.get()
+
+
+def current_event_created():
+    """Unix timestamp of the event being handled, or None outside of dispatch."""
+    event = _current_event.get()
+    return event.get('created') if event is not None else None
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram. Percentiles are reported as bucket upper bounds."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS_MS, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(0.50),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max_ms,
+            'buckets': {
+                ('+Inf' if bound == float('inf') else str(bound)): bucket_count
+                for bound, bucket_count in zip(BUCKETS_MS, self.counts)
+            }
+        }
+
+
+class _HandlerStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.successes = 0
+        self.failures = 0
+
+    def summary(self):
+        return dict(self.latency.summary(), successes=self.successes, failures=self.failures)
+
+
+def summarise_slowest(stats, limit=10):
+    """Order per-event-type summaries by p99, then mean latency, slowest first."""
+    ranked = sorted(
+        stats.items(),
+        key=lambda item: (item[1]['p99_ms'], item[1]['mean_ms']),
+        reverse=True
+    )
+    return ranked[:limit]
+
+
+class EventDispatcher:
+    """Registry mapping Stripe event types to handler functions."""
+
+    def __init__(self):
+        self.handlers = {}
+        self._stats = {}
+        self._unhandled = {}
+        self._lock = threading.Lock()
+
+    def on(self, *event_types):
+        """
+        Register the decorated function as the handler for the given event types.
+        Usage: @dispatcher.on('customer.subscription.deleted')
+        """
+        def decorator(f):
+            for event_type in event_types:
+                if event_type in self.handlers:
+                    raise ValueError(f"A handler is already registered for {event_type}")
+                self.handlers[event_type] = f
+            return f
+        return decorator
+
+    def dispatch(self, event):
+        """
+        Run the handler registered for the event's type with the event's data object.
+
+        Returns:
+            float or None: The handler's run time in milliseconds, or None if no
+            handler is registered for the event type
+        """
+        event_type = event['type']
+        handler = self.handlers.get(event_type)
+        if handler is None:
+            with self._lock:
+                self._unhandled[event_type] = self._unhandled.get(event_type, 0) + 1
+            current_app.logger.info(f"Unhandled event type {event_type}")
+            return None
+
+        token = _current_event.set(event)
+        started = time.perf_counter()
+        try:
+            handler(event['data']['object'])
+        except Exception:
+            self._record(event_type, started, succeeded=False)
+            raise
+        finally:
+            _current_event.reset(token)
+        return self._record(event_type, started, succeeded=True)
+
+    def _record(self, event_type, started, succeeded):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self._stats.get(event_type)
+            if stats is None:
+                stats = self._stats[event_type] = _HandlerStats()
+            stats.latency.observe(elapsed_ms)
+            if succeeded:
+                stats.successes += 1
+            else:
+                stats.failures += 1
+        return elapsed_ms
+
+    def stats(self):
+        with self._lock:
+            return {
+                'handlers': {event_type: stats.summary() for event_type, stats in self._stats.items()},
+                'unhandled': dict(self._unhandled)
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+            self._unhandled.clear()
+
+
+dispatcher = EventDispatcher()
@@ -0,0 +1,612 @@
+"""
+Which features a Stripe customer currently has.
+
+Active entitlements are materialized in the entitlements table. The
+entitlement summary webhook replaces a customer's rows with the set Stripe
+sends, subscription webhooks mark them stale, and ``flask stripe
+sync-entitlements`` repairs any drift. Alongside the rows, each customer's
+entitlements are stored as one bitmask in Customer.entitlement_mask (see
+app/payments/features.py), and access checks answer from that single indexed
+column. Lookups never call Stripe or write: for a customer whose entitlements
+have never been synced, or were marked stale and not synced since, the stored
+entitlements are served while a background thread refreshes them from Stripe,
+so a slow or failing Stripe does not hold up the request. Stripe reads go
+through the circuit breaker in app/payments/stripe_client.py.
+
+In front of the table the masks are cached per customer for
+ENTITLEMENT_CACHE_TTL seconds, and entries are dropped as soon as a webhook
+for the customer is handled, so a cached answer is never older than the last
+change we heard of. ENTITLEMENT_CACHE_BACKEND picks where: ``memory`` keeps a
+bounded LRU in each process, and ``sqlite`` keeps one cache in a local SQLite
+file that every gunicorn worker on the host reads and invalidates, so a
+customer is loaded once per host rather than once per worker.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+import stripe
+from flask import current_app
+from app import db
+from app.models import Customer, Entitlement
+from app.payments.dispatcher import LatencyHistogram
+from app.payments.features import feature_registry
+from app.payments.persistence import unit_of_work, upsert
+from app.payments.stripe_client import stripe_client
+
+
+def utc_datetime(timestamp=None):
+    """A naive UTC datetime for a Unix timestamp, or for now, as stored in entitlements_synced_at."""
+    if timestamp is None:
+        # Whole seconds like event timestamps, so an event from the same second as a sync still applies
+        return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+def _field(entitlement, name):
+    """Read a field from an entitlement given as a webhook dict or a Stripe API object."""
+    if isinstance(entitlement, dict):
+        return entitlement.get(name)
+    return getattr(entitlement, name, None)
+
+
+def _lookup_keys(entitlements):
+    return {_field(e, 'lookup_key') for e in entitlements if _field(e, 'lookup_key')}
+
+
+def load_entitlements(stripe_customer_id):
+    """
+    Read a customer's entitlement mask in one indexed query.
+
+    Returns:
+        tuple: (mask, whether it is in sync with Stripe). Not in sync when the
+        customer is unknown, has never been synced or was marked stale.
+    """
+    row = db.session.execute(
+        db.select(Customer.entitlements_synced_at, Customer.entitlement_mask)
+        .where(Customer.stripe_customer_id == stripe_customer_id)
+    ).first()
+    if row is None:
+        return 0, False
+    return row.entitlement_mask, row.entitlements_synced_at is not None
+
+
+def replace_entitlements(stripe_customer_id, entitlements, synced_at):
+    """
+    Make the customer's stored entitlements match the given set. Does not commit.
+
+    Args:
+        stripe_customer_id (str): The Stripe customer ID
+        entitlements (list): Active entitlements, as webhook dicts or Stripe objects
+        synced_at (datetime): When Stripe reported this set, see utc_datetime
+
+    Returns:
+        bool: False if the customer is unknown or was synced more recently, in
+        which case nothing is written
+    """
+    by_key = {_field(e, 'lookup_key'): e for e in entitlements if _field(e, 'lookup_key')}
+    synced = db.session.execute(
+        db.update(Customer)
+        .where(
+            Customer.stripe_customer_id == stripe_customer_id,
+            db.or_(Customer.entitlements_synced_at.is_(None), Customer.entitlements_synced_at <= synced_at)
+        )
+        .values(entitlements_synced_at=synced_at, entitlement_mask=feature_registry.mask_for(by_key))
+    ).rowcount
+    if not synced:
+        return False
+
+    db.session.execute(
+        db.delete(Entitlement).where(
+            Entitlement.stripe_customer_id == stripe_customer_id,
+            Entitlement.lookup_key.not_in(list(by_key))
+        )
+    )
+    for lookup_key, entitlement in by_key.items():
+        upsert(
+            Entitlement,
+            dict(
+                stripe_customer_id=stripe_customer_id,
+                lookup_key=lookup_key,
+                stripe_entitlement_id=_field(entitlement, 'id'),
+                feature_id=_field(entitlement, 'feature')
+            ),
+            index_elements=['stripe_customer_id', 'lookup_key'],
+            update_columns=['stripe_entitlement_id', 'feature_id']
+        )
+    return True
+
+
+def mark_entitlements_stale(stripe_customer_id, changed_at):
+    """
+    Flag that the customer's entitlements may have changed since they were last synced. Does not commit.
+
+    The next check schedules a refresh from Stripe, unless the entitlement summary webhook
+    syncs them first. Does nothing if they were synced after the change.
+    """
+    if not stripe_customer_id:
+        return
+    db.session.execute(
+        db.update(Customer)
+        .where(
+            Customer.stripe_customer_id == stripe_customer_id,
+            Customer.entitlements_synced_at <= changed_at
+        )
+        .values(entitlements_synced_at=None)
+    )
+
+
+def fetch_entitlements(stripe_customer_id):
+    """List the customer's active entitlements from Stripe."""
+    return stripe_client.list_active_entitlements(stripe_customer_id).data
+
+
+def refresh_entitlements(stripe_customer_id):
+    """
+    Sync one customer's entitlements from Stripe and commit.
+
+    Returns:
+        int: The customer's entitlement mask
+
+    Raises:
+        stripe.error.StripeError: If Stripe could not be reached
+    """
+    synced_at = utc_datetime()
+    entitlements = fetch_entitlements(stripe_customer_id)
+    with unit_of_work():
+        mask = feature_registry.mask_for(_lookup_keys(entitlements))
+        replace_entitlements(stripe_customer_id, entitlements, synced_at)
+    return mask
+
+
+def _sync(app, customer_ids):
+    """Refresh a batch of customers from Stripe. Runs in its own app context."""
+    counts = {'synced': 0, 'failed': 0}
+    with app.app_context():
+        for stripe_customer_id in customer_ids:
+            try:
+                refresh_entitlements(stripe_customer_id)
+            except stripe.error.StripeError as e:
+                current_app.logger.warning(f"Could not sync entitlements for {stripe_customer_id}: {e}")
+                counts['failed'] += 1
+            else:
+                entitlement_cache.invalidate(stripe_customer_id)
+                counts['synced'] += 1
+        db.session.remove()
+    return counts
+
+
+def sync_entitlements(stale_only=False, workers=4):
+    """
+    Resync stored entitlements from Stripe, to repair drift from missed or failed webhooks.
+
+    Args:
+        stale_only (bool): Only sync customers that were never synced or were marked stale
+        workers (int): Number of customers to sync concurrently
+
+    Returns:
+        dict: Counts of synced and failed customers, and the elapsed seconds
+    """
+    started = time.perf_counter()
+    query = db.select(Customer.stripe_customer_id).order_by(Customer.id)
+    if stale_only:
+        query = query.where(Customer.entitlements_synced_at.is_(None))
+    customer_ids = db.session.scalars(query).all()
+
+    workers = max(1, min(workers, len(customer_ids)))
+    batches = [customer_ids[i::workers] for i in range(workers)]
+    app = current_app._get_current_object()
+    if workers == 1:
+        results = [_sync(app, batch) for batch in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda batch: _sync(app, batch), batches))
+
+    totals = {'synced': 0, 'failed': 0}
+    for counts in results:
+        for key, value in counts.items():
+            totals[key] += value
+    totals['seconds'] = time.perf_counter() - started
+    return totals
+
+
+class _EntitlementCache:
+    """Thread-safe bounded LRU of entitlement masks per customer, with a TTL and hit/miss counters."""
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+        self.latency = LatencyHistogram()
+        self._entries = OrderedDict()
+        # Bumped on every invalidation so a lookup that started before it cannot store what it loaded.
+        # Bounded like the entries; only the most recently invalidated customers need a version.
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, customer_id):
+        """Return (mask or None if missing or expired, version to pass to put)."""
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(customer_id)
+                self.hits += 1
+                return entry[1], None
+            if entry is not None:
+                del self._entries[customer_id]
+            self.misses += 1
+            return None, self._versions.get(customer_id, 0)
+
+    def put(self, customer_id, mask, version):
+        with self._lock:
+            if self._versions.get(customer_id, 0) != version:
+                return
+            self._entries[customer_id] = (self.clock() + self.ttl, mask)
+            self._entries.move_to_end(customer_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, customer_id):
+        with self._lock:
+            self._entries.pop(customer_id, None)
+            self._versions[customer_id] = self._versions.get(customer_id, 0) + 1
+            self._versions.move_to_end(customer_id)
+            while len(self._versions) > self.maxsize:
+                self._versions.popitem(last=False)
+
+    def version(self, customer_id):
+        """How many times the customer has been invalidated, as far as this process remembers."""
+        with self._lock:
+            return self._versions.get(customer_id, 0)
+
+    def observe(self, elapsed_ms):
+        with self._lock:
+            self.latency.observe(elapsed_ms)
+
+    def served_stale(self):
+        with self._lock:
+            self.stale_served += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'memory',
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'stale_served': self.stale_served,
+                'lookup_latency': self.latency.summary()
+            }
+
+
+class _SharedEntitlementCache:
+    """
+    Entitlement masks cached in a SQLite file shared by the processes on a host.
+
+    Expiry uses wall-clock time, since monotonic clocks are not comparable
+    between processes. Invalidation versions are stored in the file too, so a
+    lookup in one worker that raced an invalidation in another is not stored.
+    They are pruned version_ttl seconds after the invalidation, by default the
+    entry TTL, once no lookup or copy kept elsewhere can still hold the version
+    from before it. A version is the invalidation's time in milliseconds, so a
+    customer whose version was pruned never gets an earlier one back.
+    Reads never write, so once full the entries closest to expiry are evicted
+    rather than the least recently used. The hit, miss and latency counters are
+    the current process's.
+    """
+
+    def __init__(self, path, maxsize, ttl, clock=time.time, version_ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_ttl = ttl if version_ttl is None else version_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+        self.latency = LatencyHistogram()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'customer_id TEXT PRIMARY KEY, mask INTEGER NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_entries_expires_at ON entries (expires_at)')
+        # Left by earlier releases, which kept a version per customer forever
+        connection.execute('DROP TABLE IF EXISTS versions')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS invalidations ('
+            'customer_id TEXT PRIMARY KEY, version INTEGER NOT NULL, invalidated_at REAL NOT NULL) WITHOUT ROWID'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS ix_invalidations_invalidated_at ON invalidations (invalidated_at)'
+        )
+
+    def _connection(self):
+        """This thread's connection, opened again after a fork since SQLite connections cannot be shared."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # A cache can be rebuilt, so skip the fsyncs
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, customer_id):
+        """Return (mask or None if missing or expired, version to pass to put)."""
+        mask, version = self._connection().execute(
+            'SELECT (SELECT mask FROM entries WHERE customer_id = :customer_id AND expires_at > :now), '
+            '(SELECT version FROM invalidations WHERE customer_id = :customer_id)',
+            {'customer_id': customer_id, 'now': self.clock()}
+        ).fetchone()
+        with self._lock:
+            if mask is not None:
+                self.hits += 1
+                return mask, None
+            self.misses += 1
+        return None, version or 0
+
+    def put(self, customer_id, mask, version):
+        now = self.clock()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT INTO entries (customer_id, mask, expires_at) SELECT :customer_id, :mask, :expires_at '
+                'WHERE coalesce((SELECT version FROM invalidations WHERE customer_id = :customer_id), 0) = :version '
+                'ON CONFLICT (customer_id) DO UPDATE SET mask = excluded.mask, expires_at = excluded.expires_at',
+                {'customer_id': customer_id, 'mask': mask, 'expires_at': now + self.ttl, 'version': version}
+            )
+            connection.execute(
+                'DELETE FROM entries WHERE expires_at <= :now OR customer_id IN ('
+                'SELECT customer_id FROM entries ORDER BY expires_at '
+                'LIMIT max((SELECT count(*) FROM entries) - :maxsize, 0))',
+                {'now': now, 'maxsize': self.maxsize}
+            )
+            self._prune(connection, now)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def invalidate(self, customer_id):
+        now = self.clock()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM entries WHERE customer_id = :customer_id', {'customer_id': customer_id})
+            self._prune(connection, now)
+            connection.execute(
+                'INSERT INTO invalidations (customer_id, version, invalidated_at) '
+                'VALUES (:customer_id, :version, :now) '
+                'ON CONFLICT (customer_id) DO UPDATE SET '
+                'version = max(version + 1, excluded.version), invalidated_at = excluded.invalidated_at',
+                {'customer_id': customer_id, 'version': int(now * 1000), 'now': now}
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _prune(self, connection, now):
+        connection.execute(
+            'DELETE FROM invalidations WHERE invalidated_at <= ?', (now - self.version_ttl,)
+        )
+
+    def version(self, customer_id):
+        """Changes on every invalidation of the customer by any process on the host, 0 if there has been none lately."""
+        row = self._connection().execute(
+            'SELECT version FROM invalidations WHERE customer_id = ?', (customer_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def observe(self, elapsed_ms):
+        with self._lock:
+            self.latency.observe(elapsed_ms)
+
+    def served_stale(self):
+        with self._lock:
+            self.stale_served += 1
+
+    def stats(self):
+        size, = self._connection().execute(
+            'SELECT count(*) FROM entries WHERE expires_at > ?', (self.clock(),)
+        ).fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'sqlite',
+                'size': size,
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'stale_served': self.stale_served,
+                'lookup_latency': self.latency.summary()
+            }
+
+
+class _BackgroundRefresher:
+    """Refreshes stale customers from Stripe off the request path, at most once at a time per customer."""
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='entitlement-refresh')
+        self.scheduled = 0
+        self.refreshed = 0
+        self.failed = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, customer_id):
+        with self._lock:
+            if customer_id in self._pending:
+                return None
+            self._pending.add(customer_id)
+            self.scheduled += 1
+        return self.executor.submit(self._refresh, customer_id)
+
+    def _refresh(self, customer_id):
+        with self.app.app_context():
+            try:
+                refresh_entitlements(customer_id)
+            except stripe.error.StripeError as e:
+                current_app.logger.warning(f"Background entitlement refresh failed for {customer_id}: {e}")
+                with self._lock:
+                    self.failed += 1
+            else:
+                entitlement_cache.invalidate(customer_id)
+                with self._lock:
+                    self.refreshed += 1
+            finally:
+                with self._lock:
+                    self._pending.discard(customer_id)
+                db.session.remove()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'scheduled': self.scheduled,
+                'refreshed': self.refreshed,
+                'failed': self.failed,
+                'pending': len(self._pending)
+            }
+
+
+class EntitlementCache:
+    """Flask extension answering which features a Stripe customer currently has."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ENTITLEMENT_CACHE_TTL', 60)
+        app.config.setdefault('ENTITLEMENT_CACHE_SIZE', 10000)
+        app.config.setdefault('ENTITLEMENT_CACHE_BACKEND', 'memory')
+        app.config.setdefault('ENTITLEMENT_CACHE_PATH', None)
+        app.config.setdefault('ENTITLEMENT_REFRESH_WORKERS', 2)
+        backend = app.config['ENTITLEMENT_CACHE_BACKEND']
+        if backend == 'memory':
+            cache = _EntitlementCache(app.config['ENTITLEMENT_CACHE_SIZE'], app.config['ENTITLEMENT_CACHE_TTL'])
+        elif backend == 'sqlite':
+            path = app.config['ENTITLEMENT_CACHE_PATH'] or os.path.join(app.instance_path, 'entitlement_cache.db')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            ttl = app.config['ENTITLEMENT_CACHE_TTL']
+            cache = _SharedEntitlementCache(
+                path, app.config['ENTITLEMENT_CACHE_SIZE'], ttl,
+                # Session snapshots compare versions for as long as they are trusted, see app/payments/billing.py
+                version_ttl=max(ttl, app.config.get('BILLING_SNAPSHOT_TTL') or 0)
+            )
+        else:
+            raise ValueError(f"Unknown ENTITLEMENT_CACHE_BACKEND {backend!r}, expected 'memory' or 'sqlite'")
+        app.extensions['entitlement_cache'] = cache
+        # With no workers lookups refresh nothing, and stale customers wait for the summary webhook
+        # or `flask stripe sync-entitlements`
+        workers = app.config['ENTITLEMENT_REFRESH_WORKERS']
+        app.extensions['entitlement_refresher'] = _BackgroundRefresher(app, workers) if workers else None
+
+    @property
+    def cache(self):
+        return current_app.extensions['entitlement_cache']
+
+    def mask(self, stripe_customer_id):
+        """
+        The customer's active entitlements as a mask, see app/payments/features.py.
+
+        Answered from the cache or the customer's stored mask, 0 for an unknown
+        customer. A customer out of sync with Stripe is refreshed in the background.
+        """
+        cache = self.cache
+        started = time.perf_counter()
+        try:
+            mask, version = cache.get(stripe_customer_id)
+            if mask is None:
+                mask = self._load(stripe_customer_id)
+                cache.put(stripe_customer_id, mask, version)
+            return mask
+        finally:
+            cache.observe((time.perf_counter() - started) * 1000)
+
+    def _load(self, stripe_customer_id):
+        mask, in_sync = load_entitlements(stripe_customer_id)
+        if not in_sync:
+            # Serve the stored entitlements; the refresh or the entitlement summary webhook resyncs them
+            self.cache.served_stale()
+            refresher = current_app.extensions['entitlement_refresher']
+            if refresher is not None:
+                refresher.submit(stripe_customer_id)
+        return mask
+
+    def lookup_keys(self, stripe_customer_id):
+        """The lookup keys of the customer's active entitlements."""
+        return feature_registry.lookup_keys(self.mask(stripe_customer_id))
+
+    def has_feature(self, stripe_customer_id, *feature_lookup_keys):
+        """True if the customer has every one of the given features."""
+        return feature_registry.has(self.mask(stripe_customer_id), *feature_lookup_keys)
+
+    def invalidate(self, stripe_customer_id):
+        """Drop the customer's cached entitlements. Called when a webhook says they may have changed."""
+        if stripe_customer_id:
+            self.cache.invalidate(stripe_customer_id)
+
+    def invalidate_on_commit(self, stripe_customer_id):
+        """
+        Drop the customer's cached entitlements once the current transaction commits, or now outside one.
+
+        Webhook handlers use this rather than invalidate. A request that reads the
+        customer before the commit would otherwise cache, or snapshot, the old rows
+        at the new version. Nothing is invalidated if the transaction rolls back.
+        """
+        if not stripe_customer_id:
+            return
+        session = db.session()
+        if not session.in_transaction():
+            self.invalidate(stripe_customer_id)
+            return
+        session.info.setdefault(_PENDING_INVALIDATIONS, set()).add(stripe_customer_id)
+
+    def version(self, stripe_customer_id):
+        """A counter bumped by every invalidation of the customer, to tell whether a copy kept elsewhere is current."""
+        return self.cache.version(stripe_customer_id)
+
+    def stats(self):
+        stats = self.cache.stats()
+        refresher = current_app.extensions['entitlement_refresher']
+        if refresher is not None:
+            stats['background_refreshes'] = refresher.stats()
+        return stats
+
+
+entitlement_cache = EntitlementCache()
+
+# Session.info key of the customers to invalidate when the session's transaction commits
+_PENDING_INVALIDATIONS = 'pending_entitlement_invalidations'
+
+
+@sa.event.listens_for(so.Session, 'after_commit')
+def _invalidate_committed(session):
+    for stripe_customer_id in session.info.pop(_PENDING_INVALIDATIONS, ()):
+        entitlement_cache.invalidate(stripe_customer_id)
+
+
+@sa.event.listens_for(so.Session, 'after_rollback')
+def _discard_invalidations(session):
+    session.info.pop(_PENDING_INVALIDATIONS, None)
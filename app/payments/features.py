@@ -0,0 +1,143 @@
+"""
+Registry of feature lookup keys, each interned to one bit of an entitlement mask.
+
+A customer's active entitlements are stored as a single integer in
+Customer.entitlement_mask, so checking one feature or a whole set of them is
+one bitwise AND, and a customer's entitlements take a few bytes in memory or
+in a session cookie instead of a set of strings.
+
+Bits are handed out the first time a lookup key is stored and never reused.
+The mask is a signed BIGINT, which caps the registry at 63 features. Each
+process keeps a read-only copy of the registry and swaps in a fresh one only
+when it meets a mask with bits it does not know, so checks never query the
+features table in the steady state and never see a half-loaded copy.
+"""
+from types import MappingProxyType
+
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.models import Feature
+
+# Bits of a signed 64-bit integer that can be set without making it negative
+MAX_FEATURES = 63
+
+
+class FeatureRegistryFull(Exception):
+    """Raised when a new lookup key needs a bit but all MAX_FEATURES are taken."""
+
+
+class _Registry:
+    """One process's copy of the features table. Never changed once built, reloading swaps in a new one."""
+
+    __slots__ = ('bits', 'keys', 'known', 'reloads')
+
+    def __init__(self, rows=(), reloads=0):
+        bits = dict(rows)
+        object.__setattr__(self, 'bits', MappingProxyType(bits))
+        object.__setattr__(self, 'keys', MappingProxyType({bit: lookup_key for lookup_key, bit in bits.items()}))
+        object.__setattr__(self, 'known', sum(1 << bit for bit in bits.values()))
+        object.__setattr__(self, 'reloads', reloads)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+class FeatureRegistry:
+    """Flask extension mapping feature lookup keys to entitlement mask bits."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['feature_registry'] = _Registry()
+
+    @property
+    def registry(self):
+        return current_app.extensions['feature_registry']
+
+    def reload(self):
+        """Read the committed features table and swap it in as this process's copy."""
+        rows = db.session.execute(sa.select(Feature.lookup_key, Feature.bit)).all()
+        registry = _Registry(rows, self.registry.reloads + 1)
+        current_app.extensions['feature_registry'] = registry
+        return registry
+
+    def _registry_for(self, mask):
+        """The registry, reloaded first if the mask has bits registered since it was loaded."""
+        registry = self.registry
+        if mask & ~registry.known:
+            registry = self.reload()
+        return registry
+
+    def has(self, mask, *lookup_keys):
+        """True if the mask includes every one of the given features."""
+        registry = self._registry_for(mask)
+        required = 0
+        for lookup_key in lookup_keys:
+            bit = registry.bits.get(lookup_key)
+            if bit is None:
+                # Not registered, so nobody has it
+                return False
+            required |= 1 << bit
+        return mask & required == required
+
+    def lookup_keys(self, mask):
+        """The lookup keys of the features in a mask. Bits missing from the features table are skipped."""
+        registry = self._registry_for(mask)
+        if mask & ~registry.known:
+            current_app.logger.warning(f"Entitlement mask {mask:#x} has bits with no registered feature")
+        lookup_keys = []
+        mask &= registry.known
+        while mask:
+            lowest = mask & -mask
+            lookup_keys.append(registry.keys[lowest.bit_length() - 1])
+            mask ^= lowest
+        return frozenset(lookup_keys)
+
+    def mask_for(self, lookup_keys):
+        """
+        The mask for a set of lookup keys, registering new ones in the current transaction. Does not commit.
+
+        The process's copy of the registry is left alone, as the new bits only
+        exist once the caller commits. It picks them up on its next reload.
+
+        Raises:
+            FeatureRegistryFull: If a new lookup key needs a bit and none are left
+        """
+        registry = self.registry
+        bits = {lookup_key: registry.bits.get(lookup_key) for lookup_key in lookup_keys}
+        missing = [lookup_key for lookup_key, bit in bits.items() if bit is None]
+        if missing:
+            bits.update(db.session.execute(
+                sa.select(Feature.lookup_key, Feature.bit).where(Feature.lookup_key.in_(missing))
+            ).all())
+            for lookup_key in missing:
+                if bits[lookup_key] is None:
+                    bits[lookup_key] = self._allocate(lookup_key)
+        return sum(1 << bit for bit in set(bits.values()))
+
+    def _allocate(self, lookup_key, attempts=5):
+        """Give a lookup key the next free bit, retrying if a concurrent transaction takes it first."""
+        for _ in range(attempts):
+            try:
+                with db.session.begin_nested():
+                    bit = db.session.scalar(sa.select(sa.func.coalesce(sa.func.max(Feature.bit), -1) + 1))
+                    if bit >= MAX_FEATURES:
+                        raise FeatureRegistryFull(f"No entitlement mask bit left for feature {lookup_key}")
+                    db.session.add(Feature(lookup_key=lookup_key, bit=bit))
+                return bit
+            except sa.exc.IntegrityError:
+                # Either the bit or the lookup key was registered by someone else since we looked
+                bit = db.session.scalar(sa.select(Feature.bit).where(Feature.lookup_key == lookup_key))
+                if bit is not None:
+                    return bit
+        raise RuntimeError(f"Could not register feature {lookup_key}")
+
+    def stats(self):
+        registry = self.registry
+        return {'features': len(registry.bits), 'max_features': MAX_FEATURES, 'reloads': registry.reloads}
+
+
+feature_registry = FeatureRegistry()
@@ -0,0 +1,66 @@
+"""
+Hydrate the Stripe objects a webhook handler needs with as few API calls as possible.
+
+Event payloads only carry IDs for related objects unless they were expanded.
+The helpers here use whatever the payload already contains and fetch the
+rest in a single expanded request, instead of one retrieve per object.
+Requests go through the circuit breaker in app/payments/stripe_client.py.
+"""
+from app.payments.stripe_client import stripe_client
+
+
+def stripe_id(ref):
+    """Return the ID of a Stripe reference that is either an ID string or an (expanded) object."""
+    if isinstance(ref, dict):
+        return ref.get('id')
+    return ref
+
+
+def event_customer_id(event):
+    """Return the Stripe customer ID an event belongs to, or None for events not tied to a customer."""
+    data_object = event['data']['object']
+    if data_object.get('object') == 'customer':
+        return data_object.get('id')
+    return stripe_id(data_object.get('customer'))
+
+
+def _expanded(ref):
+    return ref if isinstance(ref, dict) else None
+
+
+def hydrate_checkout_session(session):
+    """
+    Resolve the customer and subscription for a completed checkout session.
+
+    - Objects that are already expanded in the payload are used as they are.
+    - Otherwise the subscription is retrieved with its customer expanded, so a
+      subscription checkout costs one round trip instead of two.
+    - The customer is only retrieved on its own when there is no subscription
+      to expand it from.
+
+    Args:
+        session (dict): The Stripe checkout session object from the event
+
+    Returns:
+        tuple: (customer, subscription) as dicts; subscription is None when the
+        checkout did not create one
+    """
+    customer = _expanded(session.get('customer'))
+    subscription = _expanded(session.get('subscription'))
+    if subscription is not None and 'items' not in subscription:
+        subscription = None
+
+    subscription_id = stripe_id(session.get('subscription'))
+    if subscription_id and subscription is None:
+        if customer is None:
+            subscription = stripe_client.retrieve_subscription(subscription_id, expand=['customer'])
+        else:
+            subscription = stripe_client.retrieve_subscription(subscription_id)
+
+    if customer is None and subscription is not None:
+        customer = _expanded(subscription.get('customer'))
+
+    if customer is None:
+        customer = stripe_client.retrieve_customer(stripe_id(session.get('customer')))
+
+    return customer, subscription
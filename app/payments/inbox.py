@@ -0,0 +1,357 @@
+"""
+Durable inbox for Stripe webhook events.
+
+The webhook endpoint only verifies the signature and stores the raw event here,
+so Stripe gets its 200 straight away. A pool of in-process worker threads then
+drains the inbox, recording per-event status, attempt count and the last error.
+
+Events are sharded by customer: each worker owns the customers that hash to
+it, so one customer's events never run concurrently, and each worker takes
+its events in order of when Stripe created them. Events are held for
+WEBHOOK_REORDER_DELAY seconds first so that near-simultaneous deliveries are
+put back in order. Events that still arrive too late are handled by the
+handlers themselves, see webhook_helpers.py.
+
+Each handled event also moves the catch-up cursor forward, so `flask stripe
+catch-up` only has to replay from the last event the workers handled, see
+advance_cursor.
+"""
+import itertools
+import json
+import queue
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.models import SyncCursor, WebhookEvent
+from app.payments.dispatcher import EventNotReady, dispatcher
+from app.payments.ledger import event_ledger
+from app.payments.persistence import unit_of_work, upsert
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+PROCESSED = 'processed'
+FAILED = 'failed'
+
+# The sync_cursors row recording how far Stripe's events have been handled, see app/payments/catchup.py
+CURSOR_NAME = 'stripe_events'
+
+
+def record_event(event_id, event_type, payload, customer_id=None, created=None):
+    """
+    Store a raw Stripe event in the inbox.
+
+    The row is written with ``INSERT ... ON CONFLICT DO NOTHING``, so a
+    redelivery of an event already in the inbox costs one statement rather
+    than a failed INSERT and a rollback.
+
+    Args:
+        event_id (str): The Stripe event ID (``evt_...``)
+        event_type (str): The Stripe event type, e.g. ``checkout.session.completed``
+        payload (str): The raw request body as received from Stripe
+        customer_id (str): The Stripe customer the event belongs to, if any
+        created (int): When Stripe created the event, as a Unix timestamp
+
+    Returns:
+        WebhookEvent or None: The stored row, or None if the event was already in the inbox
+    """
+    now = datetime.now(timezone.utc)
+    # The column defaults are not applied to the upsert's text statement, so they are given here
+    webhook_event = upsert(
+        WebhookEvent,
+        {
+            'stripe_event_id': event_id,
+            'event_type': event_type,
+            'payload': payload,
+            'stripe_customer_id': customer_id,
+            'event_created': created,
+            'status': PENDING,
+            'attempts': 0,
+            'received_at': now,
+            'next_attempt_at': now
+        },
+        index_elements=['stripe_event_id']
+    )
+    # None if Stripe redelivered an event we already hold
+    db.session.commit()
+    return webhook_event
+
+
+def _claim(webhook_event_id, now):
+    """Atomically move a due event to processing. Safe across threads and processes."""
+    lease = timedelta(seconds=current_app.config['WEBHOOK_LEASE_SECONDS'])
+    result = db.session.execute(
+        sa.update(WebhookEvent)
+        .where(
+            WebhookEvent.id == webhook_event_id,
+            WebhookEvent.status.in_([PENDING, PROCESSING]),
+            WebhookEvent.next_attempt_at <= now
+        )
+        .values(
+            status=PROCESSING,
+            attempts=WebhookEvent.attempts + 1,
+            next_attempt_at=now + lease
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def process_event(webhook_event_id):
+    """
+    Claim a single inbox event and run its handler.
+
+    Claiming the event is its own short transaction. The handler's changes,
+    the ledger entry and the inbox status are then committed together as one
+    unit of work. Failed events go back to pending with an exponential backoff
+    until WEBHOOK_MAX_ATTEMPTS is reached, after which they are marked failed.
+
+    Returns:
+        bool: True if the event was claimed and handled successfully
+    """
+    now = datetime.now(timezone.utc)
+    if not _claim(webhook_event_id, now):
+        return False
+
+    webhook_event = db.session.get(WebhookEvent, webhook_event_id)
+    stripe_event_id = webhook_event.stripe_event_id
+    try:
+        with unit_of_work():
+            # Events already in the ledger are acknowledged without running the handler again
+            if not event_ledger.is_processed(stripe_event_id):
+                webhook_event.duration_ms = dispatcher.dispatch(json.loads(webhook_event.payload))
+                event_ledger.record(stripe_event_id, webhook_event.event_type)
+            webhook_event.status = PROCESSED
+            webhook_event.last_error = None
+            webhook_event.processed_at = datetime.now(timezone.utc)
+            advance_cursor(stripe_event_id, webhook_event.event_created)
+    except Exception as exc:
+        if isinstance(exc, EventNotReady):
+            current_app.logger.info(f"Webhook event {stripe_event_id} is not ready yet: {exc}")
+        else:
+            current_app.logger.exception(f"Webhook event {stripe_event_id} failed")
+        webhook_event = db.session.get(WebhookEvent, webhook_event_id)
+        webhook_event.last_error = f"{type(exc).__name__}: {exc}"
+        if webhook_event.attempts >= current_app.config['WEBHOOK_MAX_ATTEMPTS']:
+            webhook_event.status = FAILED
+        else:
+            backoff = current_app.config['WEBHOOK_RETRY_BACKOFF'] * 2 ** (webhook_event.attempts - 1)
+            webhook_event.status = PENDING
+            webhook_event.next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=backoff)
+        db.session.commit()
+        return False
+
+    event_ledger.remember(stripe_event_id)
+    return True
+
+
+def advance_cursor(stripe_event_id, created):
+    """
+    Move the catch-up cursor forward to an event that was just handled, in one UPDATE. Does not commit.
+
+    The cursor is only moved if it is at most WEBHOOK_CURSOR_MAX_GAP seconds
+    older than the event. A longer silence may be an outage whose events were
+    never delivered, so the cursor stays before it for catch-up to replay.
+    Catch-up moves it up to date again, and live events carry it on from there.
+    There is no cursor to move before the first catch-up.
+    """
+    if created is None:
+        return
+    db.session.execute(
+        sa.update(SyncCursor)
+        .where(
+            SyncCursor.name == CURSOR_NAME,
+            SyncCursor.event_created < created,
+            SyncCursor.event_created >= created - current_app.config['WEBHOOK_CURSOR_MAX_GAP']
+        )
+        .values(stripe_event_id=stripe_event_id, event_created=created)
+    )
+
+
+def due_events(limit=100):
+    """(id, customer, created) of inbox events that are waiting for a worker, oldest first."""
+    return db.session.execute(
+        sa.select(WebhookEvent.id, WebhookEvent.stripe_customer_id, WebhookEvent.event_created)
+        .where(
+            WebhookEvent.status.in_([PENDING, PROCESSING]),
+            WebhookEvent.next_attempt_at <= datetime.now(timezone.utc)
+        )
+        .order_by(WebhookEvent.id)
+        .limit(limit)
+    ).all()
+
+
+def shard_for(customer_id, shards):
+    """The shard a customer's events run on. Stable across processes and restarts."""
+    if not customer_id:
+        return 0
+    return zlib.crc32(customer_id.encode('utf-8')) % shards
+
+
+class WorkerPool:
+    """
+    A fixed set of daemon threads draining the inbox for one Flask app.
+
+    Each thread has its own priority queue ordered by event creation time and
+    owns the customers that hash to it. One more thread sweeps the inbox every
+    poll interval for retries and orphaned events, however busy the workers are.
+    An event is only queued once until a worker has finished with it, so the
+    sweep does not pile up copies of events still waiting in a queue.
+    """
+
+    def __init__(self, app, workers, poll_interval, reorder_delay=0):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.reorder_delay = reorder_delay
+        self._queues = [queue.PriorityQueue() for _ in range(workers)]
+        # Breaks ties between events created in the same second, in arrival order
+        self._sequence = itertools.count()
+        # IDs of the events in a queue or being processed
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, args=(i,), name=f'webhook-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            sweeper = threading.Thread(target=self._sweep_periodically, name='webhook-sweeper', daemon=True)
+            sweeper.start()
+            self._threads.append(sweeper)
+
+    def stop(self, timeout=None):
+        with self._lock:
+            self._stopping.set()
+            for shard in self._queues[:len(self._threads)]:
+                shard.put((float('-inf'), next(self._sequence), 0, None))
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
+
+    def submit(self, webhook_event_id, customer_id=None, created=None):
+        self.start()
+        self._put(webhook_event_id, customer_id, created, time.monotonic() + self.reorder_delay)
+
+    def _put(self, webhook_event_id, customer_id, created, ready_at):
+        with self._queued_lock:
+            if webhook_event_id in self._queued:
+                return
+            self._queued.add(webhook_event_id)
+        shard = self._queues[shard_for(customer_id, self.workers)]
+        shard.put((created or 0, next(self._sequence), ready_at, webhook_event_id))
+
+    def _done(self, webhook_event_id):
+        with self._queued_lock:
+            self._queued.discard(webhook_event_id)
+
+    def join(self):
+        """Block until every submitted event has been picked up and finished."""
+        for shard in self._queues:
+            shard.join()
+
+    def _run(self, shard_index):
+        shard = self._queues[shard_index]
+        while not self._stopping.is_set():
+            try:
+                item = shard.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            created, sequence, ready_at, webhook_event_id = item
+            try:
+                if webhook_event_id is None:
+                    continue
+                wait = ready_at - time.monotonic()
+                if wait > 0:
+                    # Hold the event so an older one for the same shard delivered
+                    # just after it can overtake it, then take the oldest again
+                    shard.put(item)
+                    self._stopping.wait(min(wait, self.poll_interval))
+                    continue
+                try:
+                    with self.app.app_context():
+                        process_event(webhook_event_id)
+                finally:
+                    # A retry is due only after its backoff, when the sweep queues it again
+                    self._done(webhook_event_id)
+            except Exception:
+                self.app.logger.exception('Webhook worker crashed while processing an event')
+            finally:
+                shard.task_done()
+
+    def _sweep_periodically(self):
+        while not self._stopping.wait(self.poll_interval):
+            self._sweep()
+
+    def _sweep(self):
+        """Pick up retries and events left behind by a restart or a crashed worker."""
+        try:
+            with self.app.app_context():
+                now = time.monotonic()
+                for webhook_event_id, customer_id, created in due_events():
+                    self._put(webhook_event_id, customer_id, created, now)
+        except Exception:
+            self.app.logger.exception('Webhook worker failed to sweep the inbox')
+
+
+class WebhookInbox:
+    """
+    Flask extension owning the webhook worker pool.
+
+    With WEBHOOK_WORKERS set to 0 events are processed inline in the request,
+    which keeps tests and one-off scripts deterministic.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WEBHOOK_WORKERS', 4)
+        app.config.setdefault('WEBHOOK_POLL_INTERVAL', 5)
+        app.config.setdefault('WEBHOOK_MAX_ATTEMPTS', 8)
+        app.config.setdefault('WEBHOOK_RETRY_BACKOFF', 2)
+        app.config.setdefault('WEBHOOK_LEASE_SECONDS', 300)
+        app.config.setdefault('WEBHOOK_REORDER_DELAY', 1)
+        app.config.setdefault('WEBHOOK_CURSOR_MAX_GAP', 900)
+        app.extensions['webhook_inbox'] = WorkerPool(
+            app,
+            workers=app.config['WEBHOOK_WORKERS'],
+            poll_interval=app.config['WEBHOOK_POLL_INTERVAL'],
+            reorder_delay=app.config['WEBHOOK_REORDER_DELAY']
+        )
+
+        # Start the workers with the first request rather than at import time so
+        # CLI commands such as `flask db upgrade` never spawn background threads
+        @app.before_request
+        def _start_webhook_workers():
+            pool = app.extensions['webhook_inbox']
+            if pool.workers and not pool._threads:
+                pool.start()
+
+    @property
+    def pool(self):
+        return current_app.extensions['webhook_inbox']
+
+    def submit(self, webhook_event_id, customer_id=None, created=None):
+        """Hand a stored event to its customer's worker, or process it now if the pool is disabled."""
+        pool = self.pool
+        if pool.workers:
+            pool.submit(webhook_event_id, customer_id, created)
+        else:
+            process_event(webhook_event_id)
+
+
+webhook_inbox = WebhookInbox()
@@ -0,0 +1,102 @@
+"""
+Ledger of Stripe events that have already been processed.
+
+Stripe delivers events at least once. The processed_events table, with its
+unique index on the event ID, is the source of truth; a bounded in-memory LRU
+of recently processed IDs sits in front of it so most redeliveries are
+acknowledged without touching the database.
+"""
+import threading
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.models import ProcessedEvent
+
+
+class _LedgerCache:
+    """Thread-safe bounded LRU of processed event IDs, with hit/miss counters."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, event_id):
+        with self._lock:
+            if event_id in self._ids:
+                self._ids.move_to_end(event_id)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, event_id):
+        with self._lock:
+            self._ids[event_id] = None
+            self._ids.move_to_end(event_id)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._ids),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+class EventLedger:
+    """Flask extension recording which Stripe events have been applied."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WEBHOOK_LEDGER_CACHE_SIZE', 10000)
+        app.extensions['event_ledger'] = _LedgerCache(app.config['WEBHOOK_LEDGER_CACHE_SIZE'])
+
+    @property
+    def cache(self):
+        return current_app.extensions['event_ledger']
+
+    def seen_recently(self, event_id):
+        """Check the in-memory LRU only. Used on the ack path, where we never want a DB round trip."""
+        return event_id in self.cache
+
+    def is_processed(self, event_id):
+        """Check the LRU, falling back to the unique index on processed_events."""
+        if event_id in self.cache:
+            return True
+        found = db.session.scalar(
+            sa.select(ProcessedEvent.id).where(ProcessedEvent.stripe_event_id == event_id)
+        )
+        if found is not None:
+            self.cache.add(event_id)
+            return True
+        return False
+
+    def record(self, event_id, event_type):
+        """
+        Add an event to the ledger in the current transaction.
+
+        Call remember() once the transaction has committed.
+        """
+        db.session.add(ProcessedEvent(stripe_event_id=event_id, event_type=event_type))
+
+    def remember(self, event_id):
+        self.cache.add(event_id)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+event_ledger = EventLedger()
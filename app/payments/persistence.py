@@ -0,0 +1,117 @@
+"""
+Persistence helpers for webhook handlers.
+
+Each webhook event is applied as one unit of work: the handler's writes, the
+ledger entry and the inbox status are flushed in a single transaction and
+committed once, so a failure part way through leaves nothing half applied.
+Handlers therefore never commit themselves, and write with native
+``INSERT ... ON CONFLICT`` upserts rather than a SELECT followed by an
+INSERT or UPDATE.
+"""
+from contextlib import contextmanager
+from functools import lru_cache
+
+import sqlalchemy as sa
+from app import db
+
+# Dialects with INSERT ... ON CONFLICT ... RETURNING, which share the same syntax
+UPSERT_DIALECTS = ('postgresql', 'sqlite')
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Run a block in one transaction on the current session.
+
+    Commits once when the block finishes and rolls everything back if it raises.
+    """
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+@lru_cache(maxsize=None)
+def _upsert_statement(model, dialect, columns, index_elements, update_columns, newer_column, increment_columns=()):
+    """
+    Build the upsert for one model and column set.
+
+    SQLAlchemy cannot cache compiled dialect-specific ON CONFLICT constructs,
+    so they would be recompiled on every call. The statement is written as
+    typed text instead, which is built once here and cached by SQLAlchemy
+    like any other statement.
+    """
+    table = model.__table__
+    quote = dialect.identifier_preparer.quote
+    table_name = dialect.identifier_preparer.format_table(table)
+    sql = (
+        f"INSERT INTO {table_name} "
+        f"({', '.join(quote(column) for column in columns)}) "
+        f"VALUES ({', '.join(':' + column for column in columns)}) "
+        f"ON CONFLICT ({', '.join(quote(column) for column in index_elements)}) "
+    )
+    if update_columns or increment_columns:
+        sql += 'DO UPDATE SET ' + ', '.join(
+            [f"{quote(column)} = excluded.{quote(column)}" for column in update_columns]
+            + [f"{quote(column)} = {table_name}.{quote(column)} + excluded.{quote(column)}"
+               for column in increment_columns]
+        )
+        if newer_column:
+            column = quote(newer_column)
+            sql += f" WHERE {table_name}.{column} IS NULL OR {table_name}.{column} <= excluded.{column}"
+    else:
+        sql += 'DO NOTHING'
+    sql += f" RETURNING {', '.join(quote(column.name) for column in table.columns)}"
+
+    statement = (
+        sa.text(sql)
+        .bindparams(*[sa.bindparam(column, type_=table.c[column].type) for column in columns])
+        .columns(*table.columns)
+    )
+    return sa.select(model).from_statement(statement)
+
+
+def upsert(model, values, index_elements, update_columns=(), newer_column=None, increment_columns=()):
+    """
+    Insert a row, or update it if it conflicts on the given unique columns.
+
+    The row is written with a single ``INSERT ... ON CONFLICT ... RETURNING``,
+    and any copy of the row already loaded in the session is refreshed with
+    the result.
+
+    Args:
+        model: The mapped model class
+        values (dict): Column values for the insert
+        index_elements (list): The unique columns that identify the row
+        update_columns (list): Columns to overwrite when the row already exists.
+            With none, an existing row is left untouched.
+        newer_column (str): Only update an existing row if its value in this
+            column is NULL or not newer than the one being written. Used to
+            skip events that are older than the row's current state.
+        increment_columns (list): Columns to add the written value to when the
+            row already exists, for counters that concurrent writers share.
+
+    Returns:
+        The model instance for the row, or None if it already existed and was
+        not updated
+    """
+    dialect = db.session.get_bind(mapper=model).dialect
+    if dialect.name not in UPSERT_DIALECTS:
+        raise NotImplementedError(f"upsert is not supported on {dialect.name}")
+
+    statement = _upsert_statement(
+        model,
+        dialect,
+        tuple(values),
+        tuple(index_elements),
+        tuple(update_columns),
+        newer_column,
+        tuple(increment_columns)
+    )
+    return db.session.scalars(
+        statement,
+        values,
+        execution_options={'populate_existing': True}
+    ).first()
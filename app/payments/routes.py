@@ -3,7 +3,15 @@ from flask_login import current_user, login_required
 import stripe
 import os
 import json
+from app import database
+from app.auth.decorators import admin_required
 from app.payments import bp
+from app.payments.billing import billing_context
+from app.payments.dispatcher import dispatcher
+from app.payments.entitlements import entitlement_cache
+from app.payments.features import feature_registry
+from app.payments.ledger import event_ledger
+from app.payments.stripe_client import stripe_client
 
 # Nuke any proxy config that might be injected
 # There was a bug where I was getting 403 errors from Stripe because of a proxy config in the environment
@@ -48,6 +56,8 @@ def create_checkout_session():
     
 @bp.route('/success')
 def success():
+    # The checkout webhooks write the new subscription to the primary database; read it there until replicas catch up
+    database.stick_to_primary()
     return '''
     <html>
         <head><title>Payment Successful</title></head>
@@ -78,7 +88,7 @@ def billing_portal():
     if not stripe.api_key:
         return jsonify({'error': 'Stripe API key is not configured.'}), 500
 
-    customer = current_user.customer
+    customer = billing_context().customer
     if not customer:
         return jsonify({'error': 'No Stripe customer is linked to your account.'}), 400
 
@@ -93,3 +103,14 @@ def billing_portal():
         return jsonify({'error': str(e)}), 400
 
 
+@bp.route('/metrics')
+@admin_required
+def metrics():
+    """Operational counters for the payment pipeline, for admins only."""
+    return jsonify({
+        'entitlement_cache': entitlement_cache.stats(),
+        'event_ledger': event_ledger.stats(),
+        'feature_registry': feature_registry.stats(),
+        'stripe_client': stripe_client.stats(),
+        'webhook_handlers': dispatcher.stats()
+    })
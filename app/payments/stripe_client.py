@@ -0,0 +1,238 @@
+"""
+Facade for the Stripe reads made while serving requests and handling webhooks.
+
+Every read goes through a circuit breaker. After STRIPE_BREAKER_FAILURES
+consecutive failures that look like a Stripe outage (connection errors,
+timeouts, 5xx responses and rate limiting) the breaker opens, and reads fail
+straight away with CircuitOpenError for STRIPE_BREAKER_RESET seconds. It
+then goes half-open and lets STRIPE_BREAKER_PROBES calls through: a success
+closes it again and a failure opens it for another period. Errors Stripe
+answered with, like a missing object, do not count.
+
+Reads are made with the app's own stripe.StripeClient, whose HTTP client
+times out after STRIPE_TIMEOUT seconds rather than the SDK's 80, so a slow
+Stripe holds a worker for a bounded time before it counts as a failure. The
+SDK's process-wide defaults, used by the other Stripe calls, are left alone.
+
+Reads are also coalesced: while a call is in flight, identical calls from
+other threads in the process wait for it and get the same result or error
+instead of calling Stripe themselves. Callers share the returned object and
+must not modify it.
+"""
+import threading
+import time
+from collections import Counter
+
+import stripe
+from flask import current_app
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Errors that mean Stripe could not answer, rather than answered with an error
+OUTAGE_ERRORS = (stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError)
+
+
+class CircuitOpenError(stripe.error.APIConnectionError):
+    """Raised instead of calling Stripe while the circuit breaker is open."""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time, sharing its outcome with concurrent callers."""
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._flights)}
+
+
+class CircuitBreaker:
+    """Thread-safe closed/open/half-open breaker with transition counters."""
+
+    def __init__(self, failure_threshold, reset_timeout, half_open_probes=1, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.calls = 0
+        self.short_circuited = 0
+        self.transitions = Counter()
+        self._opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        self.transitions[f'{self.state}->{state}'] += 1
+        self.state = state
+        if state == OPEN:
+            self._opened_at = self.clock()
+        elif state == HALF_OPEN:
+            self._probes = 0
+
+    def before_call(self):
+        """Reserve a call, or raise CircuitOpenError if Stripe should not be called now."""
+        with self._lock:
+            if self.state == OPEN and self.clock() >= self._opened_at + self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probes >= self.half_open_probes):
+                self.short_circuited += 1
+                raise CircuitOpenError('Stripe circuit breaker is open')
+            if self.state == HALF_OPEN:
+                self._probes += 1
+            self.calls += 1
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def release(self):
+        """Give back a half-open probe whose call ended without telling whether Stripe is up."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self._transition(OPEN)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'calls': self.calls,
+                'short_circuited': self.short_circuited,
+                'transitions': dict(self.transitions)
+            }
+
+
+class StripeClient:
+    """Flask extension making the app's Stripe reads through a circuit breaker, one in flight per call."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STRIPE_TIMEOUT', 10)
+        app.config.setdefault('STRIPE_BREAKER_FAILURES', 5)
+        app.config.setdefault('STRIPE_BREAKER_RESET', 30)
+        app.config.setdefault('STRIPE_BREAKER_PROBES', 1)
+        app.extensions['stripe_client'] = CircuitBreaker(
+            app.config['STRIPE_BREAKER_FAILURES'],
+            app.config['STRIPE_BREAKER_RESET'],
+            app.config['STRIPE_BREAKER_PROBES']
+        )
+        app.extensions['stripe_single_flight'] = SingleFlight()
+        timeout = app.config['STRIPE_TIMEOUT']
+        app.extensions['stripe_sdk_client'] = stripe.StripeClient(
+            app.config.get('STRIPE_SECRET_KEY') or '',
+            http_client=stripe.new_default_http_client(timeout=timeout) if timeout else None
+        )
+
+    @property
+    def breaker(self):
+        return current_app.extensions['stripe_client']
+
+    @property
+    def sdk(self):
+        """The app's stripe.StripeClient, with its own HTTP timeout."""
+        return current_app.extensions['stripe_sdk_client']
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call a Stripe SDK method, sharing an identical call already in flight.
+
+        Raises:
+            CircuitOpenError: If the breaker is open
+            stripe.error.StripeError: Whatever the call raised
+        """
+        # Bound SDK methods compare equal for the same service and method; reprs make params hashable
+        key = (method, repr(args), tuple(sorted((name, repr(value)) for name, value in kwargs.items())))
+        single_flight = current_app.extensions['stripe_single_flight']
+        return single_flight.do(key, lambda: self._call(method, args, kwargs))
+
+    def _call(self, method, args, kwargs):
+        breaker = self.breaker
+        breaker.before_call()
+        try:
+            result = method(*args, **kwargs)
+        except OUTAGE_ERRORS:
+            breaker.record_failure()
+            raise
+        except stripe.error.StripeError:
+            # Stripe answered, so it is up
+            breaker.record_success()
+            raise
+        except BaseException:
+            # Not a Stripe error, such as a bug or an interrupt; a half-open probe must not stay taken
+            breaker.release()
+            raise
+        breaker.record_success()
+        return result
+
+    def list_active_entitlements(self, customer_id):
+        return self.call(self.sdk.v1.entitlements.active_entitlements.list, {'customer': customer_id, 'limit': 100})
+
+    def retrieve_customer(self, customer_id, **params):
+        return self.call(self.sdk.v1.customers.retrieve, customer_id, params)
+
+    def retrieve_subscription(self, subscription_id, **params):
+        return self.call(self.sdk.v1.subscriptions.retrieve, subscription_id, params)
+
+    def list_events(self, **params):
+        return self.call(self.sdk.v1.events.list, params)
+
+    def stats(self):
+        stats = self.breaker.stats()
+        stats['single_flight'] = current_app.extensions['stripe_single_flight'].stats()
+        return stats
+
+
+stripe_client = StripeClient()
@@ -1,9 +1,214 @@
-from datetime import datetime
 import stripe
+from flask import current_app
 from app import db
-from app.models import Customer, Subscription
+from app.analytics import rollups
+from app.models import Customer, Subscription, SubscriptionPrice
+from app.payments.dispatcher import EventNotReady, current_event_created, dispatcher
+from app.payments.entitlements import (
+    entitlement_cache,
+    fetch_entitlements,
+    mark_entitlements_stale,
+    replace_entitlements,
+    utc_datetime
+)
+from app.payments.hydration import hydrate_checkout_session, stripe_id
+from app.payments.persistence import upsert
 
+# As a minumum the events to monitor are checkout.session.completed, invoice.paid, and invoice.payment_failed.
+# checkout.session.completed is sent when a customer successfully completes the Checkout session, informing of a new purchase.
+# invoice.paid is sent each billing period when a invoice payment succeeds.
+# invoice.payment_failed is sent each billing period if theres an issue with your customer's payment method.
+# Handlers register for their event types with @dispatcher.on, see app/payments/dispatcher.py.
+# Handlers do not commit: each event is applied in one transaction, see app/payments/persistence.py.
+# Stripe does not deliver events in order. Subscriptions record the created time of the newest subscription snapshot
+# (checkout or customer.subscription.*) applied to them in last_event_created, and older events that arrive late are
+# skipped rather than overwriting newer state. Invoice events only set a few columns, so they are checked against it
+# but do not move it, and an older snapshot delivered after them is still applied.
+# Any event that can change what a customer is entitled to drops their cached entitlements once it commits. The
+# entitlement summary event replaces the customer's stored entitlements, and subscription changes mark them stale
+# until it arrives, see app/payments/entitlements.py.
+# Writes that can change what a subscription bills move it in the daily revenue rollups in the same transaction,
+# see app/analytics/rollups.py. Plan changes are also added to the subscription's price history, so revenue
+# analytics bill the old plan until the change rather than the new one throughout.
 
+# The Subscription columns that make up its plan, as recorded in its price history
+PLAN_KEYS = ('product_id', 'price_id', 'amount', 'currency', 'billing_interval', 'billing_interval_count')
+
+
+def entitlements_changed(stripe_customer_id):
+    """Mark the customer's stored entitlements stale and drop the cached ones on commit after a subscription change."""
+    created = current_event_created()
+    mark_entitlements_stale(stripe_customer_id, utc_datetime(created) if created is not None else utc_datetime())
+    entitlement_cache.invalidate_on_commit(stripe_customer_id)
+
+
+def _utc_datetime_or_none(timestamp):
+    return utc_datetime(timestamp) if timestamp is not None else None
+
+
+def subscription_fields(subscription):
+    """
+    The status, billing period, trial, cancellation and end of a Stripe subscription as Subscription column values.
+
+    Newer Stripe API versions report the billing period on each subscription
+    item rather than on the subscription, so the first item's is used if the
+    subscription has none.
+    """
+    items = (subscription.get('items') or {}).get('data') or [{}]
+    period_start = subscription.get('current_period_start') or items[0].get('current_period_start')
+    period_end = subscription.get('current_period_end') or items[0].get('current_period_end')
+    return dict(
+        # Stripe spells it 'canceled'; cancellations are stored as 'cancelled'
+        status='cancelled' if subscription['status'] == 'canceled' else subscription['status'],
+        current_period_start=_utc_datetime_or_none(period_start),
+        current_period_end=_utc_datetime_or_none(period_end),
+        cancel_at_period_end=bool(subscription.get('cancel_at_period_end')),
+        trial_end=_utc_datetime_or_none(subscription.get('trial_end')),
+        ended_at=_utc_datetime_or_none(subscription.get('ended_at'))
+    )
+
+
+def price_fields(subscription):
+    """
+    The plan of a Stripe subscription as Subscription column values.
+
+    The amount is summed over the items, which Stripe requires to share a
+    billing interval. It is None if any item's price has no unit amount,
+    such as a tiered price.
+    """
+    items = subscription['items']['data']
+    price = items[0]['price']
+    amounts = [item['price'].get('unit_amount') for item in items]
+    recurring = price.get('recurring') or {}
+    return dict(
+        product_id=stripe_id(price['product']),
+        price_id=price['id'],
+        amount=None if None in amounts else sum(
+            amount * (item.get('quantity') or 1) for amount, item in zip(amounts, items)
+        ),
+        currency=price.get('currency'),
+        billing_interval=recurring.get('interval'),
+        billing_interval_count=recurring.get('interval_count') or 1
+    )
+
+
+def invoice_subscription_id(invoice):
+    """The ID of the subscription an invoice bills, or None for a one-off invoice."""
+    subscription = invoice.get('subscription')
+    if subscription is None:
+        # Newer Stripe API versions moved it under the invoice's parent
+        subscription = ((invoice.get('parent') or {}).get('subscription_details') or {}).get('subscription')
+    return stripe_id(subscription)
+
+
+def invoice_period(invoice):
+    """
+    The (start, end) Unix timestamps of the subscription period an invoice pays for, or None.
+
+    Taken from the invoice's line ending last. The invoice's own period_start
+    and period_end cover the usage billed in arrears, not the period paid for.
+    """
+    periods = [line['period'] for line in (invoice.get('lines') or {}).get('data', []) if line.get('period')]
+    if not periods:
+        return None
+    period = max(periods, key=lambda p: p['end'])
+    return period['start'], period['end']
+
+
+def record_plan_change(subscription_id, before, values):
+    """
+    Add a change of plan to a subscription's price history, if the values written change its plan.
+
+    The plan it billed before is recorded from its creation first, unless an
+    earlier change already was, so the history covers its whole life. The new
+    plan takes effect when the current event was created. Rows stored before
+    prices were recorded had no known plan to change from, and record nothing.
+
+    Args:
+        subscription_id (str): The Stripe subscription ID
+        before: The subscription's rollups.billing_state before the write
+        values (dict): The column values written
+    """
+    # The last row of the billing state has the plan the subscription bills now
+    current = before[-1] if before else None
+    if current is None or current.currency is None or all(
+            values.get(key, getattr(current, key)) == getattr(current, key) for key in PLAN_KEYS):
+        return
+    created = current_event_created()
+    index_elements = ['stripe_subscription_id', 'effective_at']
+    upsert(
+        SubscriptionPrice,
+        dict(stripe_subscription_id=subscription_id, effective_at=current.created_at,
+             **{key: getattr(current, key) for key in PLAN_KEYS}),
+        index_elements=index_elements
+    )
+    upsert(
+        SubscriptionPrice,
+        dict(stripe_subscription_id=subscription_id,
+             effective_at=utc_datetime(created) if created is not None else utc_datetime(),
+             **{key: values.get(key, getattr(current, key)) for key in PLAN_KEYS}),
+        index_elements=index_elements,
+        update_columns=PLAN_KEYS
+    )
+
+
+def update_subscription(subscription_id, values, required=False, snapshot=False):
+    """
+    Update a subscription with a single UPDATE, unless a newer snapshot has already been applied.
+
+    If the values can change what the subscription bills, it is read before and
+    after the UPDATE and moved in the daily revenue rollups to match, and a
+    change of plan is added to its price history.
+
+    Args:
+        subscription_id (str): The Stripe subscription ID
+        values (dict): Column values to set
+        required (bool): Raise EventNotReady if the subscription is not in the database yet,
+            so the event is retried once the checkout that creates it has been applied.
+            Otherwise unknown subscriptions are ignored.
+        snapshot (bool): The values come from the whole subscription, as in customer.subscription.*
+            events, so later events are ordered after this one
+
+    Returns:
+        bool: True if the subscription was updated
+    """
+    created = current_event_created()
+    statement = db.update(Subscription).where(Subscription.stripe_subscription_id == subscription_id)
+    values = dict(values)
+    if created is not None:
+        statement = statement.where(db.or_(
+            Subscription.last_event_created.is_(None),
+            Subscription.last_event_created <= created
+        ))
+        if snapshot:
+            values['last_event_created'] = created
+
+    billed = not rollups.BILLING_KEYS.isdisjoint(values)
+    before = rollups.billing_state(subscription_id) if billed else None
+    if db.session.execute(statement.values(**values)).rowcount:
+        if billed:
+            record_plan_change(subscription_id, before, values)
+            rollups.record_change(before, rollups.billing_state(subscription_id))
+        return True
+
+    # Nothing matched: either the subscription is unknown or a newer event got there first
+    exists = db.session.scalar(
+        db.select(Subscription.id).where(Subscription.stripe_subscription_id == subscription_id)
+    )
+    if exists is None:
+        if required:
+            raise EventNotReady(f"Subscription {subscription_id} does not exist yet")
+    else:
+        current_app.logger.info(f"Skipping stale event for subscription {subscription_id}")
+    return False
+
+
+def set_subscription_status(subscription_id, status, required=False):
+    """Set a subscription's status, see update_subscription."""
+    return update_subscription(subscription_id, {'status': status}, required)
+
+
+@dispatcher.on('checkout.session.completed')
 def handle_checkout_session(session):
     """
     Handle a Stripe checkout session completion event.
@@ -15,55 +220,72 @@ def handle_checkout_session(session):
     Returns:
         None
     Side Effects:
-        - Creates or updates Customer record in database
-        - Creates Subscription record in database if subscription exists
-        - Commits changes to database session
+        - Upserts the Customer record in database
+        - Upserts the Subscription record in database if subscription exists,
+          and adds it to the daily revenue rollups
+        - Does not commit; the webhook inbox commits once per event
     Note:
-        Requires active database session and Stripe API access
+        Requires active database session. Stripe is only called for data missing
+        from the event payload, see hydrate_checkout_session.
     """
     
     # 1. Deal with customer creation from the event
-    stripe_customer_id = session.get('customer')
+    stripe_customer_id = stripe_id(session.get('customer'))
     user_id = session.get('client_reference_id')
 
-    # Retrieve the customer data from Stripe
-    stripe_customer = stripe.Customer.retrieve(stripe_customer_id)
+    # Resolve the customer and subscription, using the payload where possible
+    stripe_customer, stripe_subscription = hydrate_checkout_session(session)
     customer_name = stripe_customer.get('name')
     created_at = stripe_customer.get('created')
 
     # Create or update the Customer record in your database
-    customer = db.session.scalar(db.select(Customer).where(Customer.stripe_customer_id == stripe_customer_id))
-    if not customer:
-        customer = Customer(
+    upsert(
+        Customer,
+        dict(
             user_id=user_id,
             stripe_customer_id=stripe_customer_id,
-            created_at=datetime.fromtimestamp(created_at),
+            created_at=utc_datetime(created_at),
             customer_name=customer_name
-        )
-        db.session.add(customer)
-        db.session.commit()
-    else:
-        customer.customer_name = customer_name
-        db.session.commit()
+        ),
+        index_elements=['stripe_customer_id'],
+        update_columns=['customer_name']
+    )
     
     # 2. Deal with subscription creation from the event
-    subscription_id = session.get('subscription')
-    if subscription_id:
-        stripe_subscription = stripe.Subscription.retrieve(subscription_id)
-        product_id = stripe_subscription['items']['data'][0]['price']['product']
-        price_id = stripe_subscription['items']['data'][0]['price']['id']
-        subscription = Subscription(
+    if stripe_subscription:
+        subscription_id = stripe_subscription['id']
+        fields = {**subscription_fields(stripe_subscription), **price_fields(stripe_subscription)}
+        values = dict(
             stripe_customer_id=stripe_customer_id,
             stripe_subscription_id=subscription_id,
-            status=stripe_subscription['status'],
-            product_id=product_id,
-            price_id=price_id,
-            created_at=datetime.fromtimestamp(stripe_subscription['created'])
+            created_at=utc_datetime(stripe_subscription['created']),
+            last_event_created=current_event_created(),
+            **fields
         )
-        db.session.add(subscription)
-        db.session.commit()
+        # A new subscription, the usual case, is inserted without reading anything first
+        created = upsert(Subscription, values, index_elements=['stripe_subscription_id'])
+        if created is not None:
+            rollups.record_change(None, [created])
+        else:
+            # Upserting makes a replayed checkout a no-op rather than a unique constraint failure,
+            # and a checkout delivered after a newer event for the subscription leaves it alone
+            before = rollups.billing_state(subscription_id)
+            updated = upsert(
+                Subscription,
+                values,
+                index_elements=['stripe_subscription_id'],
+                update_columns=['last_event_created', *fields],
+                newer_column='last_event_created'
+            )
+            if updated is None:
+                current_app.logger.info(f"Skipping stale checkout for subscription {subscription_id}")
+            else:
+                rollups.record_change(before, rollups.billing_state(subscription_id))
+
+    entitlements_changed(stripe_customer_id)
 
     
+@dispatcher.on('customer.subscription.deleted') # Case where user cancels subscrition via portal
 def handle_subscription_cancelled(session):
     """
     Handle the cancellation of a subscription.
@@ -79,38 +301,167 @@ def handle_subscription_cancelled(session):
         None
         
     Side Effects:
-        - Updates the subscription status in the database to 'cancelled'
-        - Commits the changes to the database session
+        - Updates the subscription status in the database to 'cancelled', and records when it ended
+        - Marks the customer's stored entitlements stale
+        - Does not commit; the webhook inbox commits once per event
+
+    Raises:
+        EventNotReady: If the cancellation arrived before the checkout that
+        created the subscription. The inbox retries it.
     """
     subscription_id = session.get('id')
-    subscription = db.session.scalar(db.select(Subscription).where(Subscription.stripe_subscription_id == subscription_id))
-    if subscription:
-        subscription.status = 'cancelled'
-        db.session.commit()
-    
+    ended_at = session.get('ended_at') or session.get('canceled_at') or current_event_created()
+    update_subscription(
+        subscription_id, {'status': 'cancelled', 'ended_at': utc_datetime(ended_at)}, required=True, snapshot=True
+    )
+    entitlements_changed(stripe_id(session.get('customer')))
+
+
+
+@dispatcher.on('customer.subscription.updated')
+def handle_subscription_updated(subscription):
+    """
+    Handle a change to a subscription, such as a renewal, plan change, trial ending or scheduled cancellation.
+
+    Args:
+        subscription (dict): The Stripe subscription object
 
+    Side Effects:
+        - Updates the subscription's status, price and amount, billing period, trial end
+          and cancel_at_period_end, unless a newer snapshot has already been applied
+        - Adds a change of plan to the subscription's price history
+        - Marks the customer's stored entitlements stale, as the plan or status may have changed
+        - Does not commit; the webhook inbox commits once per event
 
-def handle_invoice_payment_failed(session):
+    Raises:
+        EventNotReady: If the update arrived before the checkout that created
+        the subscription. The inbox retries it.
+    """
+    values = subscription_fields(subscription)
+    if (subscription.get('items') or {}).get('data'):
+        values.update(price_fields(subscription))
+    if update_subscription(subscription['id'], values, required=True, snapshot=True):
+        entitlements_changed(stripe_id(subscription.get('customer')))
+
+
+@dispatcher.on('customer.subscription.trial_will_end')
+def handle_trial_will_end(subscription):
+    """
+    Handle Stripe's notice, three days ahead, that a subscription's trial is ending.
+
+    Records the trial end and period in case they changed, for example when the
+    trial was extended. Entitlements do not change until the trial actually ends,
+    which Stripe reports with customer.subscription.updated.
+
+    Args:
+        subscription (dict): The Stripe subscription object
+    """
+    if update_subscription(subscription['id'], subscription_fields(subscription), required=True, snapshot=True):
+        entitlement_cache.invalidate_on_commit(stripe_id(subscription.get('customer')))
+
+
+@dispatcher.on('invoice.paid')
+def handle_invoice_paid(invoice):
+    """
+    Handle a paid invoice event from Stripe.
+
+    Continue to provision the subscription as payments continue to be made:
+    the subscription's current period is moved on to the one the invoice paid
+    for, and a subscription that was past due or unpaid becomes active again.
+    Access is then decided from the database, see has_active_access.
+
+    Args:
+        invoice (dict): The Stripe invoice object
+
+    Side Effects:
+        - Updates the subscription in a single UPDATE, unless a newer subscription snapshot has already been applied
+        - Drops the customer's cached entitlements when the event commits
+        - Does not commit; the webhook inbox commits once per event
+
+    Raises:
+        EventNotReady: If the invoice was paid before the checkout that created
+        the subscription was applied. The inbox retries it.
+    """
+    subscription_id = invoice_subscription_id(invoice)
+    if subscription_id is None:
+        return
+
+    # A trial's zero amount invoice is paid too, and must not make a trialing subscription active
+    values = {'status': db.case(
+        (Subscription.status.in_(('past_due', 'unpaid')), 'active'),
+        else_=Subscription.status
+    )}
+    period = invoice_period(invoice)
+    if period is not None:
+        values.update(current_period_start=utc_datetime(period[0]), current_period_end=utc_datetime(period[1]))
+    if update_subscription(subscription_id, values, required=True):
+        entitlement_cache.invalidate_on_commit(stripe_id(invoice.get('customer')))
+
+
+@dispatcher.on('invoice.payment_failed')
+def handle_invoice_payment_failed(invoice):
     """
     Handle a failed invoice payment event from Stripe.
     
-    This function processes an invoice payment failure by:
-    1. Retrieving the associated subscription and customer from the database
-    2. Updating the subscription status to 'past_due'
+    This function processes an invoice payment failure by updating the
+    subscription the invoice bills to 'past_due' in a single UPDATE statement,
+    which ends its access, see has_active_access.
     
     Args:
-        session (dict): The Stripe invoice object containing subscription and customer data
+        invoice (dict): The Stripe invoice object, with the subscription it bills
+            and the customer
     
     Returns:
         None
         
     Note:
-        Requires active database session and Stripe API access
+        Requires active database session. Does not commit; the webhook inbox
+        commits once per event. One-off invoices and unknown subscriptions are ignored.
     """
-    subscription_id = session.get('id')
-    subscription = db.session.scalar(db.select(Subscription).where(Subscription.stripe_subscription_id == subscription_id))
-    
-    if subscription:
-        # Update subscription status to 'past_due'
-        subscription.status = 'past_due'
-        db.session.commit()
\ No newline at end of file
+    subscription_id = invoice_subscription_id(invoice)
+    if subscription_id is None:
+        return
+    if set_subscription_status(subscription_id, 'past_due'):
+        entitlement_cache.invalidate_on_commit(stripe_id(invoice.get('customer')))
+
+
+@dispatcher.on('entitlements.active_entitlement_summary.updated')
+def handle_entitlement_summary_updated(summary):
+    """
+    Handle a change to a customer's active entitlements.
+
+    Stripe sends this whenever a customer gains or loses a feature, for example
+    after a subscription is created, upgraded or cancelled.
+
+    Args:
+        summary (dict): The Stripe active entitlement summary, with the customer ID
+            in 'customer' and the entitlements in 'entitlements'
+
+    Side Effects:
+        - Replaces the customer's stored entitlements, unless they were synced
+          more recently than the event
+        - Drops the customer's cached entitlements when the event commits, so the next check sees the change
+        - Does not commit; the webhook inbox commits once per event
+
+    Raises:
+        EventNotReady: If the summary arrived before the checkout that created
+        the customer. The inbox retries it.
+    """
+    stripe_customer_id = stripe_id(summary.get('customer'))
+    entitlements = summary.get('entitlements') or {}
+    created = current_event_created()
+    synced_at = utc_datetime(created) if created is not None else utc_datetime()
+    data = entitlements.get('data', [])
+    if entitlements.get('has_more'):
+        # The summary only embeds the first page
+        synced_at = utc_datetime()
+        data = fetch_entitlements(stripe_customer_id)
+
+    if not replace_entitlements(stripe_customer_id, data, synced_at):
+        exists = db.session.scalar(
+            db.select(Customer.id).where(Customer.stripe_customer_id == stripe_customer_id)
+        )
+        if exists is None:
+            raise EventNotReady(f"Customer {stripe_customer_id} does not exist yet")
+        current_app.logger.info(f"Skipping stale entitlement summary for customer {stripe_customer_id}")
+    entitlement_cache.invalidate_on_commit(stripe_customer_id)
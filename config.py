@@ -5,19 +5,75 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(base_dir, 'app.db')
+    # Pool, timeout and SQLite pragma settings from app/database.py: 'sqlite', 'postgres' or 'default'
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE') or \
+        ('postgres' if SQLALCHEMY_DATABASE_URI.startswith('postgres') else 'sqlite')
+    # Read-only replicas of the primary, comma separated. GET requests read from one of them.
+    # A user's requests read from the primary for this many seconds after they write or their billing changes.
+    REPLICA_DATABASE_URIS = [url for url in (os.environ.get('REPLICA_DATABASE_URLS') or '').split(',') if url]
+    REPLICA_STICKY_SECONDS = 30
     
+    # Users allowed to call the admin endpoints under /analytics, comma separated
+    ADMIN_EMAILS = [email.strip().lower() for email in (os.environ.get('ADMIN_EMAILS') or '').split(',') if email.strip()]
+    # Directory of the cohort retention Parquet snapshots written by `flask analytics cohorts`. Defaults to instance/cohorts.
+    COHORTS_PATH = os.environ.get('COHORTS_PATH')
+
     # Stripe configuration
     STRIPE_SECRET_KEY = os.environ.get('TEST_STRIPE_SECRET_KEY')
     STRIPE_WEBHOOK_SECRET = os.environ.get('TEST_STRIPE_WEBHOOK_SECRET')
     STRIPE_MONTHLY_PRICE_ID = os.environ.get('TEST_MONTHLY_PRICE_ID')
     STRIPE_YEARLY_PRICE_ID = os.environ.get('TEST_YEARLY_PRICE_ID')
 
+    # Webhook inbox: number of background worker threads per process, and retry policy
+    WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS') or 4)
+    WEBHOOK_POLL_INTERVAL = 5
+    WEBHOOK_MAX_ATTEMPTS = 8
+    WEBHOOK_RETRY_BACKOFF = 2
+    WEBHOOK_LEASE_SECONDS = 300
+    # Events are sharded across the workers by customer. Each event is held this many seconds
+    # so that a customer's events delivered close together are applied in the order Stripe created them
+    WEBHOOK_REORDER_DELAY = 1
+    # Number of recently processed event IDs kept in memory to short-circuit redeliveries
+    WEBHOOK_LEDGER_CACHE_SIZE = 10000
+    # Handled events move the catch-up cursor forward, unless this many seconds have passed since it,
+    # which may mean events were missed; `flask stripe catch-up` then replays from before the gap
+    WEBHOOK_CURSOR_MAX_GAP = 900
+
+    # Active entitlements are cached per customer for this many seconds, for at most this many customers.
+    # Entitlement and subscription webhooks invalidate a customer's entry straight away.
+    ENTITLEMENT_CACHE_TTL = 60
+    ENTITLEMENT_CACHE_SIZE = 10000
+    # 'sqlite' shares the cache between the gunicorn workers on a host through a local file,
+    # ENTITLEMENT_CACHE_PATH or instance/entitlement_cache.db. 'memory' keeps one per process.
+    ENTITLEMENT_CACHE_BACKEND = os.environ.get('ENTITLEMENT_CACHE_BACKEND') or 'sqlite'
+    ENTITLEMENT_CACHE_PATH = os.environ.get('ENTITLEMENT_CACHE_PATH')
+    # Threads refreshing stale entitlements from Stripe while the stored ones are served. 0 refreshes inline.
+    ENTITLEMENT_REFRESH_WORKERS = 2
+
+    # Seconds a snapshot of the user's billing state is kept in the session cookie and trusted. 0 disables it.
+    BILLING_SNAPSHOT_TTL = 0
+
+    # Stripe reads: HTTP timeout in seconds, and the circuit breaker that stops calling Stripe
+    # after this many consecutive failures, for this many seconds, before letting probe calls through
+    STRIPE_TIMEOUT = 10
+    STRIPE_BREAKER_FAILURES = 5
+    STRIPE_BREAKER_RESET = 30
+    STRIPE_BREAKER_PROBES = 1
+
 
 class TestConfig(Config):
     """Configuration for testing."""
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    DATABASE_PROFILE = 'default'
     WTF_CSRF_ENABLED = False
+
+    # Process webhook events inline so tests see the result of the request
+    WEBHOOK_WORKERS = 0
+    WEBHOOK_REORDER_DELAY = 0
+    ENTITLEMENT_REFRESH_WORKERS = 0
+    ENTITLEMENT_CACHE_BACKEND = 'memory'
+    BILLING_SNAPSHOT_TTL = 0
     
     # Mock Stripe keys for testing
     STRIPE_SECRET_KEY = 'sk_test_mock_key'
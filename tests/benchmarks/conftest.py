@@ -0,0 +1,96 @@
+"""
+Fixtures for the payment hot path benchmarks.
+
+Every benchmark runs once per database backend:
+
+- ``sqlite-memory``: the in-memory database used by the unit tests
+- ``sqlite-file``: a SQLite file, so commits pay for real disk writes
+- ``postgres``: only when BENCHMARK_DATABASE_URL points at a scratch Postgres database
+
+Stripe is replaced by the in-process StripeStub. Set BENCHMARK_STRIPE_LATENCY_MS
+to add a fixed latency to every Stripe call.
+"""
+import os
+from contextlib import contextmanager
+import pytest
+from app import create_app, db
+from app.models import User, Customer, Subscription
+from app.payments.entitlements import replace_entitlements, utc_datetime
+from config import TestConfig
+from tests.fixtures.stripe_stub import StripeStub
+
+BACKENDS = ['sqlite-memory', 'sqlite-file', 'postgres']
+
+
+def database_url(backend, tmp_path):
+    if backend == 'sqlite-memory':
+        return 'sqlite:///:memory:'
+    if backend == 'sqlite-file':
+        return 'sqlite:///' + str(tmp_path / 'benchmark.db')
+    url = os.environ.get('BENCHMARK_DATABASE_URL')
+    if not url:
+        pytest.skip('Set BENCHMARK_DATABASE_URL to benchmark against Postgres')
+    return url
+
+
+@contextmanager
+def benchmark_app(url, profile='default'):
+    """An app with one user, customer and active subscription on the given database and engine profile."""
+    class BenchmarkConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = url
+        DATABASE_PROFILE = profile
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(email='bench@example.com', name='Bench User')
+        user.set_password('password123')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Customer(user_id=user.id, stripe_customer_id='cus_bench', customer_name='Bench User'))
+        db.session.flush()
+        db.session.add(Subscription(
+            stripe_customer_id='cus_bench',
+            stripe_subscription_id='sub_bench',
+            status='active',
+            product_id='prod_test123',
+            price_id='price_test123'
+        ))
+        db.session.commit()
+        app.config['BENCHMARK_USER_ID'] = user.id
+        try:
+            yield app
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+@pytest.fixture(params=BACKENDS)
+def bench_app(request, tmp_path):
+    """An app with one user, customer, active subscription and synced entitlements on the given backend."""
+    with benchmark_app(database_url(request.param, tmp_path)) as app:
+        replace_entitlements('cus_bench', [{'lookup_key': 'test-access'}, {'lookup_key': 'test-access-2'}], utc_datetime())
+        db.session.commit()
+        yield app
+
+
+@pytest.fixture
+def stripe_stub():
+    """The Stripe stub with the benchmark customer, subscription and entitlements, patched into the SDK."""
+    stub = StripeStub(latency=float(os.environ.get('BENCHMARK_STRIPE_LATENCY_MS', 0)) / 1000)
+    stub.add_customer('cus_bench')
+    stub.add_subscription('sub_bench', 'cus_bench')
+    stub.add_entitlements('cus_bench', 'test-access', 'test-access-2')
+    with stub.patch():
+        yield stub
+
+
+@pytest.fixture
+def bench_client(bench_app):
+    """A test client logged in as the benchmark user."""
+    client = bench_app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(bench_app.config['BENCHMARK_USER_ID'])
+        sess['_fresh'] = True
+    return client
@@ -0,0 +1,51 @@
+"""
+Benchmarks for the per-request access checks: loading the user, @requires_feature and the /access view.
+"""
+import os
+import pytest
+from unittest.mock import patch
+from flask_login import login_user
+from app import db
+from app.models import User, load_user
+from app.payments.decorators import requires_feature
+
+
+@pytest.fixture
+def stripe_key():
+    with patch.dict(os.environ, {'TEST_STRIPE_SECRET_KEY': 'sk_test_benchmark'}):
+        yield
+
+
+@pytest.mark.benchmark(group='access')
+class TestAccessBenchmarks:
+    """Code that runs on every request for a gated page."""
+
+    def test_load_user(self, benchmark, bench_app):
+        user_id = str(bench_app.config['BENCHMARK_USER_ID'])
+
+        def load():
+            # A fresh session, as at the start of each request
+            db.session.remove()
+            return load_user(user_id)
+
+        assert benchmark(load).email == 'bench@example.com'
+
+    def test_requires_feature(self, benchmark, bench_app, stripe_stub):
+        view = requires_feature('test-access')(lambda: 'ok')
+        user_id = bench_app.config['BENCHMARK_USER_ID']
+
+        def check():
+            with bench_app.test_request_context('/premium'):
+                login_user(db.session.get(User, user_id))
+                return view()
+
+        assert benchmark(check) == 'ok'
+
+    def test_premium_view(self, benchmark, bench_client, stripe_stub):
+        assert benchmark(bench_client.get, '/premium').status_code == 200
+
+    def test_access_view(self, benchmark, bench_client, stripe_stub, stripe_key):
+        response = benchmark(bench_client.get, '/access')
+
+        assert response.status_code == 200
+        assert b'test-access' in response.data
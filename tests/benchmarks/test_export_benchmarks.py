@@ -0,0 +1,42 @@
+"""
+Benchmarks for the streaming export: time to stream every customer and subscription, and its peak memory.
+
+Runs over the BENCHMARK_REVENUE_LOAD_ROWS subscriptions of the revenue benchmarks' revenue_app.
+"""
+import tracemalloc
+import pytest
+from app import db
+from app.analytics.export import export_chunks
+from tests.benchmarks.test_revenue_benchmarks import LOAD_ROWS, revenue_app  # noqa: F401
+
+
+def stream(output_format, limit=None):
+    """Stream the export from a fresh session, keeping only its size in characters."""
+    db.session.remove()
+    return sum(len(chunk) for chunk in export_chunks(output_format, limit=limit))
+
+
+def traced(limit=None):
+    """Stream the CSV export and return (size, peak bytes allocated while streaming)."""
+    tracemalloc.start()
+    try:
+        return stream('csv', limit), tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.benchmark(group='export')
+class TestExportBenchmarks:
+    """Streaming the export of many subscriptions."""
+
+    @pytest.mark.parametrize('output_format', ['csv', 'ndjson'])
+    def test_stream(self, benchmark, revenue_app, output_format):
+        assert benchmark(stream, output_format) > LOAD_ROWS * 100
+
+    def test_memory_stays_flat(self, revenue_app):
+        _, peak_tenth = traced(limit=LOAD_ROWS // 10)
+        size, peak = traced()
+
+        # Ten times the rows in about the same memory, far less than the whole export
+        assert peak < peak_tenth * 2
+        assert peak < size / 3
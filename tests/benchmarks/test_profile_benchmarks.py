@@ -0,0 +1,98 @@
+"""
+Webhook and page throughput under concurrent load for each database engine profile.
+
+Half of BENCHMARK_THREADS threads post webhooks, handled inline, while the
+other half view a gated page, each making BENCHMARK_REQUESTS_PER_THREAD
+requests. Throughput per kind of request is reported in the benchmark's
+extra_info and printed with -s.
+"""
+import itertools
+import os
+import threading
+import time
+import pytest
+from app import db
+from app.payments.entitlements import replace_entitlements, utc_datetime
+from tests.benchmarks.conftest import benchmark_app, database_url
+from tests.benchmarks.test_webhook_benchmarks import post_event, webhook_secret  # noqa: F401
+from tests.fixtures.stripe_fixtures import mock_webhook_event
+
+PROFILES = [
+    ('sqlite-file', 'default'),
+    ('sqlite-file', 'sqlite'),
+    ('postgres', 'default'),
+    ('postgres', 'postgres'),
+]
+
+THREADS = int(os.environ.get('BENCHMARK_THREADS', 8))
+REQUESTS_PER_THREAD = int(os.environ.get('BENCHMARK_REQUESTS_PER_THREAD', 10))
+
+
+@pytest.fixture(params=PROFILES, ids=[f'{backend}-{profile}' for backend, profile in PROFILES])
+def profile_app(request, tmp_path):
+    """The benchmark app on a database that takes concurrent connections, with the given engine profile."""
+    backend, profile = request.param
+    with benchmark_app(database_url(backend, tmp_path), profile) as app:
+        replace_entitlements('cus_bench', [{'lookup_key': 'test-access'}], utc_datetime())
+        db.session.commit()
+        yield app
+
+
+def mixed_load(app):
+    """
+    Run the webhook and page threads together.
+
+    Returns:
+        dict: Requests per second and failed requests for each kind of request
+    """
+    event_ids = itertools.count()
+    barrier = threading.Barrier(THREADS + 1)
+    statuses = {'webhook': [], 'page': []}
+
+    def post_webhooks():
+        client = app.test_client()
+        barrier.wait()
+        for _ in range(REQUESTS_PER_THREAD):
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'in_bench', 'subscription': 'sub_bench'},
+                                       event_id=f'evt_{next(event_ids)}')
+            statuses['webhook'].append(post_event(client, event).status_code)
+
+    def view_pages():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(app.config['BENCHMARK_USER_ID'])
+        barrier.wait()
+        for _ in range(REQUESTS_PER_THREAD):
+            statuses['page'].append(client.get('/premium').status_code)
+
+    workers = [
+        threading.Thread(target=post_webhooks if i % 2 else view_pages)
+        for i in range(THREADS)
+    ]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        kind: {
+            'per_second': len(codes) / elapsed,
+            'failed': sum(1 for code in codes if code >= 400)
+        }
+        for kind, codes in statuses.items()
+    }
+
+
+@pytest.mark.benchmark(group='engine_profiles')
+def test_mixed_load(benchmark, request, profile_app, webhook_secret):
+    results = benchmark.pedantic(mixed_load, args=(profile_app,), rounds=1, iterations=1)
+
+    benchmark.extra_info.update(results)
+    print(f"\n{request.node.callspec.id}: "
+          f"{results['webhook']['per_second']:.0f} webhooks/s ({results['webhook']['failed']} failed), "
+          f"{results['page']['per_second']:.0f} pages/s ({results['page']['failed']} failed)")
+    assert results['webhook']['failed'] == 0
+    assert results['page']['failed'] == 0
@@ -0,0 +1,137 @@
+"""
+Benchmarks for the revenue analytics: computing a year of monthly MRR movements and of cohort retention,
+loading subscriptions, and rebuilding and reading the daily revenue rollups.
+
+BENCHMARK_REVENUE_ROWS sets the number of subscriptions the metrics are computed
+over, a million by default, and BENCHMARK_REVENUE_LOAD_ROWS the number loaded
+from each database backend, a hundred thousand by default.
+"""
+import os
+from datetime import date, datetime, timedelta
+import numpy as np
+import polars as pl
+import pytest
+from app import db
+from app.analytics.cohorts import month_index, retention_counts
+from app.analytics.revenue import (
+    CUSTOMERS_SCHEMA,
+    SUBSCRIPTIONS_SCHEMA,
+    load_subscriptions,
+    revenue_movements,
+    unix_seconds
+)
+from app.analytics.rollups import daily_revenue, rebuild_rollups
+from app.models import Customer, Subscription
+
+ROWS = int(os.environ.get('BENCHMARK_REVENUE_ROWS', 1_000_000))
+LOAD_ROWS = int(os.environ.get('BENCHMARK_REVENUE_LOAD_ROWS', 100_000))
+
+START, END = date(2025, 1, 1), date(2026, 1, 1)
+
+
+def synthetic_subscriptions(rows, seed=5803):
+    """
+    Subscriptions created over two years up to END, two for every three customers.
+
+    About one in five has ended, one in ten bills yearly and one in twenty had a trial.
+    """
+    rng = np.random.default_rng(seed)
+    first = unix_seconds(START - timedelta(days=365))
+    created = rng.integers(first, unix_seconds(END), rows)
+    cancelled = rng.random(rows) < 0.2
+    yearly = rng.random(rows) < 0.1
+    trial = rng.random(rows) < 0.05
+    return pl.DataFrame({
+        'customer': rng.integers(0, rows * 2 // 3, rows),
+        'customer_created': first,
+        'subscription': [f'sub_{i}' for i in range(rows)],
+        'status': np.where(cancelled, 'cancelled', 'active'),
+        'product_id': 'prod_1',
+        'price_id': np.where(yearly, 'price_yearly', 'price_monthly'),
+        'amount': np.where(yearly, 99_000, rng.choice([999, 2999, 9999], rows)),
+        'currency': 'usd',
+        'billing_interval': np.where(yearly, 'year', 'month'),
+        'billing_interval_count': 1,
+        'created': created,
+        'trial_end': pl.Series(created + 14 * 86400).scatter(np.flatnonzero(~trial), None),
+        'ended': pl.Series(created + rng.integers(86400, 400 * 86400, rows)).scatter(np.flatnonzero(~cancelled), None),
+        'period_end': None,
+        'plan_from': None,
+        'plan_until': None,
+    }, schema=SUBSCRIPTIONS_SCHEMA)
+
+
+def synthetic_customers(subscriptions):
+    """The customers of synthetic_subscriptions, each created with their first subscription."""
+    return subscriptions.group_by('customer').agg(
+        stripe_customer_id=pl.format('cus_{}', pl.col('customer').first()),
+        customer_created=pl.col('created').min()
+    ).select(list(CUSTOMERS_SCHEMA))
+
+
+@pytest.fixture
+def revenue_app(bench_app):
+    """The benchmark app with LOAD_ROWS more priced subscriptions, inserted in bulk."""
+    customers = [
+        dict(user_id=bench_app.config['BENCHMARK_USER_ID'], stripe_customer_id=f'cus_{i}',
+             created_at=datetime(2024, 1, 1))
+        for i in range(LOAD_ROWS // 2)
+    ]
+    subscriptions = [
+        dict(stripe_customer_id=f'cus_{i // 2}', stripe_subscription_id=f'sub_{i}', status='active',
+             product_id='prod_1', price_id=f'price_{i % 3}', amount=999, currency='usd', billing_interval='month',
+             billing_interval_count=1, created_at=datetime(2025, 1, 1) + timedelta(minutes=i))
+        for i in range(LOAD_ROWS)
+    ]
+    db.session.execute(db.insert(Customer), customers)
+    db.session.execute(db.insert(Subscription), subscriptions)
+    db.session.commit()
+    return bench_app
+
+
+@pytest.mark.benchmark(group='revenue')
+class TestRevenueBenchmarks:
+    """Revenue analytics over many subscriptions."""
+
+    def test_monthly_movements(self, benchmark):
+        frame = synthetic_subscriptions(ROWS)
+
+        report = benchmark(revenue_movements, frame, START, END, 'month')
+
+        assert report.height == 12
+        assert report['mrr_end'].to_list()[:-1] == report['mrr_start'].to_list()[1:]
+        movements = (report['mrr_start'] + report['new_mrr'] + report['expansion_mrr']
+                     - report['contraction_mrr'] - report['churned_mrr'])
+        assert movements.to_list() == pytest.approx(report['mrr_end'].to_list())
+
+    def test_cohort_retention(self, benchmark):
+        frame = synthetic_subscriptions(ROWS)
+        customers = synthetic_customers(frame)
+
+        counts = benchmark(retention_counts, customers, frame, month_index(START), month_index(END) - 1)
+
+        assert counts['month'].n_unique() == 12
+        assert (counts['retained'] <= counts['customers']).all()
+
+    def test_load_subscriptions(self, benchmark, revenue_app):
+        def load():
+            # A fresh session, so nothing is served from the identity map
+            db.session.remove()
+            return load_subscriptions()
+
+        assert benchmark(load).height == LOAD_ROWS + 1
+
+    def test_rebuild_rollups(self, benchmark, revenue_app):
+        rows = benchmark(rebuild_rollups)
+
+        # Subscriptions are created a minute apart, so they start on LOAD_ROWS / 1440 days, on each of three prices
+        assert rows >= LOAD_ROWS // 1440 * 3
+
+    def test_daily_revenue_from_rollups(self, benchmark, revenue_app):
+        rebuild_rollups()
+        db.session.commit()
+
+        days = benchmark(daily_revenue, START, END, True)
+
+        assert days.height == 365 * 3
+        assert days['subscriptions'].sum() > 0
@@ -0,0 +1,167 @@
+"""
+Benchmarks for receiving Stripe webhooks and for each handler in webhook_helpers.
+"""
+import itertools
+import json
+import os
+import time
+import pytest
+from unittest.mock import patch
+from app.payments.dispatcher import LatencyHistogram
+from app.payments.hydration import hydrate_checkout_session
+from app.payments.persistence import unit_of_work
+from app.payments.stripe_client import stripe_client
+from app.payments.signature import sign_payload
+from app.payments.webhook_helpers import (
+    handle_checkout_session,
+    handle_invoice_paid,
+    handle_invoice_payment_failed,
+    handle_subscription_cancelled,
+    set_subscription_status
+)
+from tests.fixtures.stripe_fixtures import mock_checkout_session, mock_webhook_event
+from tests.fixtures.stripe_stub import StripeStub
+
+SECRET = 'whsec_benchmark'
+
+# The checkout comparison needs a round trip to compare, so it adds one when BENCHMARK_STRIPE_LATENCY_MS is not set
+HYDRATION_LATENCY_MS = float(os.environ.get('BENCHMARK_STRIPE_LATENCY_MS') or 20)
+HYDRATION_CHECKOUTS = 20
+
+
+@pytest.fixture
+def webhook_secret():
+    with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': SECRET}):
+        yield SECRET
+
+
+def post_event(client, event):
+    payload = json.dumps(event)
+    return client.post(
+        '/payments/event',
+        data=payload,
+        content_type='application/json',
+        headers={'stripe-signature': sign_payload(payload, SECRET)}
+    )
+
+
+def checkout_session(app):
+    return mock_checkout_session(
+        customer_id='cus_bench',
+        subscription_id='sub_bench',
+        client_reference_id=str(app.config['BENCHMARK_USER_ID'])
+    )
+
+
+@pytest.mark.benchmark(group='event_received')
+class TestEventReceivedBenchmarks:
+    """POST /payments/event end to end, with events handled inline."""
+
+    def test_new_payment_failed_event(self, benchmark, bench_app, stripe_stub, webhook_secret):
+        client = bench_app.test_client()
+        event_ids = itertools.count()
+
+        def receive():
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'in_bench', 'subscription': 'sub_bench'},
+                                       event_id=f'evt_{next(event_ids)}')
+            return post_event(client, event)
+
+        assert benchmark(receive).status_code == 200
+
+    def test_new_checkout_event(self, benchmark, bench_app, stripe_stub, webhook_secret):
+        client = bench_app.test_client()
+        event_ids = itertools.count()
+
+        def receive():
+            event = mock_webhook_event('checkout.session.completed', checkout_session(bench_app), event_id=f'evt_{next(event_ids)}')
+            return post_event(client, event)
+
+        assert benchmark(receive).status_code == 200
+        assert stripe_stub.calls['Subscription.retrieve'] >= 1
+
+    def test_redelivered_event(self, benchmark, bench_app, stripe_stub, webhook_secret):
+        client = bench_app.test_client()
+        event = mock_webhook_event('invoice.payment_failed', {'id': 'in_bench', 'subscription': 'sub_bench'},
+                                   event_id='evt_redelivered')
+        post_event(client, event)
+
+        assert benchmark(post_event, client, event).status_code == 200
+
+
+@pytest.mark.benchmark(group='webhook_helpers')
+class TestWebhookHelperBenchmarks:
+    """Each handler applied in its own unit of work, as the inbox runs it."""
+
+    @pytest.mark.parametrize('handler, data_object', [
+        (handle_subscription_cancelled, {'id': 'sub_bench'}),
+        (handle_invoice_paid, {'id': 'in_bench', 'subscription': 'sub_bench'}),
+        (handle_invoice_payment_failed, {'id': 'in_bench', 'subscription': 'sub_bench'}),
+    ], ids=['subscription_cancelled', 'invoice_paid', 'invoice_payment_failed'])
+    def test_handler(self, benchmark, bench_app, stripe_stub, handler, data_object):
+        def apply():
+            with unit_of_work():
+                handler(data_object)
+
+        benchmark(apply)
+
+    def test_handle_checkout_session(self, benchmark, bench_app, stripe_stub):
+        session = checkout_session(bench_app)
+
+        def apply():
+            with unit_of_work():
+                handle_checkout_session(session)
+
+        benchmark(apply)
+        assert stripe_stub.calls['Customer.retrieve'] == 0
+
+    def test_set_subscription_status(self, benchmark, bench_app):
+        def apply():
+            with unit_of_work():
+                set_subscription_status('sub_bench', 'active')
+
+        benchmark(apply)
+
+
+def sequential_retrieves(session):
+    """How handle_checkout_session fetched its Stripe objects before hydration: one retrieve after the other."""
+    customer = stripe_client.retrieve_customer(session['customer'])
+    subscription = stripe_client.retrieve_subscription(session['subscription'])
+    return customer, subscription
+
+
+def checkout_latency(app, fetch):
+    """The latency of fetching the Stripe objects of HYDRATION_CHECKOUTS checkouts, in a LatencyHistogram."""
+    stub = StripeStub(latency=HYDRATION_LATENCY_MS / 1000)
+    histogram = LatencyHistogram()
+    with stub.patch():
+        for i in range(HYDRATION_CHECKOUTS + 1):
+            stub.add_customer(f'cus_hydrate_{i}')
+            stub.add_subscription(f'sub_hydrate_{i}', f'cus_hydrate_{i}')
+            session = mock_checkout_session(customer_id=f'cus_hydrate_{i}', subscription_id=f'sub_hydrate_{i}')
+            started = time.perf_counter()
+            fetch(session)
+            # The first checkout warms up the SDK client and is left out
+            if i:
+                histogram.observe((time.perf_counter() - started) * 1000)
+    return histogram.summary()
+
+
+@pytest.mark.benchmark(group='checkout_hydration')
+def test_checkout_latency_before_and_after_hydration(benchmark, app):
+    """p50 and p99 of a checkout's Stripe fetches, as two sequential retrieves and as one expanded retrieve."""
+    def compare():
+        with app.app_context():
+            return {
+                'before': checkout_latency(app, sequential_retrieves),
+                'after': checkout_latency(app, hydrate_checkout_session)
+            }
+
+    results = benchmark.pedantic(compare, rounds=1, iterations=1)
+
+    benchmark.extra_info.update({
+        f'{when}_{stat}': results[when][stat] for when in results for stat in ('p50_ms', 'p99_ms')
+    })
+    print(f"\nCheckout Stripe fetches with {HYDRATION_LATENCY_MS:.0f} ms a call: "
+          f"before p50 {results['before']['p50_ms']:.1f} ms, p99 {results['before']['p99_ms']:.1f} ms; "
+          f"after p50 {results['after']['p50_ms']:.1f} ms, p99 {results['after']['p99_ms']:.1f} ms")
+    assert results['after']['p50_ms'] < results['before']['p50_ms']
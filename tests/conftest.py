@@ -104,15 +104,22 @@ def authenticated_client(app, client, sample_user):
     return client
 
 
+@pytest.fixture
+def admin_client(app, authenticated_client):
+    """The authenticated client, with its user listed in ADMIN_EMAILS."""
+    app.config['ADMIN_EMAILS'] = ['test@example.com']
+    return authenticated_client
+
+
 @pytest.fixture
 def mock_stripe():
     """Mock the stripe module for testing."""
     with patch('stripe.checkout.Session.create') as mock_checkout, \
-         patch('stripe.Customer.retrieve') as mock_customer, \
-         patch('stripe.Subscription.retrieve') as mock_subscription, \
+         patch('stripe.CustomerService.retrieve') as mock_customer, \
+         patch('stripe.SubscriptionService.retrieve') as mock_subscription, \
          patch('stripe.billing_portal.Session.create') as mock_portal, \
          patch('stripe.Webhook.construct_event') as mock_webhook, \
-         patch('stripe.entitlements.ActiveEntitlement.list') as mock_entitlements:
+         patch('stripe.entitlements.ActiveEntitlementService.list') as mock_entitlements:
         
         yield {
             'checkout_create': mock_checkout,
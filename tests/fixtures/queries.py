@@ -0,0 +1,87 @@
+"""
+Helpers for asserting how many SQL statements a piece of code runs, and how the database runs them.
+"""
+import re
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from app import db
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run on the app's engine. Use inside an app context."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.engines[None]
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def capture_queries():
+    """Collect (statement, parameters) for the SQL statements run on the app's engine, except bulk inserts."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    engine = db.engines[None]
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def full_scans(statement, parameters):
+    """
+    The tables the database plans to read in full to run a statement, as (table, plan line) pairs.
+
+    On Postgres sequential scans are switched off for the explain, since the
+    planner prefers them for the few rows of a test database whether or not an
+    index could be used. A Seq Scan left in the plan means there was no index.
+    """
+    connection = db.session.connection()
+    try:
+        if connection.dialect.name == 'sqlite':
+            plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            return [
+                (row.detail.split()[1], row.detail) for row in plan
+                if re.match(r'SCAN (?!CONSTANT ROW)', row.detail)
+            ]
+        connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        plan = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        return [
+            (node['Relation Name'], f"Seq Scan on {node['Relation Name']}")
+            for node in _plan_nodes(plan[0]['Plan']) if node['Node Type'] == 'Seq Scan'
+        ]
+    finally:
+        db.session.rollback()
+
+
+def sorts(statement, parameters):
+    """The sorts the database plans to run a statement, as plan lines. Empty when an index gives the order."""
+    connection = db.session.connection()
+    try:
+        if connection.dialect.name == 'sqlite':
+            plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            return [row.detail for row in plan if 'TEMP B-TREE' in row.detail]
+        connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        plan = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        return [node['Node Type'] for node in _plan_nodes(plan[0]['Plan']) if node['Node Type'].endswith('Sort')]
+    finally:
+        db.session.rollback()
@@ -96,7 +96,8 @@ def mock_invoice(
     customer_id: str = 'cus_test123456',
     status: str = 'paid'
 ) -> dict:
-    """Create a mock Stripe invoice object."""
+    """Create a mock Stripe invoice object, with one line for the subscription period it pays for."""
+    period_start = int(time.time())
     return {
         'id': invoice_id,
         'object': 'invoice',
@@ -107,6 +108,15 @@ def mock_invoice(
         'amount_paid': 999 if status == 'paid' else 0,
         'currency': 'usd',
         'created': int(time.time()),
+        'lines': {
+            'object': 'list',
+            'data': [{
+                'id': 'il_test123',
+                'object': 'line_item',
+                'amount': 999,
+                'period': {'start': period_start, 'end': period_start + 30 * 24 * 60 * 60}
+            }]
+        },
         'livemode': False,
     }
 
@@ -0,0 +1,108 @@
+"""
+A deterministic in-process stand-in for the Stripe API.
+
+The stub keeps Stripe objects in dictionaries, honours ``expand`` for the
+customer on subscriptions, pages through events like the events list API,
+serves active entitlements per customer, counts calls and can inject a fixed latency per call so tests can measure
+how many round trips a code path makes.
+"""
+import copy
+import time
+from collections import Counter
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from tests.fixtures.stripe_fixtures import mock_stripe_customer, mock_subscription
+
+
+class StripeStub:
+    """In-memory Stripe API with configurable per-call latency."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.customers = {}
+        self.subscriptions = {}
+        self.events = []
+        self.entitlements = {}
+        self.calls = Counter()
+
+    def add_customer(self, customer_id: str, **kwargs) -> dict:
+        self.customers[customer_id] = mock_stripe_customer(customer_id=customer_id, **kwargs)
+        return self.customers[customer_id]
+
+    def add_subscription(self, subscription_id: str, customer_id: str, **kwargs) -> dict:
+        self.subscriptions[subscription_id] = mock_subscription(
+            subscription_id=subscription_id,
+            customer_id=customer_id,
+            **kwargs
+        )
+        return self.subscriptions[subscription_id]
+
+    def add_entitlements(self, customer_id: str, *lookup_keys: str) -> None:
+        self.entitlements[customer_id] = list(lookup_keys)
+
+    def add_event(self, event: dict) -> dict:
+        self.events.append(event)
+        return event
+
+    def _call(self, name: str):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def retrieve_customer(self, customer_id, params=None, options=None):
+        self._call('Customer.retrieve')
+        return copy.deepcopy(self.customers[customer_id])
+
+    def retrieve_subscription(self, subscription_id, params=None, options=None):
+        self._call('Subscription.retrieve')
+        subscription = copy.deepcopy(self.subscriptions[subscription_id])
+        if 'customer' in (params or {}).get('expand', []):
+            subscription['customer'] = copy.deepcopy(self.customers[subscription['customer']])
+        return subscription
+
+    def list_events(self, params=None, options=None):
+        """Newest first, filtered and paged like the SDK's ``v1.events.list``."""
+        self._call('Event.list')
+        params = params or {}
+        created = params.get('created') or {}
+        types = params.get('types')
+        limit = params.get('limit', 10)
+        starting_after = params.get('starting_after')
+        events = sorted(self.events, key=lambda event: (event['created'], event['id']), reverse=True)
+        events = [
+            event for event in events
+            if event['created'] >= created.get('gte', event['created'])
+            and event['created'] < created.get('lt', event['created'] + 1)
+            and (not types or event['type'] in types)
+        ]
+        if starting_after:
+            ids = [event['id'] for event in events]
+            events = events[ids.index(starting_after) + 1:]
+        return {
+            'object': 'list',
+            'data': copy.deepcopy(events[:limit]),
+            'has_more': len(events) > limit
+        }
+
+    def list_active_entitlements(self, params, options=None):
+        """Active entitlements with attribute access, like the SDK's ``v1.entitlements.active_entitlements.list``."""
+        self._call('ActiveEntitlement.list')
+        return SimpleNamespace(data=[
+            SimpleNamespace(id=f'ent_{lookup_key}', lookup_key=lookup_key, feature=f'feat_{lookup_key}')
+            for lookup_key in self.entitlements.get(params['customer'], [])
+        ])
+
+    def patch(self):
+        """Patch the Stripe SDK's services to route calls to this stub. Use as a context manager."""
+        stack = ExitStack()
+        stack.enter_context(patch('stripe.CustomerService.retrieve', side_effect=self.retrieve_customer))
+        stack.enter_context(patch('stripe.SubscriptionService.retrieve', side_effect=self.retrieve_subscription))
+        stack.enter_context(patch('stripe.EventService.list', side_effect=self.list_events))
+        stack.enter_context(patch('stripe.entitlements.ActiveEntitlementService.list', side_effect=self.list_active_entitlements))
+        return stack
@@ -0,0 +1,298 @@
+"""
+Unit tests for the request-scoped billing context, its session snapshot and per-request query counts.
+"""
+import os
+import time
+import pytest
+import stripe
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from app import db
+from app.models import Customer, Subscription, User
+from app.payments.billing import SNAPSHOT_KEY, billing_context, has_active_access, load_billing_context
+from app.payments.decorators import requires_feature
+from app.payments.dispatcher import dispatcher
+from app.payments.entitlements import entitlement_cache, mark_entitlements_stale, replace_entitlements, utc_datetime
+from tests.fixtures.queries import count_queries
+from tests.fixtures.stripe_fixtures import mock_webhook_event
+
+
+@pytest.fixture
+def synced_customer(app, sample_customer, sample_subscription):
+    """The sample customer, subscribed, with the 'test-access' and 'reports' entitlements already synced."""
+    with app.app_context():
+        replace_entitlements(
+            'cus_test123456', [{'lookup_key': 'test-access'}, {'lookup_key': 'reports'}], utc_datetime()
+        )
+        db.session.commit()
+    return sample_customer
+
+
+@pytest.fixture
+def gated_app(app):
+    """Routes that check features several times per request, as stacked decorators and templates do."""
+    @app.route('/upgrade')
+    def upgrade():
+        return 'Upgrade page', 200
+
+    @app.route('/stacked')
+    @requires_feature('test-access')
+    @requires_feature('reports')
+    def stacked():
+        billing = billing_context()
+        return f"{billing.user.email} {billing.has_feature('test-access', 'reports')}", 200
+
+    return app
+
+
+def requests_queries(app, client, path):
+    """Request a page in a fresh app context and return (response, SQL statements run)."""
+    with app.app_context(), count_queries() as statements:
+        response = client.get(path)
+    return response, statements
+
+
+class TestRequestQueries:
+    """Tests for how many queries a gated request runs."""
+
+    def test_premium_page_is_one_query(self, app, authenticated_client, synced_customer):
+        """Test that the user, customer and entitlements of a premium page view are loaded together."""
+        # Warm the feature registry, which a process loads once
+        authenticated_client.get('/premium')
+
+        response, statements = requests_queries(app, authenticated_client, '/premium')
+
+        assert response.status_code == 200
+        assert len(statements) == 1
+
+    def test_stacked_checks_share_the_query(self, gated_app, authenticated_client, synced_customer):
+        """Test that two decorators and the view itself do not load anything again."""
+        authenticated_client.get('/stacked')
+
+        response, statements = requests_queries(gated_app, authenticated_client, '/stacked')
+
+        assert response.data == b'test@example.com True'
+        assert len(statements) == 1
+
+    def test_access_page_is_one_query(self, app, authenticated_client, synced_customer):
+        with patch.dict(os.environ, {'TEST_STRIPE_SECRET_KEY': 'sk_test_fake'}):
+            authenticated_client.get('/access')
+            response, statements = requests_queries(app, authenticated_client, '/access')
+
+        assert b'test-access' in response.data
+        assert len(statements) == 1
+
+    def test_access_page_shows_a_lapsed_subscription(self, app, authenticated_client, synced_customer):
+        """Test that features are listed as unusable once the subscription is no longer paid up."""
+        with app.app_context():
+            db.session.execute(db.update(Subscription).values(status='past_due'))
+            db.session.commit()
+        with patch.dict(os.environ, {'TEST_STRIPE_SECRET_KEY': 'sk_test_fake'}):
+            authenticated_client.get('/access')
+            response, statements = requests_queries(app, authenticated_client, '/access')
+
+        page = response.get_data(as_text=True)
+        assert 'Subscription active: <span class="status no">No</span>' in page
+        assert 'test-access: <span class="status no">No</span>' in page
+        assert len(statements) == 1
+
+    def test_context_does_not_outlive_the_request(self, gated_app, authenticated_client, synced_customer):
+        """Test that a change between requests is seen even when they share an app context."""
+        with gated_app.app_context():
+            assert authenticated_client.get('/stacked').status_code == 200
+
+            replace_entitlements('cus_test123456', [{'lookup_key': 'test-access'}], utc_datetime())
+            db.session.commit()
+
+            assert authenticated_client.get('/stacked').status_code == 302
+
+
+class TestLoadBillingContext:
+    """Tests for what the single query loads."""
+
+    def test_prefers_the_active_subscription(self, app, sample_customer):
+        """Test that a newer cancelled subscription does not hide an active one."""
+        with app.app_context():
+            now = datetime.now(timezone.utc)
+            db.session.add_all([
+                Subscription(stripe_customer_id='cus_test123456', stripe_subscription_id='sub_active',
+                             status='active', product_id='prod_1', price_id='price_1', created_at=now - timedelta(days=30)),
+                Subscription(stripe_customer_id='cus_test123456', stripe_subscription_id='sub_cancelled',
+                             status='cancelled', product_id='prod_1', price_id='price_1', created_at=now),
+            ])
+            db.session.commit()
+
+            billing = load_billing_context(sample_customer.user_id)
+
+            assert billing.subscription.stripe_subscription_id == 'sub_active'
+            assert billing.active_subscription is billing.subscription
+            assert billing.stripe_customer_id == 'cus_test123456'
+
+    def test_user_without_a_customer(self, app, sample_user):
+        with app.app_context():
+            billing = load_billing_context(sample_user.id)
+
+            assert billing.user.id == sample_user.id
+            assert billing.customer is None
+            assert billing.active_subscription is None
+            assert not billing.has_feature('test-access')
+
+    def test_unknown_user(self, app):
+        with app.app_context():
+            assert load_billing_context(404).user is None
+
+
+@pytest.fixture
+def snapshot_app(app):
+    app.config['BILLING_SNAPSHOT_TTL'] = 30
+    return app
+
+
+class TestSessionSnapshot:
+    """Tests for serving the billing context from the signed session cookie."""
+
+    def test_repeat_views_run_no_queries(self, snapshot_app, authenticated_client, synced_customer):
+        authenticated_client.get('/premium')
+
+        response, statements = requests_queries(snapshot_app, authenticated_client, '/premium')
+
+        assert response.status_code == 200
+        assert statements == []
+
+    def test_access_page_runs_no_queries(self, snapshot_app, authenticated_client, synced_customer):
+        with patch.dict(os.environ, {'TEST_STRIPE_SECRET_KEY': 'sk_test_fake'}):
+            authenticated_client.get('/access')
+            response, statements = requests_queries(snapshot_app, authenticated_client, '/access')
+
+        assert b'test-access' in response.data
+        assert statements == []
+
+    def test_webhook_invalidates_the_snapshot(self, snapshot_app, gated_app, authenticated_client, synced_customer):
+        """Test that a change of entitlements is seen on the next view despite the snapshot."""
+        assert authenticated_client.get('/premium').status_code == 200
+
+        with snapshot_app.app_context():
+            dispatcher.dispatch(mock_webhook_event(
+                'entitlements.active_entitlement_summary.updated',
+                {'customer': 'cus_test123456', 'entitlements': {'data': []}}
+            ))
+            db.session.commit()
+
+        response, _ = requests_queries(gated_app, authenticated_client, '/premium')
+        assert response.status_code == 302
+
+    def test_expired_snapshot_is_reloaded(self, snapshot_app, authenticated_client, synced_customer):
+        authenticated_client.get('/premium')
+
+        with patch('app.payments.billing.time.time', return_value=time.time() + 31):
+            response, statements = requests_queries(snapshot_app, authenticated_client, '/premium')
+
+        assert response.status_code == 200
+        assert len(statements) == 1
+
+    def test_unsynced_entitlements_are_not_snapshotted(self, snapshot_app, authenticated_client, synced_customer):
+        """Test that entitlements that would have to come from Stripe are never kept in the cookie."""
+        with snapshot_app.app_context():
+            mark_entitlements_stale('cus_test123456', utc_datetime())
+            db.session.commit()
+
+        with patch.dict(os.environ, {'TEST_STRIPE_SECRET_KEY': 'sk_test_fake'}), \
+                patch('stripe.entitlements.ActiveEntitlementService.list', side_effect=stripe.error.APIConnectionError('down')):
+            authenticated_client.get('/access')
+
+        with authenticated_client.session_transaction() as sess:
+            assert SNAPSHOT_KEY not in sess
+
+    def test_restores_plain_values(self, snapshot_app, authenticated_client, synced_customer):
+        """Test that nothing restored from the cookie is a row that could reach the database session."""
+        @snapshot_app.route('/restored')
+        def restored():
+            billing = billing_context()
+            return f"{type(billing.user).__name__} {billing.user.email} {billing.has_feature('reports')} {len(db.session.new)}"
+
+        authenticated_client.get('/restored')
+        response, _ = requests_queries(snapshot_app, authenticated_client, '/restored')
+
+        assert response.data == b'SnapshotUser test@example.com True 0'
+
+    def test_users_without_a_customer_are_not_snapshotted(self, snapshot_app, authenticated_client, sample_user):
+        """Test that a first checkout is seen on the next view, with no version to bump on the snapshot."""
+        with patch.dict(os.environ, {'TEST_STRIPE_SECRET_KEY': 'sk_test_fake'}):
+            response, _ = requests_queries(snapshot_app, authenticated_client, '/access')
+            assert b'No Stripe customer' in response.data
+            with authenticated_client.session_transaction() as sess:
+                assert SNAPSHOT_KEY not in sess
+
+            with snapshot_app.app_context():
+                db.session.add(Customer(user_id=sample_user.id, stripe_customer_id='cus_new',
+                                        entitlements_synced_at=utc_datetime()))
+                db.session.add(Subscription(stripe_customer_id='cus_new', stripe_subscription_id='sub_new',
+                                            status='active', product_id='prod_1', price_id='price_1'))
+                db.session.commit()
+                entitlement_cache.invalidate('cus_new')
+
+            response, _ = requests_queries(snapshot_app, authenticated_client, '/access')
+            assert b'No Stripe customer' not in response.data
+        with authenticated_client.session_transaction() as sess:
+            assert sess[SNAPSHOT_KEY]['customer'][0] == 'cus_new'
+
+    def test_snapshot_is_dropped_on_logout(self, snapshot_app, authenticated_client, synced_customer):
+        authenticated_client.get('/premium')
+        with authenticated_client.session_transaction() as sess:
+            assert sess[SNAPSHOT_KEY]['user'][1] == 'test@example.com'
+
+        authenticated_client.post('/auth/logout')
+
+        with authenticated_client.session_transaction() as sess:
+            assert SNAPSHOT_KEY not in sess
+
+
+class TestHasActiveAccess:
+    """Tests for deciding access from the stored subscription alone."""
+
+    def set_subscription(self, subscription_id, **values):
+        db.session.execute(
+            db.update(Subscription).where(Subscription.id == subscription_id).values(**values)
+        )
+        db.session.commit()
+
+    @pytest.mark.parametrize('status, period_end_days, expected', [
+        ('active', 10, True),
+        ('trialing', 3, True),
+        # Renewal not paid for yet
+        ('active', -1, False),
+        ('past_due', 10, False),
+        ('cancelled', 10, False),
+        # Recorded before billing periods were stored
+        ('active', None, True),
+    ])
+    def test_status_and_period(self, app, sample_user, sample_subscription, status, period_end_days, expected):
+        with app.app_context():
+            period_end = None if period_end_days is None else utc_datetime() + timedelta(days=period_end_days)
+            self.set_subscription(sample_subscription.id, status=status, current_period_end=period_end)
+            user = db.session.get(User, sample_user.id)
+
+            assert has_active_access(user) is expected
+            assert (load_billing_context(user.id).active_subscription is not None) is expected
+
+    def test_access_at_a_given_time(self, app, sample_user, sample_subscription):
+        with app.app_context():
+            period_end = utc_datetime() + timedelta(days=10)
+            self.set_subscription(sample_subscription.id, current_period_end=period_end)
+            user = db.session.get(User, sample_user.id)
+
+            assert has_active_access(user, at=period_end - timedelta(seconds=1))
+            assert not has_active_access(user, at=period_end)
+
+    def test_one_query(self, app, sample_user, sample_subscription):
+        with app.app_context():
+            user = db.session.get(User, sample_user.id)
+            with count_queries() as statements:
+                assert has_active_access(user)
+
+            assert len(statements) == 1
+
+    def test_user_without_a_customer(self, app, sample_user):
+        with app.app_context():
+            assert not has_active_access(db.session.get(User, sample_user.id))
+            assert not has_active_access(None)
@@ -0,0 +1,222 @@
+"""
+Unit tests for replaying missed Stripe events with `flask stripe catch-up`.
+"""
+import json
+import time
+import pytest
+from app import db
+from app.models import ProcessedEvent, Subscription, SyncCursor, WebhookEvent
+from app.payments.catchup import CURSOR_NAME, _windows, catch_up, fetch_events
+from app.payments.inbox import process_event, record_event
+from app.payments.stripe_client import CircuitOpenError
+from tests.fixtures.stripe_fixtures import (
+    mock_checkout_session,
+    mock_subscription,
+    mock_webhook_event
+)
+from tests.fixtures.stripe_stub import StripeStub
+
+
+def add_checkout(stub, user_id, suffix, created):
+    """Add a customer, subscription and checkout.session.completed event for them to the stub."""
+    stub.add_customer(f'cus_{suffix}')
+    stub.add_subscription(f'sub_{suffix}', f'cus_{suffix}')
+    session = mock_checkout_session(
+        customer_id=f'cus_{suffix}',
+        subscription_id=f'sub_{suffix}',
+        client_reference_id=str(user_id)
+    )
+    event = mock_webhook_event('checkout.session.completed', session, event_id=f'evt_checkout_{suffix}')
+    event['created'] = created
+    return stub.add_event(event)
+
+
+def add_cancellation(stub, suffix, created):
+    event = mock_webhook_event(
+        'customer.subscription.deleted',
+        mock_subscription(subscription_id=f'sub_{suffix}', customer_id=f'cus_{suffix}', status='canceled'),
+        event_id=f'evt_deleted_{suffix}'
+    )
+    event['created'] = created
+    return stub.add_event(event)
+
+
+class TestFetchEvents:
+    """Tests for the concurrent, windowed events list reader."""
+
+    def test_windows_cover_the_range_without_overlap(self):
+        """Test that the time range is split into contiguous windows."""
+        assert _windows(100, 110, 3) == [(100, 104), (104, 107), (107, 110)]
+        assert _windows(100, 102, 8) == [(100, 101), (101, 102)]
+
+    def test_pages_every_window_and_sorts_oldest_first(self, app):
+        """Test that all events are fetched exactly once across windows and pages."""
+        stub = StripeStub()
+        now = int(time.time())
+        for i in range(250):
+            add_cancellation(stub, f'{i:03}', now - 1000 + i * 3)
+        # Not handled by the app, so it is filtered out
+        stub.add_event(dict(mock_webhook_event('charge.refunded', {'id': 'ch_1'}, event_id='evt_charge'), created=now))
+
+        with app.app_context(), stub.patch():
+            events = fetch_events(now - 1000, now + 1, windows=4)
+
+        assert [event['id'] for event in events] == [f'evt_deleted_{i:03}' for i in range(250)]
+        # Four windows of ~63 events each need a second page of 100
+        assert stub.calls['Event.list'] == 4
+
+
+    def test_lists_events_through_the_circuit_breaker(self, app):
+        """Test that an open breaker stops the events list without calling Stripe."""
+        stub = StripeStub()
+        now = int(time.time())
+
+        with app.app_context(), stub.patch():
+            breaker = app.extensions['stripe_client']
+            for _ in range(breaker.failure_threshold):
+                breaker.record_failure()
+
+            with pytest.raises(CircuitOpenError):
+                fetch_events(now - 60, now, windows=2)
+
+        assert stub.calls['Event.list'] == 0
+
+
+def handle_live(event):
+    """Record and process an event the way the webhook endpoint and workers do."""
+    webhook_event = record_event(event['id'], event['type'], json.dumps(event), created=event['created'])
+    assert process_event(webhook_event.id)
+
+
+class TestCatchUp:
+    """Tests for replaying events through the handlers."""
+
+    def test_applies_missed_events_and_stores_cursor(self, app, sample_user):
+        """Test that missed events reach the handlers and the cursor moves to the newest event."""
+        stub = StripeStub()
+        now = int(time.time())
+        add_checkout(stub, sample_user.id, 'a', now - 60)
+        add_checkout(stub, sample_user.id, 'b', now - 30)
+
+        with app.app_context(), stub.patch():
+            result = catch_up(since=now - 3600, workers=1)
+
+            assert result['fetched'] == 2
+            assert result['applied'] == 2
+            assert db.session.scalar(db.select(db.func.count(Subscription.id))) == 2
+            cursor = db.session.get(SyncCursor, CURSOR_NAME)
+            assert cursor.stripe_event_id == 'evt_checkout_b'
+            assert cursor.event_created == now - 30
+
+    def test_events_are_applied_in_order_per_customer(self, app, sample_user):
+        """Test that a cancellation is applied after the checkout that created the subscription."""
+        stub = StripeStub()
+        now = int(time.time())
+        add_cancellation(stub, 'ordered', now - 10)
+        add_checkout(stub, sample_user.id, 'ordered', now - 20)
+
+        with app.app_context(), stub.patch():
+            catch_up(since=now - 3600, workers=1)
+
+            subscription = db.session.scalar(
+                db.select(Subscription).where(Subscription.stripe_subscription_id == 'sub_ordered')
+            )
+            assert subscription.status == 'cancelled'
+
+    def test_resumes_from_cursor_and_skips_handled_events(self, app, sample_user):
+        """Test that a second run only fetches from the cursor and does not reapply anything."""
+        stub = StripeStub()
+        now = int(time.time())
+        add_checkout(stub, sample_user.id, 'first', now - 100)
+
+        with app.app_context(), stub.patch():
+            catch_up(since=now - 3600, workers=1)
+            add_cancellation(stub, 'first', now - 50)
+            result = catch_up(workers=1)
+
+            # The cursor's own event is fetched again but skipped by the ledger
+            assert result['fetched'] == 2
+            assert result['applied'] == 1
+            assert result['skipped'] == 1
+            assert db.session.scalar(db.select(db.func.count(ProcessedEvent.id))) == 2
+
+    def test_live_events_advance_the_cursor(self, app, sample_user):
+        """Test that handled webhooks move the cursor so the next run starts after them."""
+        stub = StripeStub()
+        now = int(time.time())
+        add_checkout(stub, sample_user.id, 'live', now - 600)
+
+        with app.app_context(), stub.patch():
+            catch_up(since=now - 3600, workers=1)
+            handle_live(add_cancellation(stub, 'live', now - 60))
+
+            cursor = db.session.get(SyncCursor, CURSOR_NAME)
+            assert cursor.stripe_event_id == 'evt_deleted_live'
+            assert cursor.event_created == now - 60
+            result = catch_up(workers=1)
+            assert result['fetched'] == 1
+            assert result['applied'] == 0
+
+    def test_live_events_after_a_gap_leave_the_cursor(self, app, sample_user):
+        """Test that an event long after the cursor does not skip the events that may be missing before it."""
+        stub = StripeStub()
+        now = int(time.time())
+        add_checkout(stub, sample_user.id, 'gap', now - 3000)
+        app.config['WEBHOOK_CURSOR_MAX_GAP'] = 900
+
+        with app.app_context(), stub.patch():
+            catch_up(since=now - 3600, workers=1)
+            handle_live(add_cancellation(stub, 'gap', now - 60))
+
+            cursor = db.session.get(SyncCursor, CURSOR_NAME)
+            assert cursor.stripe_event_id == 'evt_checkout_gap'
+            assert cursor.event_created == now - 3000
+
+    def test_requires_a_start_without_cursor(self, app):
+        """Test that the first run has to say where to start."""
+        with app.app_context(), pytest.raises(ValueError):
+            catch_up()
+
+
+class TestCatchUpCommand:
+    """Tests for `flask stripe catch-up`."""
+
+    def test_reports_counts(self, app, runner, sample_user):
+        """Test the summary printed after a replay."""
+        stub = StripeStub()
+        add_checkout(stub, sample_user.id, 'cli', int(time.time()) - 60)
+
+        with stub.patch():
+            result = runner.invoke(args=['stripe', 'catch-up', '--hours', '1'])
+
+        assert result.exit_code == 0
+        assert 'Fetched 1 events' in result.output
+        assert '1 applied' in result.output
+        with app.app_context():
+            assert db.session.scalar(db.select(WebhookEvent.status)) == 'processed'
+
+    def test_first_run_needs_hours(self, runner):
+        """Test the usage error shown before any cursor exists."""
+        result = runner.invoke(args=['stripe', 'catch-up'])
+
+        assert result.exit_code == 2
+        assert '--hours' in result.output
+
+    def test_replays_thousands_of_events_quickly(self, runner):
+        """Test that fetching and applying a large backlog is fast with a slow API."""
+        stub = StripeStub(latency=0.02)
+        now = int(time.time())
+        for i in range(2000):
+            add_cancellation(stub, f'bulk_{i}', now - 7200 + i * 3)
+
+        started = time.perf_counter()
+        with stub.patch():
+            result = runner.invoke(args=['stripe', 'catch-up', '--hours', '3', '--windows', '16'])
+        elapsed = time.perf_counter() - started
+
+        assert result.exit_code == 0, result.output
+        print(f'\n{result.output.strip()}')
+        assert 'Fetched 2000 events' in result.output
+        # At most one partial page per window on top of the 20 full ones, fetched side by side
+        assert stub.calls['Event.list'] <= 20 + 16
+        assert elapsed < 30
@@ -0,0 +1,159 @@
+"""
+Unit tests for the cohort retention snapshots in app/analytics/cohorts.py.
+"""
+import os
+from datetime import date, datetime
+import polars as pl
+import pytest
+from app import db
+from app.analytics.cohorts import (
+    month_index,
+    read_cohorts,
+    retention_counts,
+    retention_matrix,
+    snapshot_months,
+    update_cohorts
+)
+from app.analytics.revenue import CUSTOMERS_SCHEMA
+from app.models import Customer, Subscription
+from tests.test_revenue import at, subscriptions
+
+JAN, FEB, MAR, APR = date(2026, 1, 1), date(2026, 2, 1), date(2026, 3, 1), date(2026, 4, 1)
+
+
+def customers(*created):
+    """A frame as load_customers returns it, with customers cus_1, cus_2 and so on created on the given days."""
+    return pl.DataFrame(
+        [(number, f'cus_{number}', at(day)) for number, day in enumerate(created, 1)],
+        schema=CUSTOMERS_SCHEMA, orient='row'
+    )
+
+
+class TestRetentionCounts:
+    """Tests for counting each cohort's retained customers per month."""
+
+    def test_counts_the_customers_billed_in_each_month(self):
+        frame = subscriptions(
+            dict(customer='cus_1', created=at(date(2026, 1, 5))),
+            # Ended as March began, so last billed in February
+            dict(customer='cus_2', created=at(date(2026, 1, 20)), status='cancelled', ended=at(MAR)),
+            # Two subscriptions in one month count the customer once
+            dict(customer='cus_2', created=at(date(2026, 1, 25)), status='cancelled', ended=at(date(2026, 1, 28))),
+        )
+
+        counts = retention_counts(
+            customers(date(2026, 1, 5), date(2026, 1, 20), date(2026, 2, 3)), frame, month_index(JAN), month_index(MAR)
+        )
+
+        assert counts.rows() == [
+            (JAN, '2026-01', 0, 2, 2),
+            (JAN, '2026-02', 1, 2, 2),
+            (FEB, '2026-02', 0, 1, 0),
+            (JAN, '2026-03', 2, 2, 1),
+            (FEB, '2026-03', 1, 1, 0),
+        ]
+
+    def test_only_counts_the_months_in_the_range(self):
+        counts = retention_counts(customers(date(2025, 12, 1)), subscriptions(dict(created=at(date(2025, 12, 1)))),
+                                  month_index(FEB), month_index(FEB))
+
+        assert counts.select('month', 'months_since', 'retained').rows() == [('2026-02', 2, 1)]
+
+
+@pytest.fixture
+def cohort_data(app, sample_user):
+    """Two January customers, one billed until February and one ongoing, and a March customer never billed."""
+    with app.app_context():
+        for number, created in enumerate([datetime(2026, 1, 5), datetime(2026, 1, 20), datetime(2026, 3, 2)], 1):
+            db.session.add(Customer(user_id=sample_user.id, stripe_customer_id=f'cus_{number}', created_at=created))
+        db.session.flush()
+        for number, ended in ((1, datetime(2026, 2, 10)), (2, None)):
+            db.session.add(Subscription(
+                stripe_customer_id=f'cus_{number}', stripe_subscription_id=f'sub_{number}',
+                status='cancelled' if ended else 'active', product_id='prod_1', price_id='price_1', amount=999,
+                currency='usd', billing_interval='month', billing_interval_count=1,
+                created_at=datetime(2026, 1, 21), ended_at=ended
+            ))
+        db.session.commit()
+
+
+class TestSnapshots:
+    """Tests for writing and reading the Parquet snapshots."""
+
+    def test_writes_a_partition_per_closed_month(self, app, cohort_data, tmp_path):
+        with app.app_context():
+            written = update_cohorts(str(tmp_path), as_of=date(2026, 3, 15))
+
+        assert written == ['2026-01', '2026-02']
+        assert snapshot_months(str(tmp_path)) == ['2026-01', '2026-02']
+        assert os.listdir(tmp_path / 'month=2026-01') == ['cohorts-0.parquet']
+
+    def test_later_runs_only_write_new_months(self, app, cohort_data, tmp_path):
+        with app.app_context():
+            update_cohorts(str(tmp_path), as_of=date(2026, 3, 15))
+            january = tmp_path / 'month=2026-01' / 'cohorts-0.parquet'
+            written_at = january.stat().st_mtime_ns
+
+            assert update_cohorts(str(tmp_path), as_of=date(2026, 3, 31)) == []
+            assert update_cohorts(str(tmp_path), as_of=date(2026, 5, 1)) == ['2026-03', '2026-04']
+
+        assert january.stat().st_mtime_ns == written_at
+        assert snapshot_months(str(tmp_path)) == ['2026-01', '2026-02', '2026-03', '2026-04']
+
+    def test_rebuild_writes_every_month_again(self, app, cohort_data, tmp_path):
+        with app.app_context():
+            update_cohorts(str(tmp_path), as_of=date(2026, 3, 15))
+
+            assert update_cohorts(str(tmp_path), as_of=date(2026, 3, 15), rebuild=True) == ['2026-01', '2026-02']
+
+    def test_reads_the_retention_matrix(self, app, cohort_data, tmp_path):
+        with app.app_context():
+            update_cohorts(str(tmp_path), as_of=APR)
+            update_cohorts(str(tmp_path), as_of=date(2026, 5, 1))
+
+        cohorts = read_cohorts(str(tmp_path))
+        matrix = retention_matrix(cohorts)
+
+        assert cohorts.height == 4 + 2
+        assert matrix.columns == ['cohort', 'customers', '0', '1', '2', '3']
+        assert matrix.rows() == [(JAN, 2, 1.0, 1.0, 0.5, 0.5), (MAR, 1, 0.0, 0.0, None, None)]
+
+    def test_cohort_sizes_are_kept_from_their_first_partition(self, app, cohort_data, sample_user, tmp_path):
+        """Test that a customer added to a snapshotted cohort later does not change its size in new months."""
+        with app.app_context():
+            update_cohorts(str(tmp_path), as_of=APR)
+            db.session.add(Customer(user_id=sample_user.id, stripe_customer_id='cus_late',
+                                    created_at=datetime(2026, 1, 25)))
+            db.session.commit()
+            update_cohorts(str(tmp_path), as_of=date(2026, 5, 1))
+
+        cohorts = read_cohorts(str(tmp_path))
+        january = cohorts.filter(pl.col('cohort') == JAN)
+        assert january['customers'].to_list() == [2, 2, 2, 2]
+        assert retention_matrix(cohorts).height == 2
+
+    def test_no_snapshots(self, tmp_path):
+        assert read_cohorts(str(tmp_path / 'missing')).is_empty()
+
+    def test_no_customers(self, app, tmp_path):
+        with app.app_context():
+            assert update_cohorts(str(tmp_path)) == []
+
+
+class TestCohortsCommand:
+    """Tests for `flask analytics cohorts`."""
+
+    def test_writes_snapshots_and_prints_the_matrix(self, app, runner, cohort_data, tmp_path):
+        app.config['COHORTS_PATH'] = str(tmp_path)
+
+        result = runner.invoke(args=['analytics', 'cohorts'])
+
+        assert result.exit_code == 0
+        assert snapshot_months(str(tmp_path))
+        lines = result.output.splitlines()
+        assert lines[0].startswith('Wrote snapshots for 2026-01, 2026-02')
+        assert lines[2].split()[:4] == ['2026-01', '2', '100%', '100%']
+        # The header's columns end where the rows' do
+        assert lines[1].index('customers') + len('customers') == lines[2].index(' 2 ') + 2
+
+        assert runner.invoke(args=['analytics', 'cohorts']).output.startswith('The snapshots are up to date.')
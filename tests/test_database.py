@@ -0,0 +1,268 @@
+"""
+Unit tests for the database engine profiles.
+"""
+import os
+import time
+from unittest.mock import MagicMock
+import pytest
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import create_app, db
+from app.database import ENGINE_PROFILES, STICKY_KEY, _set_request_timeouts, engine_options, request_settings
+from app.models import Customer, User
+from app.payments.entitlements import entitlement_cache, replace_entitlements, utc_datetime
+from config import TestConfig
+from tests.fixtures.stripe_stub import StripeStub
+
+
+def profile_app(profile, url, options=None):
+    class ProfileConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = url
+        DATABASE_PROFILE = profile
+        SQLALCHEMY_ENGINE_OPTIONS = options or {}
+
+    return create_app(ProfileConfig)
+
+
+def pragma(name):
+    return db.session.execute(db.text(f'PRAGMA {name}')).scalar()
+
+
+class TestEngineOptions:
+    """Tests for turning a profile into create_engine options."""
+
+    def test_postgres_gets_pool_without_connection_timeouts(self):
+        """Test that the timeouts are not set on connect, where they would also hold back migrations and CLI commands."""
+        options = engine_options(ENGINE_PROFILES['postgres'], 'postgresql://app@db.internal/app')
+
+        assert options['pool_size'] == 5
+        assert options['max_overflow'] == 10
+        assert options['pool_pre_ping'] is True
+        assert options['pool_recycle'] == 1800
+        assert 'connect_args' not in options
+        assert request_settings(ENGINE_PROFILES['postgres']) == [('statement_timeout', 5000), ('lock_timeout', 2000)]
+
+    def test_in_memory_sqlite_gets_no_pool_sizes(self):
+        """Test that options the single shared connection's pool rejects are left out."""
+        options = engine_options(ENGINE_PROFILES['postgres'], 'sqlite:///:memory:')
+
+        assert options == {'pool_pre_ping': True, 'pool_recycle': 1800}
+
+    def test_default_profile_sets_nothing(self):
+        assert engine_options(ENGINE_PROFILES['default'], 'postgresql://app@db.internal/app') == {}
+
+
+class TestProfiles:
+    """Tests for applying a profile to the app's engine."""
+
+    def test_sqlite_pragmas_are_set_on_connect(self, tmp_path):
+        app = profile_app('sqlite', 'sqlite:///' + str(tmp_path / 'app.db'))
+        with app.app_context():
+            assert pragma('journal_mode') == 'wal'
+            assert pragma('busy_timeout') == 5000
+            # NORMAL
+            assert pragma('synchronous') == 1
+
+    def test_pool_options_reach_the_engine(self, tmp_path):
+        app = profile_app('postgres', 'sqlite:///' + str(tmp_path / 'app.db'))
+        with app.app_context():
+            pool = db.engine.pool
+
+            assert pool.size() == 5
+            assert pool._pre_ping is True
+            assert pool._recycle == 1800
+
+    def test_config_engine_options_override_the_profile(self, tmp_path):
+        app = profile_app('postgres', 'sqlite:///' + str(tmp_path / 'app.db'), options={'pool_size': 2})
+        with app.app_context():
+            assert db.engine.pool.size() == 2
+
+    def test_unknown_profile(self):
+        with pytest.raises(ValueError):
+            profile_app('oracle', 'sqlite:///:memory:')
+
+
+class TestRequestTimeouts:
+    """Tests for the Postgres timeouts set on each transaction begun in a request."""
+
+    def postgres_connection(self):
+        connection = MagicMock()
+        connection.dialect.name = 'postgresql'
+        return connection
+
+    def test_set_locally_in_a_request(self):
+        app = profile_app('postgres', 'sqlite:///:memory:')
+        connection = self.postgres_connection()
+        with app.test_request_context('/'):
+            _set_request_timeouts(db.session, None, connection)
+
+        assert [call.args[0] for call in connection.exec_driver_sql.call_args_list] == [
+            'SET LOCAL statement_timeout = 5000',
+            'SET LOCAL lock_timeout = 2000'
+        ]
+
+    def test_not_set_outside_a_request(self):
+        """Test that CLI commands, migrations and webhook workers run without the timeouts."""
+        app = profile_app('postgres', 'sqlite:///:memory:')
+        connection = self.postgres_connection()
+        with app.app_context():
+            _set_request_timeouts(db.session, None, connection)
+
+        connection.exec_driver_sql.assert_not_called()
+
+    def test_applied_on_postgres(self):
+        url = os.environ.get('BENCHMARK_DATABASE_URL')
+        if not url:
+            pytest.skip('Set BENCHMARK_DATABASE_URL to check the timeouts on Postgres')
+        app = profile_app('postgres', url)
+        show = db.text('SHOW statement_timeout')
+
+        with app.test_request_context('/'):
+            assert db.session.execute(show).scalar() == '5s'
+            db.session.rollback()
+        with app.app_context():
+            assert db.session.execute(show).scalar() == '0'
+            db.session.rollback()
+
+
+@pytest.fixture
+def replica_app(tmp_path):
+    """
+    An app with a primary and a replica in two SQLite files.
+
+    Both hold the same user and customer, except that the user is named after
+    the database, so a page showing the user's name tells which one it read.
+    """
+    class ReplicaConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'primary.db')
+        REPLICA_DATABASE_URIS = ['sqlite:///' + str(tmp_path / 'replica.db')]
+
+    app = create_app(ReplicaConfig)
+    with app.app_context():
+        for engine, name in ((db.engine, 'Primary'), (db.engines['replica_0'], 'Replica')):
+            db.metadata.create_all(engine)
+            with so.Session(engine) as session:
+                user = User(email='replica@example.com', name=name)
+                user.set_password('password123')
+                session.add(user)
+                session.flush()
+                session.add(Customer(user_id=user.id, stripe_customer_id='cus_replica', entitlement_mask=0))
+                session.commit()
+                app.config['REPLICA_USER_ID'] = user.id
+    return app
+
+
+@pytest.fixture
+def replica_client(replica_app):
+    client = replica_app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(replica_app.config['REPLICA_USER_ID'])
+        sess['_fresh'] = True
+    return client
+
+
+@pytest.fixture
+def stripe_stub():
+    stub = StripeStub()
+    with stub.patch():
+        yield stub
+
+
+def read_from(client):
+    """Which database the index page read the logged-in user from."""
+    page = client.get('/').get_data(as_text=True)
+    return 'primary' if 'Hello, Primary!' in page else 'replica' if 'Hello, Replica!' in page else None
+
+
+class TestReplicaRouting:
+    """Tests for sending reads to replicas and everything else to the primary."""
+
+    def test_get_requests_read_from_the_replica(self, replica_client):
+        assert read_from(replica_client) == 'replica'
+
+    def test_other_methods_read_from_the_primary(self, replica_app):
+        with replica_app.test_request_context('/payments/event', method='POST'):
+            assert db.session.scalar(sa.select(User.name)) == 'Primary'
+
+    def test_outside_a_request_reads_from_the_primary(self, replica_app):
+        """Test that webhook workers and CLI commands see the primary."""
+        with replica_app.app_context():
+            assert db.session.scalar(sa.select(User.name)) == 'Primary'
+
+    def test_writes_go_to_the_primary_and_reads_follow_them(self, replica_app):
+        with replica_app.test_request_context('/'):
+            user = db.session.scalar(sa.select(User))
+            assert user.name == 'Replica'
+
+            user.name = 'Renamed'
+            db.session.commit()
+
+            assert db.session.scalar(sa.select(User.name).execution_options(populate_existing=True)) == 'Renamed'
+            assert db.session.get_bind(clause=sa.select(User)) is db.engine
+        with replica_app.app_context():
+            assert db.session.scalar(sa.select(User.name)) == 'Renamed'
+            with db.engines['replica_0'].connect() as replica:
+                assert replica.scalar(sa.select(User.name)) == 'Replica'
+
+    def test_premium_checks_do_not_write(self, replica_app, replica_client, stripe_stub):
+        """Test that a page view for a customer never synced leaves Stripe and the primary alone."""
+        replica_app.add_url_rule('/upgrade', 'upgrade', lambda: 'Upgrade')
+        stripe_stub.add_entitlements('cus_replica', 'test-access')
+        assert replica_client.get('/premium').status_code == 302
+
+        with replica_client.session_transaction() as sess:
+            assert STICKY_KEY not in sess
+        assert not stripe_stub.calls
+
+    def test_sticky_window_expires(self, replica_client):
+        replica_client.get('/payments/success')
+        assert read_from(replica_client) == 'primary'
+
+        with replica_client.session_transaction() as sess:
+            sess[STICKY_KEY] = int(time.time()) - 1
+        assert read_from(replica_client) == 'replica'
+
+    def test_reads_do_not_stick(self, replica_client):
+        read_from(replica_client)
+
+        with replica_client.session_transaction() as sess:
+            assert STICKY_KEY not in sess
+
+    def test_checkout_success_sticks_to_the_primary(self, replica_client):
+        replica_client.get('/payments/success')
+
+        assert read_from(replica_client) == 'primary'
+
+    def test_billing_change_from_a_webhook_is_read_from_the_primary(self, replica_app, replica_client):
+        """Test that a user whose session snapshot a webhook invalidated reads their new state from the primary."""
+        replica_app.config['BILLING_SNAPSHOT_TTL'] = 30
+        with replica_app.app_context():
+            replace_entitlements('cus_replica', [], utc_datetime())
+            db.session.commit()
+        with replica_app.app_context(), so.Session(db.engines['replica_0']) as replica:
+            replica.execute(sa.update(Customer).values(entitlements_synced_at=utc_datetime()))
+            replica.commit()
+        assert read_from(replica_client) == 'replica'
+
+        with replica_app.app_context():
+            entitlement_cache.invalidate('cus_replica')
+
+        assert read_from(replica_client) == 'primary'
+        with replica_client.session_transaction() as sess:
+            assert sess[STICKY_KEY] > time.time()
+
+    def test_each_request_reads_from_one_replica(self, tmp_path):
+        class ReplicasConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'primary.db')
+            REPLICA_DATABASE_URIS = ['sqlite:///' + str(tmp_path / f'replica_{i}.db') for i in range(3)]
+
+        app = create_app(ReplicasConfig)
+        used = set()
+        for _ in range(30):
+            with app.test_request_context('/'):
+                engines = {db.session.get_bind(clause=sa.select(User)) for _ in range(5)}
+                assert len(engines) == 1
+                used |= engines
+
+        with app.app_context():
+            assert used == {db.engines[f'replica_{i}'] for i in range(3)}
@@ -0,0 +1,129 @@
+"""
+Unit tests for the webhook event dispatcher and the `flask stripe slowest` command.
+"""
+import json
+import pytest
+from unittest.mock import MagicMock
+from app import db
+from app.models import WebhookEvent
+from app.payments.dispatcher import EventDispatcher, LatencyHistogram, dispatcher
+from app.payments import webhook_helpers
+from tests.fixtures.stripe_fixtures import mock_webhook_event
+
+
+class TestEventDispatcher:
+    """Tests for handler registration and dispatch."""
+
+    def test_registered_handlers(self):
+        """Test that webhook_helpers registers the handled event types."""
+        assert dispatcher.handlers['checkout.session.completed'] is webhook_helpers.handle_checkout_session
+        assert dispatcher.handlers['invoice.paid'] is webhook_helpers.handle_invoice_paid
+        assert dispatcher.handlers['invoice.payment_failed'] is webhook_helpers.handle_invoice_payment_failed
+        assert dispatcher.handlers['customer.subscription.deleted'] is webhook_helpers.handle_subscription_cancelled
+        assert dispatcher.handlers['entitlements.active_entitlement_summary.updated'] is webhook_helpers.handle_entitlement_summary_updated
+
+    def test_dispatch_calls_handler_with_data_object(self, app):
+        """Test that the handler receives the event's data object."""
+        events = EventDispatcher()
+        handler = MagicMock()
+        events.on('customer.updated', 'customer.deleted')(handler)
+
+        with app.app_context():
+            elapsed_ms = events.dispatch(mock_webhook_event('customer.deleted', {'id': 'cus_1'}))
+
+        handler.assert_called_once_with({'id': 'cus_1'})
+        assert elapsed_ms >= 0
+
+    def test_duplicate_registration_is_rejected(self):
+        """Test that two handlers cannot claim the same event type."""
+        events = EventDispatcher()
+        events.on('customer.updated')(MagicMock())
+
+        with pytest.raises(ValueError):
+            events.on('customer.updated')(MagicMock())
+
+    def test_unhandled_event_types_are_counted(self, app):
+        """Test that events without a handler are counted rather than raising."""
+        events = EventDispatcher()
+
+        with app.app_context():
+            assert events.dispatch(mock_webhook_event('charge.refunded', {'id': 'ch_1'})) is None
+
+        assert events.stats()['unhandled'] == {'charge.refunded': 1}
+
+    def test_records_successes_failures_and_latency(self, app):
+        """Test that every call is counted and timed per event type."""
+        events = EventDispatcher()
+        events.on('customer.updated')(MagicMock())
+        events.on('customer.deleted')(MagicMock(side_effect=RuntimeError('boom')))
+
+        with app.app_context():
+            events.dispatch(mock_webhook_event('customer.updated', {'id': 'cus_1'}))
+            events.dispatch(mock_webhook_event('customer.updated', {'id': 'cus_1'}))
+            with pytest.raises(RuntimeError):
+                events.dispatch(mock_webhook_event('customer.deleted', {'id': 'cus_1'}))
+
+        stats = events.stats()['handlers']
+        assert stats['customer.updated']['successes'] == 2
+        assert stats['customer.updated']['failures'] == 0
+        assert stats['customer.updated']['count'] == 2
+        assert stats['customer.deleted']['failures'] == 1
+        assert sum(stats['customer.updated']['buckets'].values()) == 2
+
+
+class TestLatencyHistogram:
+    """Tests for the fixed-bucket latency histogram."""
+
+    def test_percentiles_use_bucket_bounds(self):
+        """Test that percentiles resolve to the bucket containing the rank."""
+        histogram = LatencyHistogram()
+        for elapsed_ms in [0.5] * 98 + [40, 300]:
+            histogram.observe(elapsed_ms)
+
+        assert histogram.percentile(0.50) == 1
+        assert histogram.percentile(0.99) == 50
+        assert histogram.percentile(1.0) == 300
+        assert histogram.summary()['max_ms'] == 300
+
+
+class TestSlowestCommand:
+    """Tests for `flask stripe slowest`."""
+
+    def test_lists_event_types_slowest_first(self, app, runner):
+        """Test that event types are ordered by their p99 handler time."""
+        with app.app_context():
+            rows = [
+                ('invoice.paid', 3.0, 'processed'),
+                ('invoice.paid', 4.0, 'processed'),
+                ('checkout.session.completed', 400.0, 'processed'),
+                ('checkout.session.completed', None, 'failed'),
+                ('customer.subscription.deleted', 20.0, 'processed'),
+            ]
+            for i, (event_type, duration_ms, status) in enumerate(rows):
+                db.session.add(WebhookEvent(
+                    stripe_event_id=f'evt_{i}',
+                    event_type=event_type,
+                    payload=json.dumps(mock_webhook_event(event_type, {})),
+                    status=status,
+                    duration_ms=duration_ms
+                ))
+            db.session.commit()
+
+        result = runner.invoke(args=['stripe', 'slowest'])
+
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        assert [line.split()[0] for line in lines[1:]] == [
+            'checkout.session.completed',
+            'customer.subscription.deleted',
+            'invoice.paid'
+        ]
+        # One failed checkout is reported alongside its timings
+        assert lines[1].split()[2] == '1'
+
+    def test_reports_when_nothing_was_handled(self, runner):
+        """Test the message shown for an empty inbox."""
+        result = runner.invoke(args=['stripe', 'slowest'])
+
+        assert result.exit_code == 0
+        assert 'No handled webhook events' in result.output
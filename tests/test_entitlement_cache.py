@@ -0,0 +1,216 @@
+"""
+Unit tests for the per-customer entitlement cache used by requires_feature and /access.
+"""
+import json
+import pytest
+from unittest.mock import patch
+from app import db
+from app.models import Customer
+from app.payments.dispatcher import dispatcher
+from app.payments.entitlements import entitlement_cache, replace_entitlements, utc_datetime
+from tests.fixtures.queries import count_queries
+from tests.fixtures.stripe_fixtures import mock_entitlements_list, mock_subscription, mock_webhook_event
+
+
+def store_entitlements(stripe_customer_id, *lookup_keys):
+    """Sync the customer's stored entitlements as the summary webhook does, and commit."""
+    replace_entitlements(stripe_customer_id, [{'lookup_key': key} for key in lookup_keys], utc_datetime())
+    db.session.commit()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def premium_client(app, sample_user, sample_subscription):
+    """A logged in client for a subscribed user, and a route gated on 'premium_access'."""
+    from app.payments.decorators import requires_feature
+
+    @app.route('/upgrade')
+    def upgrade():
+        return 'Upgrade page', 200
+
+    @app.route('/test-cached-feature')
+    @requires_feature('premium_access')
+    def cached_feature_route():
+        return 'Access granted', 200
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(sample_user.id)
+        sess['_fresh'] = True
+    return client
+
+
+class TestEntitlementCache:
+    """Tests for caching, expiry and invalidation."""
+
+    def test_requests_never_call_stripe(self, app, premium_client):
+        """Test that premium page views for a customer never synced are answered without Stripe."""
+        with patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list:
+            for _ in range(5):
+                assert premium_client.get('/test-cached-feature').status_code == 302
+
+        mock_list.assert_not_called()
+        with app.app_context():
+            stats = entitlement_cache.stats()
+        # Nothing is stored until the summary webhook or a refresh syncs the customer
+        assert stats['misses'] == 1
+        assert stats['stale_served'] == 1
+
+    def test_lookups_only_read(self, app, sample_customer):
+        """Test that a lookup for a customer out of sync neither calls Stripe nor writes."""
+        with app.app_context():
+            store_entitlements('cus_test123456', 'premium_access')
+            db.session.execute(db.update(Customer).values(entitlements_synced_at=None))
+            db.session.commit()
+
+            with patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list, \
+                    patch.object(db.session, 'commit') as commit, count_queries() as statements:
+                assert entitlement_cache.lookup_keys('cus_test123456') == {'premium_access'}
+
+        mock_list.assert_not_called()
+        commit.assert_not_called()
+        assert all(statement.lstrip().upper().startswith('SELECT') for statement in statements)
+
+    def test_entries_expire_after_ttl(self, app, sample_customer):
+        """Test that a cached entry is reloaded once the TTL has passed."""
+        clock = FakeClock()
+        app.extensions['entitlement_cache'].clock = clock
+        with app.app_context():
+            entitlement_cache.lookup_keys('cus_ttl')
+            clock.now += app.config['ENTITLEMENT_CACHE_TTL'] - 1
+            entitlement_cache.lookup_keys('cus_ttl')
+            assert entitlement_cache.stats()['misses'] == 1
+
+            clock.now += 2
+            entitlement_cache.lookup_keys('cus_ttl')
+            assert entitlement_cache.stats()['misses'] == 2
+
+    def test_size_is_bounded(self, app):
+        """Test that the least recently used customers are evicted."""
+        app.extensions['entitlement_cache'].maxsize = 2
+        with app.app_context():
+            for customer_id in ['cus_1', 'cus_2', 'cus_1', 'cus_3']:
+                entitlement_cache.lookup_keys(customer_id)
+
+            assert entitlement_cache.stats()['size'] == 2
+            entitlement_cache.lookup_keys('cus_1')
+            assert entitlement_cache.stats()['misses'] == 3
+            entitlement_cache.lookup_keys('cus_2')
+            assert entitlement_cache.stats()['misses'] == 4
+
+    def test_lookup_racing_an_invalidation_is_not_stored(self, app):
+        """Test that entitlements loaded before an invalidation do not overwrite it."""
+        with app.app_context():
+            def load_then_change(stripe_customer_id):
+                # A webhook for the customer is handled while the lookup reads the database
+                entitlement_cache.invalidate('cus_race')
+                return 0b1, True
+
+            with patch('app.payments.entitlements.load_entitlements', side_effect=load_then_change):
+                assert entitlement_cache.mask('cus_race') == 0b1
+
+            assert entitlement_cache.stats()['size'] == 0
+
+
+class TestWebhookInvalidation:
+    """Tests for dropping cached entitlements when webhooks arrive."""
+
+    @pytest.mark.parametrize('event_type, data_object, status_code', [
+        # The summary carries the new entitlements
+        ('entitlements.active_entitlement_summary.updated', {
+            'object': 'entitlements.active_entitlement_summary',
+            'customer': 'cus_test123456',
+            'entitlements': {'data': []}
+        }, 302),
+        # A subscription change marks them stale, and the stored ones are served until the summary arrives
+        ('customer.subscription.updated', mock_subscription(), 200),
+        # A cancellation ends access straight away, whatever is stored
+        ('customer.subscription.deleted', {'id': 'sub_test123456', 'customer': 'cus_test123456'}, 302),
+    ])
+    def test_webhook_changes_the_next_check(self, app, premium_client, event_type, data_object, status_code):
+        """Test that the next premium page view after the webhook sees the change, without calling Stripe."""
+        with app.app_context():
+            store_entitlements('cus_test123456', 'premium_access')
+
+        with patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list:
+            assert premium_client.get('/test-cached-feature').status_code == 200
+
+            with app.app_context():
+                dispatcher.dispatch(mock_webhook_event(event_type, data_object))
+                db.session.commit()
+
+            response = premium_client.get('/test-cached-feature')
+
+        mock_list.assert_not_called()
+        assert response.status_code == status_code
+
+    def test_payment_failure_drops_cached_entitlements(self, app, sample_subscription):
+        """Test that a failed payment drops the cache entry but keeps the stored entitlements."""
+        with app.app_context():
+            store_entitlements('cus_test123456', 'premium_access')
+            assert entitlement_cache.lookup_keys('cus_test123456') == {'premium_access'}
+
+            dispatcher.dispatch(mock_webhook_event(
+                'invoice.payment_failed',
+                {'id': 'in_test123456', 'subscription': 'sub_test123456', 'customer': 'cus_test123456'}
+            ))
+            db.session.commit()
+            assert entitlement_cache.stats()['size'] == 0
+
+            assert entitlement_cache.lookup_keys('cus_test123456') == {'premium_access'}
+
+    def test_invalidates_when_the_event_commits(self, app, sample_customer):
+        """Test that a request reading the customer before the commit cannot see the new version."""
+        event = mock_webhook_event(
+            'entitlements.active_entitlement_summary.updated',
+            {'customer': 'cus_test123456', 'entitlements': {'data': []}}
+        )
+        with app.app_context():
+            dispatcher.dispatch(event)
+            assert entitlement_cache.version('cus_test123456') == 0
+
+            db.session.commit()
+            assert entitlement_cache.version('cus_test123456') == 1
+
+            dispatcher.dispatch(event)
+            db.session.rollback()
+            assert entitlement_cache.version('cus_test123456') == 1
+
+    def test_other_customers_stay_cached(self, app, sample_customer):
+        """Test that invalidation only affects the customer in the event."""
+        with app.app_context():
+            entitlement_cache.lookup_keys('cus_other')
+            dispatcher.dispatch(mock_webhook_event(
+                'entitlements.active_entitlement_summary.updated',
+                {'customer': 'cus_test123456', 'entitlements': {'data': []}}
+            ))
+            db.session.commit()
+            entitlement_cache.lookup_keys('cus_other')
+
+            stats = entitlement_cache.stats()
+
+        assert (stats['misses'], stats['hits']) == (1, 1)
+
+
+class TestEntitlementMetrics:
+    """Tests for the cache counters on /payments/metrics."""
+
+    def test_metrics_expose_hit_ratio_and_latency(self, app, admin_client):
+        """Test that hit ratio and lookup latency are served from /payments/metrics."""
+        with app.app_context(), patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list:
+            mock_list.return_value = mock_entitlements_list(['premium_access'])
+            entitlement_cache.lookup_keys('cus_metrics')
+            entitlement_cache.lookup_keys('cus_metrics')
+
+        stats = json.loads(admin_client.get('/payments/metrics').data)['entitlement_cache']
+
+        assert stats['hit_ratio'] == pytest.approx(0.5)
+        assert stats['lookup_latency']['count'] == 2
+        assert 'p99_ms' in stats['lookup_latency']
@@ -0,0 +1,201 @@
+"""
+Unit tests for the materialized entitlements table and `flask stripe sync-entitlements`.
+"""
+import json
+import time
+import pytest
+import stripe
+import sqlalchemy as sa
+from unittest.mock import patch
+from app import db
+from app.models import Customer, Entitlement
+from app.payments.dispatcher import EventNotReady, dispatcher
+from app.payments.entitlements import entitlement_cache, utc_datetime
+from app.payments.signature import sign_payload
+from tests.fixtures.queries import count_queries
+from tests.fixtures.stripe_fixtures import mock_entitlements_list, mock_webhook_event
+from tests.fixtures.stripe_stub import StripeStub
+
+
+def summary_event(customer_id, *lookup_keys, created=None, has_more=False):
+    """An entitlements.active_entitlement_summary.updated event carrying the given lookup keys."""
+    event = mock_webhook_event('entitlements.active_entitlement_summary.updated', {
+        'object': 'entitlements.active_entitlement_summary',
+        'customer': customer_id,
+        'entitlements': {
+            'object': 'list',
+            'data': [
+                {
+                    'id': f'ent_{lookup_key}',
+                    'object': 'entitlements.active_entitlement',
+                    'feature': f'feat_{lookup_key}',
+                    'lookup_key': lookup_key
+                }
+                for lookup_key in lookup_keys
+            ],
+            'has_more': has_more
+        }
+    }, event_id=f'evt_summary_{time.monotonic_ns()}')
+    if created is not None:
+        event['created'] = created
+    return event
+
+
+def post_event(client, event):
+    payload = json.dumps(event)
+    return client.post(
+        '/payments/event',
+        data=payload,
+        content_type='application/json',
+        headers={'stripe-signature': sign_payload(payload, 'whsec_test')}
+    )
+
+
+def stored_keys(customer_id='cus_test123456'):
+    return set(db.session.scalars(
+        sa.select(Entitlement.lookup_key).where(Entitlement.stripe_customer_id == customer_id)
+    ))
+
+
+class TestSummaryWebhook:
+    """Tests for materializing entitlements from the summary webhook."""
+
+    def test_replaces_the_customers_entitlements(self, app, client, sample_customer):
+        """Test that each summary leaves exactly its entitlements stored."""
+        post_event(client, summary_event('cus_test123456', 'premium_access', 'reports'))
+        with app.app_context():
+            assert stored_keys() == {'premium_access', 'reports'}
+            entitlement = db.session.scalar(sa.select(Entitlement).filter_by(lookup_key='reports'))
+            assert entitlement.stripe_entitlement_id == 'ent_reports'
+            assert entitlement.feature_id == 'feat_reports'
+
+        post_event(client, summary_event('cus_test123456', 'reports'))
+        with app.app_context():
+            assert stored_keys() == {'reports'}
+            assert db.session.get(Customer, sample_customer.id).entitlements_synced_at is not None
+
+    def test_older_summary_is_skipped(self, app, client, sample_customer):
+        """Test that a summary delivered late does not overwrite a newer one."""
+        now = int(time.time())
+        post_event(client, summary_event('cus_test123456', 'premium_access', created=now))
+        post_event(client, summary_event('cus_test123456', created=now - 60))
+
+        with app.app_context():
+            assert stored_keys() == {'premium_access'}
+
+    def test_summary_before_checkout_is_retried(self, app):
+        """Test that a summary for a customer that does not exist yet is not dropped."""
+        with app.app_context(), pytest.raises(EventNotReady):
+            dispatcher.dispatch(summary_event('cus_unknown', 'premium_access'))
+
+    def test_truncated_summary_is_listed_from_stripe(self, app, client, sample_customer):
+        """Test that a summary with more entitlements than it embeds is completed from Stripe."""
+        with patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list:
+            mock_list.return_value = mock_entitlements_list(['premium_access', 'reports', 'exports'])
+            post_event(client, summary_event('cus_test123456', 'premium_access', has_more=True))
+
+        with app.app_context():
+            assert stored_keys() == {'premium_access', 'reports', 'exports'}
+
+    def test_subscription_change_marks_entitlements_stale(self, app, client, sample_subscription):
+        """Test that a cancellation makes the next check go back to Stripe."""
+        post_event(client, summary_event('cus_test123456', 'premium_access', created=int(time.time()) - 10))
+        post_event(client, mock_webhook_event(
+            'customer.subscription.deleted', {'id': 'sub_test123456', 'customer': 'cus_test123456'},
+            event_id='evt_deleted'
+        ))
+
+        with app.app_context():
+            assert db.session.get(Customer, sample_subscription.customer.id).entitlements_synced_at is None
+
+
+class TestLocalLookups:
+    """Tests for answering access checks from the entitlements table."""
+
+    def test_synced_customer_is_answered_with_one_query(self, app, client, sample_customer):
+        """Test that a check for a synced customer runs one query and never calls Stripe."""
+        post_event(client, summary_event('cus_test123456', 'premium_access'))
+
+        with app.app_context(), patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list:
+            # The first check in a process also loads the feature registry
+            assert entitlement_cache.has_feature('cus_test123456', 'premium_access')
+            entitlement_cache.invalidate('cus_test123456')
+
+            with count_queries() as statements:
+                assert entitlement_cache.has_feature('cus_test123456', 'premium_access')
+
+        mock_list.assert_not_called()
+        assert len(statements) == 1
+        assert 'entitlement_mask' in statements[0]
+
+    def test_never_synced_customer_waits_for_the_sync(self, app, client, sample_customer):
+        """Test that a check for a customer never synced does not ask Stripe, and the summary webhook syncs them."""
+        with app.app_context(), patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list:
+            mock_list.return_value = mock_entitlements_list(['premium_access'])
+            assert entitlement_cache.lookup_keys('cus_test123456') == set()
+            assert stored_keys() == set()
+
+        post_event(client, summary_event('cus_test123456', 'premium_access'))
+
+        with app.app_context():
+            assert entitlement_cache.lookup_keys('cus_test123456') == {'premium_access'}
+        mock_list.assert_not_called()
+
+    def test_stale_entitlements_are_used_when_stripe_is_down(self, app, client, sample_customer):
+        """Test that stored entitlements answer the check if the resync fails."""
+        post_event(client, summary_event('cus_test123456', 'premium_access'))
+        with app.app_context():
+            db.session.execute(sa.update(Customer).values(entitlements_synced_at=None))
+            db.session.commit()
+
+            with patch('stripe.entitlements.ActiveEntitlementService.list') as mock_list:
+                mock_list.side_effect = stripe.error.APIConnectionError('Stripe is down')
+                assert entitlement_cache.lookup_keys('cus_test123456') == {'premium_access'}
+
+
+class TestSyncCommand:
+    """Tests for `flask stripe sync-entitlements`."""
+
+    @pytest.fixture
+    def customers(self, app, sample_user):
+        with app.app_context():
+            db.session.add_all([
+                Customer(user_id=sample_user.id, stripe_customer_id='cus_synced', entitlements_synced_at=utc_datetime()),
+                Customer(user_id=sample_user.id, stripe_customer_id='cus_stale'),
+            ])
+            db.session.add(Entitlement(stripe_customer_id='cus_synced', lookup_key='revoked'))
+            db.session.commit()
+
+    def test_repairs_drift(self, app, runner, customers):
+        """Test that every customer's stored entitlements are made to match Stripe."""
+        stub = StripeStub()
+        stub.add_entitlements('cus_synced', 'premium_access')
+        stub.add_entitlements('cus_stale', 'reports')
+
+        with stub.patch():
+            result = runner.invoke(args=['stripe', 'sync-entitlements', '--workers', '1'])
+
+        assert 'Synced entitlements for 2 customers' in result.output
+        with app.app_context():
+            assert stored_keys('cus_synced') == {'premium_access'}
+            assert stored_keys('cus_stale') == {'reports'}
+
+    def test_stale_only(self, app, runner, customers):
+        """Test that --stale-only skips customers already in sync."""
+        stub = StripeStub()
+
+        with stub.patch():
+            result = runner.invoke(args=['stripe', 'sync-entitlements', '--stale-only', '--workers', '1'])
+
+        assert 'Synced entitlements for 1 customers' in result.output
+        assert stub.calls['ActiveEntitlement.list'] == 1
+
+    def test_reports_failures(self, app, runner, customers):
+        """Test that customers Stripe could not answer for are counted and left as they were."""
+        with patch('stripe.entitlements.ActiveEntitlementService.list', side_effect=stripe.error.APIConnectionError('down')):
+            result = runner.invoke(args=['stripe', 'sync-entitlements', '--workers', '1'])
+
+        assert '0 customers' in result.output
+        assert '2 failed' in result.output
+        with app.app_context():
+            assert stored_keys('cus_synced') == {'revoked'}
@@ -0,0 +1,130 @@
+"""
+Unit tests for the processed-event ledger.
+"""
+import json
+import os
+import pytest
+from unittest.mock import patch, MagicMock
+from app import db
+from app.models import ProcessedEvent, WebhookEvent
+from app.payments.dispatcher import dispatcher
+from app.payments.inbox import record_event, process_event, PROCESSED
+from app.payments.ledger import event_ledger
+from app.payments.signature import sign_payload
+from tests.fixtures.stripe_fixtures import (
+    mock_checkout_session,
+    mock_stripe_customer,
+    mock_subscription,
+    mock_webhook_event
+)
+
+
+def post_event(client, event):
+    payload = json.dumps(event)
+    with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}):
+        return client.post(
+            '/payments/event',
+            data=payload,
+            content_type='application/json',
+            headers={'stripe-signature': sign_payload(payload, 'whsec_test')}
+        )
+
+
+class TestRedelivery:
+    """Tests for duplicate deliveries of the same event."""
+
+    def test_duplicate_checkout_makes_no_stripe_calls_or_writes(self, app, client, sample_user):
+        """Test that a redelivered checkout.session.completed is acknowledged from memory."""
+        with app.app_context():
+            session_obj = mock_checkout_session(
+                customer_id='cus_dupe',
+                subscription_id='sub_dupe',
+                client_reference_id=str(sample_user.id)
+            )
+            event = mock_webhook_event('checkout.session.completed', session_obj, event_id='evt_checkout_dupe')
+
+            with patch('stripe.CustomerService.retrieve') as mock_cust, \
+                 patch('stripe.SubscriptionService.retrieve') as mock_sub:
+                mock_cust.return_value = mock_stripe_customer(customer_id='cus_dupe')
+                mock_sub.return_value = mock_subscription(subscription_id='sub_dupe', customer_id='cus_dupe')
+
+                assert post_event(client, event).status_code == 200
+                calls = mock_cust.call_count + mock_sub.call_count
+
+                with patch('app.payments.webhook.record_event') as mock_record:
+                    response = post_event(client, event)
+
+                assert response.status_code == 200
+                mock_record.assert_not_called()
+                assert mock_cust.call_count + mock_sub.call_count == calls
+
+            assert event_ledger.stats()['hits'] == 1
+            assert db.session.scalar(db.select(db.func.count(ProcessedEvent.id))) == 1
+
+    def test_ledger_entry_skips_handler_after_restart(self, app):
+        """Test that an event in the ledger is not handled again once the LRU has been lost."""
+        with app.app_context():
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_x'}, event_id='evt_restart')
+            db.session.add(ProcessedEvent(stripe_event_id='evt_restart', event_type=event['type']))
+            db.session.commit()
+            webhook_event = record_event(event['id'], event['type'], json.dumps(event))
+
+            mock_handler = MagicMock()
+            with patch.dict(dispatcher.handlers, {'invoice.payment_failed': mock_handler}):
+                assert process_event(webhook_event.id) is True
+
+            mock_handler.assert_not_called()
+            assert db.session.get(WebhookEvent, webhook_event.id).status == PROCESSED
+            # The DB lookup warmed the LRU for the next redelivery
+            assert event_ledger.seen_recently('evt_restart')
+
+    def test_failed_handler_is_not_recorded(self, app):
+        """Test that only successfully handled events enter the ledger."""
+        with app.app_context():
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_x'}, event_id='evt_not_done')
+            webhook_event = record_event(event['id'], event['type'], json.dumps(event))
+
+            mock_handler = MagicMock()
+            with patch.dict(dispatcher.handlers, {'invoice.payment_failed': mock_handler}):
+                mock_handler.side_effect = RuntimeError('boom')
+                process_event(webhook_event.id)
+
+            assert not event_ledger.is_processed('evt_not_done')
+
+
+class TestLedgerCache:
+    """Tests for the in-memory LRU in front of the ledger."""
+
+    def test_lru_is_bounded(self, app):
+        """Test that the least recently used IDs are evicted."""
+        app.extensions['event_ledger'].maxsize = 2
+        with app.app_context():
+            event_ledger.remember('evt_1')
+            event_ledger.remember('evt_2')
+            assert event_ledger.seen_recently('evt_1')
+            event_ledger.remember('evt_3')
+
+            assert event_ledger.seen_recently('evt_1')
+            assert not event_ledger.seen_recently('evt_2')
+            assert event_ledger.stats()['size'] == 2
+
+    def test_metrics_endpoint_exposes_counters(self, app, admin_client):
+        """Test that hit/miss counters are available from /payments/metrics."""
+        with app.app_context():
+            event_ledger.remember('evt_1')
+            event_ledger.seen_recently('evt_1')
+            event_ledger.seen_recently('evt_2')
+
+        response = admin_client.get('/payments/metrics')
+
+        assert response.status_code == 200
+        stats = json.loads(response.data)['event_ledger']
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['hit_ratio'] == pytest.approx(0.5)
+
+    def test_metrics_endpoint_requires_login(self, client):
+        assert client.get('/payments/metrics').status_code == 401
+
+    def test_metrics_endpoint_requires_an_admin(self, authenticated_client):
+        assert authenticated_client.get('/payments/metrics').status_code == 403
@@ -0,0 +1,146 @@
+"""
+Unit tests for the streaming customer and subscription export in app/analytics/export.py.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+import pytest
+from app import db
+from app.analytics import export
+from app.analytics.export import HEADER, export_chunks, parse_cursor
+from app.models import Customer, Subscription, User
+from tests.fixtures.queries import count_queries
+
+
+@pytest.fixture
+def export_data(app, sample_user):
+    """cus_1 with two subscriptions, cus_2 with none and cus_3 with one, each of their own user."""
+    with app.app_context():
+        for number in (1, 2, 3):
+            user = User(email=f'export{number}@example.com', name=f'Export {number}', password_hash='unused')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Customer(user_id=user.id, stripe_customer_id=f'cus_{number}',
+                                    created_at=datetime(2026, 1, number)))
+        db.session.flush()
+        for customer, subscription in ((1, 'sub_1a'), (1, 'sub_1b'), (3, 'sub_3')):
+            db.session.add(Subscription(
+                stripe_customer_id=f'cus_{customer}', stripe_subscription_id=subscription, status='active',
+                product_id='prod_1', price_id='price_1', amount=999, currency='usd', billing_interval='month',
+                billing_interval_count=1, created_at=datetime(2026, 2, 1)
+            ))
+        db.session.commit()
+
+
+@pytest.fixture
+def admin(app):
+    app.config['ADMIN_EMAILS'] = ['test@example.com']
+
+
+def read_csv(text):
+    return list(csv.DictReader(io.StringIO(text), fieldnames=HEADER))
+
+
+class TestExportChunks:
+    """Tests for generating the export in batches."""
+
+    def test_joins_every_customer_to_their_subscriptions(self, app, export_data):
+        with app.app_context():
+            rows = read_csv(''.join(export_chunks()))
+
+        assert list(rows[0].values()) == HEADER
+        assert [(row['stripe_customer_id'], row['stripe_subscription_id']) for row in rows[1:]] == [
+            ('cus_1', 'sub_1a'), ('cus_1', 'sub_1b'), ('cus_2', ''), ('cus_3', 'sub_3')
+        ]
+        assert rows[3]['cursor'] == f"{rows[3]['customer_id']}:0"
+        assert rows[1]['created_at'] == '2026-02-01T00:00:00'
+
+    def test_ndjson(self, app, export_data):
+        with app.app_context():
+            lines = ''.join(export_chunks('ndjson')).splitlines()
+
+        rows = [json.loads(line) for line in lines]
+        assert len(rows) == 4
+        assert (rows[0]['amount'], rows[0]['cancel_at_period_end']) == (999, False)
+        assert rows[2]['stripe_subscription_id'] is None
+
+    def test_yields_a_chunk_per_batch(self, app, export_data, monkeypatch):
+        monkeypatch.setattr(export, 'BATCH_SIZE', 3)
+        with app.app_context():
+            chunks = list(export_chunks('ndjson'))
+
+        assert [len(chunk.splitlines()) for chunk in chunks] == [3, 1]
+
+    def test_resumes_after_a_cursor_without_offset(self, app, export_data):
+        with app.app_context():
+            first = read_csv(''.join(export_chunks(limit=2)))
+            with count_queries() as statements:
+                rest = read_csv(''.join(export_chunks(after=parse_cursor(first[-1]['cursor']), header=False)))
+
+        assert [row['stripe_subscription_id'] for row in first[1:] + rest] == ['sub_1a', 'sub_1b', '', 'sub_3']
+        assert 'OFFSET' not in statements[0]
+
+    @pytest.mark.parametrize('cursor', ['12', '1:x', '1:2:3', ''])
+    def test_invalid_cursor(self, cursor):
+        with pytest.raises(ValueError):
+            parse_cursor(cursor)
+
+
+class TestExportEndpoint:
+    """Tests for GET /analytics/export."""
+
+    def test_streams_csv(self, authenticated_client, admin, export_data):
+        response = authenticated_client.get('/analytics/export')
+
+        assert response.status_code == 200
+        assert response.mimetype == 'text/csv'
+        assert response.headers['Content-Disposition'] == 'attachment; filename=customers.csv'
+        assert len(read_csv(response.get_data(as_text=True))) == 1 + 4
+
+    def test_resumes_without_the_header(self, authenticated_client, admin, export_data):
+        first = authenticated_client.get('/analytics/export?format=ndjson&limit=3').get_data(as_text=True)
+        cursor = json.loads(first.splitlines()[-1])['cursor']
+
+        response = authenticated_client.get(f'/analytics/export?after={cursor}')
+
+        assert response.status_code == 200
+        assert [row['stripe_customer_id'] for row in read_csv(response.get_data(as_text=True))] == ['cus_3']
+
+    @pytest.mark.parametrize('query', ['format=xml', 'after=nope', 'limit=0', 'limit=many'])
+    def test_bad_query(self, authenticated_client, admin, query):
+        response = authenticated_client.get(f'/analytics/export?{query}')
+
+        assert response.status_code == 400
+        assert 'error' in response.get_json()
+
+    def test_requires_login(self, client):
+        assert client.get('/analytics/export').status_code == 401
+
+    def test_requires_an_admin(self, authenticated_client):
+        assert authenticated_client.get('/analytics/export').status_code == 403
+
+
+class TestExportCommand:
+    """Tests for `flask analytics export`."""
+
+    def test_appends_a_resumed_export_to_the_file(self, runner, export_data, tmp_path):
+        output = tmp_path / 'customers.csv'
+        runner.invoke(args=['analytics', 'export', '--output', str(output)])
+        rows = read_csv(output.read_text())
+        # Drop the last two rows, as if the export had stopped there
+        output.write_text(''.join(line for line in output.read_text().splitlines(keepends=True)[:-2]))
+
+        result = runner.invoke(args=['analytics', 'export', '--output', str(output), '--after', rows[-3]['cursor']])
+
+        assert result.exit_code == 0
+        assert read_csv(output.read_text()) == rows
+
+    def test_ndjson_to_standard_output(self, runner, export_data):
+        result = runner.invoke(args=['analytics', 'export', '--format', 'ndjson'])
+
+        assert result.exit_code == 0
+        assert len(result.output.splitlines()) == 4
+
+    def test_invalid_cursor(self, runner):
+        assert runner.invoke(args=['analytics', 'export', '--after', 'nope']).exit_code == 2
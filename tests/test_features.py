@@ -0,0 +1,132 @@
+"""
+Unit tests for the feature registry and entitlement bitmasks.
+"""
+import sys
+import pytest
+from app import db
+from app.models import Customer, Feature
+from app.payments.entitlements import entitlement_cache, replace_entitlements, utc_datetime
+from app.payments.features import MAX_FEATURES, FeatureRegistryFull, feature_registry
+
+
+def register(*lookup_keys):
+    mask = feature_registry.mask_for(lookup_keys)
+    db.session.commit()
+    return mask
+
+
+class TestFeatureRegistry:
+    """Tests for interning lookup keys to bits."""
+
+    def test_bits_are_assigned_once_in_order(self, app):
+        """Test that each lookup key keeps the bit it was first given."""
+        with app.app_context():
+            assert register('a', 'b') == 0b11
+            assert register('c') == 0b100
+            assert register('b', 'c') == 0b110
+            assert dict(db.session.execute(db.select(Feature.lookup_key, Feature.bit)).all()) == {'a': 0, 'b': 1, 'c': 2}
+
+    def test_has_checks_every_feature_with_one_and(self, app):
+        """Test single and multi-feature checks, including keys nobody has."""
+        with app.app_context():
+            register('reports', 'exports', 'api')
+            mask = feature_registry.mask_for(['reports', 'api'])
+
+            assert feature_registry.has(mask, 'reports')
+            assert feature_registry.has(mask, 'reports', 'api')
+            assert not feature_registry.has(mask, 'reports', 'exports')
+            assert not feature_registry.has(mask, 'unregistered')
+            assert feature_registry.has(mask)
+
+    def test_lookup_keys_decodes_a_mask(self, app):
+        with app.app_context():
+            mask = register('reports', 'exports', 'api')
+            assert feature_registry.lookup_keys(mask) == {'reports', 'exports', 'api'}
+            assert feature_registry.lookup_keys(0) == frozenset()
+
+    def test_registry_is_reloaded_only_for_unknown_bits(self, app):
+        """Test that checks do not query the features table once the registry is loaded."""
+        with app.app_context():
+            mask = register('reports')
+            feature_registry.has(mask, 'reports')
+            feature_registry.has(mask, 'reports')
+            assert feature_registry.stats()['reloads'] == 1
+
+            # Registered by another process
+            new_mask = register('exports')
+            assert feature_registry.has(new_mask, 'exports')
+            assert feature_registry.stats()['reloads'] == 2
+
+    def test_reload_swaps_in_a_new_registry(self, app):
+        """Test that a reload leaves the copy other threads may be reading untouched."""
+        with app.app_context():
+            register('reports')
+            feature_registry.reload()
+            before = feature_registry.registry
+
+            register('exports')
+            feature_registry.reload()
+
+            assert dict(before.bits) == {'reports': 0}
+            assert dict(feature_registry.registry.bits) == {'reports': 0, 'exports': 1}
+            with pytest.raises(AttributeError):
+                before.known = 0
+            with pytest.raises(TypeError):
+                before.bits['exports'] = 1
+
+    def test_unregistered_bits_are_skipped(self, app, caplog):
+        """Test that a mask with bits missing from the features table decodes to the features it can name."""
+        with app.app_context():
+            mask = register('reports') | 1 << 40
+
+            assert feature_registry.lookup_keys(mask) == {'reports'}
+            assert 'no registered feature' in caplog.text
+
+    def test_uncommitted_bits_are_not_learned(self, app):
+        """Test that the process's copy only ever holds bits read back from the features table."""
+        with app.app_context():
+            feature_registry.mask_for(['pending'])
+            assert feature_registry.stats()['features'] == 0
+            db.session.rollback()
+
+            mask = register('kept')
+            assert feature_registry.lookup_keys(mask) == {'kept'}
+
+    def test_registry_is_capped_at_63_features(self, app):
+        """Test that the mask never needs more than a signed BIGINT."""
+        with app.app_context():
+            mask = register(*[f'feature-{i}' for i in range(MAX_FEATURES)])
+            assert mask == 2 ** 63 - 1
+
+            with pytest.raises(FeatureRegistryFull):
+                feature_registry.mask_for(['one-too-many'])
+
+
+class TestEntitlementMasks:
+    """Tests for storing and caching customers' entitlements as masks."""
+
+    def test_mask_is_stored_with_the_entitlements(self, app, sample_customer):
+        with app.app_context():
+            replace_entitlements('cus_test123456', [{'lookup_key': 'reports'}, {'lookup_key': 'api'}], utc_datetime())
+            db.session.commit()
+
+            mask = db.session.get(Customer, sample_customer.id).entitlement_mask
+            assert feature_registry.lookup_keys(mask) == {'reports', 'api'}
+            assert entitlement_cache.has_feature('cus_test123456', 'reports', 'api')
+            assert not entitlement_cache.has_feature('cus_test123456', 'exports')
+
+    def test_full_mask_round_trips_through_the_database(self, app, sample_customer):
+        """Test that the highest bit survives a BIGINT column."""
+        with app.app_context():
+            entitlements = [{'lookup_key': f'feature-{i}'} for i in range(MAX_FEATURES)]
+            replace_entitlements('cus_test123456', entitlements, utc_datetime())
+            db.session.commit()
+            db.session.expire_all()
+
+            assert db.session.get(Customer, sample_customer.id).entitlement_mask == 2 ** 63 - 1
+
+    def test_masks_are_small(self):
+        """Test that a customer's cached entitlements take a few bytes, not a set of strings."""
+        lookup_keys = frozenset(f'feature-{i}' for i in range(10))
+        assert sys.getsizeof(2 ** 63 - 1) <= 36
+        assert sys.getsizeof(2 ** 63 - 1) * 10 < sys.getsizeof(lookup_keys)
@@ -7,6 +7,7 @@ import os
 from unittest.mock import patch, MagicMock
 from app import db
 from app.models import User, Customer, Subscription
+from app.payments.signature import sign_payload
 from tests.fixtures.stripe_fixtures import (
     mock_checkout_session,
     mock_billing_portal_session,
@@ -112,11 +113,9 @@ class TestWebhookEvent:
             event = mock_webhook_event('checkout.session.completed', session_obj)
             
             with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}):
-                with patch('app.payments.webhook.stripe.Webhook.construct_event') as mock_construct, \
-                     patch('app.payments.webhook_helpers.stripe.Customer.retrieve') as mock_cust, \
-                     patch('app.payments.webhook_helpers.stripe.Subscription.retrieve') as mock_sub:
+                with patch('stripe.CustomerService.retrieve') as mock_cust, \
+                     patch('stripe.SubscriptionService.retrieve') as mock_sub:
                     
-                    mock_construct.return_value = event
                     mock_cust.return_value = mock_stripe_customer(customer_id='cus_webhook_test')
                     mock_sub.return_value = mock_subscription(
                         subscription_id='sub_webhook_test',
@@ -127,7 +126,7 @@ class TestWebhookEvent:
                         '/payments/event',
                         data=json.dumps(event),
                         content_type='application/json',
-                        headers={'stripe-signature': 'test_sig'}
+                        headers={'stripe-signature': sign_payload(json.dumps(event), 'whsec_test')}
                     )
                     
                     assert response.status_code == 200
@@ -143,45 +142,38 @@ class TestWebhookEvent:
             event = mock_webhook_event('customer.subscription.deleted', sub_obj)
             
             with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}):
-                with patch('app.payments.webhook.stripe.Webhook.construct_event') as mock_construct:
-                    mock_construct.return_value = event
-                    
-                    response = client.post(
-                        '/payments/event',
-                        data=json.dumps(event),
-                        content_type='application/json',
-                        headers={'stripe-signature': 'test_sig'}
-                    )
-                    
-                    assert response.status_code == 200
-                    
-                    # Verify subscription was cancelled
-                    updated_sub = db.session.get(Subscription, sample_subscription.id)
-                    assert updated_sub.status == 'cancelled'
+                response = client.post(
+                    '/payments/event',
+                    data=json.dumps(event),
+                    content_type='application/json',
+                    headers={'stripe-signature': sign_payload(json.dumps(event), 'whsec_test')}
+                )
+                
+                assert response.status_code == 200
+                
+                # Verify subscription was cancelled
+                updated_sub = db.session.get(Subscription, sample_subscription.id)
+                assert updated_sub.status == 'cancelled'
 
     def test_handles_invoice_payment_failed(self, app, client, sample_subscription):
         """Test handling invoice.payment_failed webhook."""
         with app.app_context():
-            # invoice.payment_failed expects subscription_id in the 'id' field
-            invoice_obj = {'id': sample_subscription.stripe_subscription_id}
+            invoice_obj = {'id': 'in_test123456', 'subscription': sample_subscription.stripe_subscription_id}
             event = mock_webhook_event('invoice.payment_failed', invoice_obj)
             
             with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}):
-                with patch('app.payments.webhook.stripe.Webhook.construct_event') as mock_construct:
-                    mock_construct.return_value = event
-                    
-                    response = client.post(
-                        '/payments/event',
-                        data=json.dumps(event),
-                        content_type='application/json',
-                        headers={'stripe-signature': 'test_sig'}
-                    )
-                    
-                    assert response.status_code == 200
-                    
-                    # Verify subscription status was updated
-                    updated_sub = db.session.get(Subscription, sample_subscription.id)
-                    assert updated_sub.status == 'past_due'
+                response = client.post(
+                    '/payments/event',
+                    data=json.dumps(event),
+                    content_type='application/json',
+                    headers={'stripe-signature': sign_payload(json.dumps(event), 'whsec_test')}
+                )
+                
+                assert response.status_code == 200
+                
+                # Verify subscription status was updated
+                updated_sub = db.session.get(Subscription, sample_subscription.id)
+                assert updated_sub.status == 'past_due'
 
 
 class TestBillingPortal:
@@ -0,0 +1,230 @@
+"""
+Unit tests for the unit-of-work and upsert helpers used by the webhook handlers.
+"""
+import json
+from datetime import date, datetime
+import pytest
+import sqlalchemy as sa
+from app import db
+from app.models import Customer, DailyRevenue, Subscription, User, WebhookEvent
+from app.payments.inbox import record_event, process_event, PENDING
+from app.payments.persistence import unit_of_work, upsert
+from app.payments.webhook_helpers import handle_checkout_session
+from tests.fixtures.stripe_fixtures import (
+    mock_checkout_session,
+    mock_stripe_customer,
+    mock_subscription,
+    mock_webhook_event
+)
+
+
+def expanded_checkout(user_id, suffix):
+    """A checkout session with its customer and subscription already expanded, so no Stripe calls are made."""
+    session = mock_checkout_session(client_reference_id=str(user_id))
+    session['customer'] = mock_stripe_customer(customer_id=f'cus_{suffix}')
+    session['subscription'] = mock_subscription(subscription_id=f'sub_{suffix}', customer_id=f'cus_{suffix}')
+    return session
+
+
+class StatementLog:
+    """Collects the SQL statements and commits issued on the engine."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.commits = 0
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def _on_commit(self, conn):
+        self.commits += 1
+
+    def __enter__(self):
+        sa.event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        sa.event.listen(self.engine, 'commit', self._on_commit)
+        return self
+
+    def __exit__(self, *exc_info):
+        sa.event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+        sa.event.remove(self.engine, 'commit', self._on_commit)
+
+
+class TestUpsert:
+    """Tests for the ON CONFLICT upsert helper."""
+
+    def test_inserts_then_updates_only_given_columns(self, app, sample_user):
+        """Test that a conflicting upsert only overwrites update_columns."""
+        with app.app_context():
+            values = dict(
+                user_id=sample_user.id,
+                stripe_customer_id='cus_upsert',
+                created_at=datetime(2026, 1, 1),
+                customer_name='First'
+            )
+            upsert(Customer, values, ['stripe_customer_id'], ['customer_name'])
+            customer = upsert(
+                Customer,
+                dict(values, created_at=datetime(2026, 6, 1), customer_name='Second'),
+                ['stripe_customer_id'],
+                ['customer_name']
+            )
+
+            assert customer.customer_name == 'Second'
+            assert customer.created_at == datetime(2026, 1, 1)
+            assert db.session.scalar(sa.select(sa.func.count(Customer.id))) == 1
+
+    def test_do_nothing_without_update_columns(self, app, sample_customer):
+        """Test that an upsert without update_columns leaves an existing row alone."""
+        with app.app_context():
+            result = upsert(
+                Customer,
+                dict(
+                    user_id=sample_customer.user_id,
+                    stripe_customer_id=sample_customer.stripe_customer_id,
+                    created_at=datetime(2026, 1, 1),
+                    customer_name='Ignored'
+                ),
+                ['stripe_customer_id']
+            )
+
+            assert result is None
+            assert db.session.get(Customer, sample_customer.id).customer_name == 'Test User'
+
+    def test_refreshes_loaded_instance(self, app, sample_customer):
+        """Test that an instance already in the session sees the upserted values."""
+        with app.app_context():
+            customer = db.session.get(Customer, sample_customer.id)
+            upsert(
+                Customer,
+                dict(
+                    user_id=customer.user_id,
+                    stripe_customer_id=customer.stripe_customer_id,
+                    created_at=customer.created_at,
+                    customer_name='Refreshed'
+                ),
+                ['stripe_customer_id'],
+                ['customer_name']
+            )
+
+            assert customer.customer_name == 'Refreshed'
+
+    def test_increment_columns_add_to_the_existing_row(self, app):
+        with app.app_context():
+            key = dict(day=date(2026, 1, 1), currency='usd', product_id='prod_1', price_id='price_1')
+            for change in (5, -2):
+                row = upsert(DailyRevenue, dict(key, mrr_change=change * 100, subscriptions_change=change),
+                             list(key), increment_columns=['mrr_change', 'subscriptions_change'])
+
+            assert (row.mrr_change, row.subscriptions_change) == (300, 3)
+
+
+class TestUnitOfWork:
+    """Tests for one transaction per webhook event."""
+
+    def test_rolls_back_everything_on_error(self, app, sample_user):
+        """Test that a failure after the customer upsert leaves no customer behind."""
+        with app.app_context():
+            session = expanded_checkout(sample_user.id, 'atomic')
+            session['subscription']['items']['data'] = []
+
+            with pytest.raises(IndexError):
+                with unit_of_work():
+                    handle_checkout_session(session)
+
+            assert db.session.scalar(
+                sa.select(Customer).where(Customer.stripe_customer_id == 'cus_atomic')
+            ) is None
+
+    def test_failed_event_leaves_no_partial_state(self, app, sample_user):
+        """Test that process_event rolls back the handler's writes and keeps the event for retry."""
+        with app.app_context():
+            session = expanded_checkout(sample_user.id, 'partial')
+            session['subscription']['items']['data'] = []
+            event = mock_webhook_event('checkout.session.completed', session, event_id='evt_partial')
+            webhook_event = record_event(event['id'], event['type'], json.dumps(event))
+
+            assert process_event(webhook_event.id) is False
+
+            assert db.session.scalar(sa.select(sa.func.count(Customer.id))) == 0
+            assert db.session.get(WebhookEvent, webhook_event.id).status == PENDING
+
+    def test_checkout_is_one_commit_without_selects(self, app, sample_user):
+        """Test that a checkout event is applied with one commit and no SELECT before writing."""
+        with app.app_context():
+            event = mock_webhook_event(
+                'checkout.session.completed',
+                expanded_checkout(sample_user.id, 'commits'),
+                event_id='evt_commits'
+            )
+            webhook_event = record_event(event['id'], event['type'], json.dumps(event))
+
+            with StatementLog(db.engine) as log:
+                assert process_event(webhook_event.id) is True
+
+            # One commit claims the event, one applies it
+            assert log.commits == 2
+            assert not [s for s in log.statements if s.startswith('SELECT') and 'FROM customers' in s]
+            assert not [s for s in log.statements if s.startswith('SELECT') and 'FROM subscriptions' in s]
+
+    def test_replayed_checkout_is_idempotent(self, app, sample_user):
+        """Test that applying the same checkout twice does not hit the unique constraint."""
+        with app.app_context():
+            session = expanded_checkout(sample_user.id, 'replay')
+
+            with unit_of_work():
+                handle_checkout_session(session)
+            with unit_of_work():
+                handle_checkout_session(session)
+
+            assert db.session.scalar(sa.select(sa.func.count(Subscription.id))) == 1
+
+
+class TestThroughput:
+    """Compare the unit-of-work handler against the old select-then-insert, commit-per-step pattern."""
+
+    @staticmethod
+    def legacy_checkout(session):
+        stripe_customer = session['customer']
+        stripe_subscription = session['subscription']
+        customer = db.session.scalar(
+            sa.select(Customer).where(Customer.stripe_customer_id == stripe_customer['id'])
+        )
+        if not customer:
+            db.session.add(Customer(
+                user_id=int(session['client_reference_id']),
+                stripe_customer_id=stripe_customer['id'],
+                created_at=datetime.fromtimestamp(stripe_customer['created']),
+                customer_name=stripe_customer['name']
+            ))
+            db.session.commit()
+        else:
+            customer.customer_name = stripe_customer['name']
+            db.session.commit()
+        db.session.add(Subscription(
+            stripe_customer_id=stripe_customer['id'],
+            stripe_subscription_id=stripe_subscription['id'],
+            status=stripe_subscription['status'],
+            product_id='prod_test123',
+            price_id='price_test123',
+            created_at=datetime.fromtimestamp(stripe_subscription['created'])
+        ))
+        db.session.commit()
+
+    def test_unit_of_work_commits_once_without_selects(self, app, sample_user):
+        """Test that one upserting transaction per event costs half the commits and none of the SELECTs."""
+        events = 20
+        with app.app_context():
+            with StatementLog(db.engine) as legacy:
+                for i in range(events):
+                    self.legacy_checkout(expanded_checkout(sample_user.id, f'legacy_{i}'))
+
+            with StatementLog(db.engine) as uow:
+                for i in range(events):
+                    with unit_of_work():
+                        handle_checkout_session(expanded_checkout(sample_user.id, f'uow_{i}'))
+
+        # Each commit is a sync on a file database, and each SELECT a round trip before the writes
+        assert (legacy.commits, uow.commits) == (2 * events, events)
+        assert len([s for s in legacy.statements if s.startswith('SELECT')]) == events
+        assert not [s for s in uow.statements if s.startswith('SELECT')]
@@ -0,0 +1,204 @@
+"""
+Query plan regression tests for the hot lookups in models.py, decorators.py, webhook_helpers.py and the export.
+
+Each test runs a hot path, captures the statements it ran and fails if the
+database plans to read any table in full for them. Tests run on SQLite and,
+when BENCHMARK_DATABASE_URL points at a scratch Postgres database, on Postgres.
+"""
+import os
+import pytest
+from app import create_app, db
+from app.analytics.export import export_chunks
+from app.models import Customer, Subscription, User
+from app.payments.billing import ACTIVE_STATUSES, has_active_access
+from app.payments.dispatcher import dispatcher
+from app.payments.entitlements import mark_entitlements_stale, refresh_entitlements, replace_entitlements, utc_datetime
+from config import TestConfig
+from tests.fixtures.queries import capture_queries, full_scans, sorts
+from tests.fixtures.stripe_fixtures import (
+    mock_checkout_session,
+    mock_invoice,
+    mock_stripe_customer,
+    mock_subscription,
+    mock_webhook_event
+)
+from tests.fixtures.stripe_stub import StripeStub
+
+BACKENDS = ['sqlite', 'postgres']
+
+# Read in full on purpose: each process loads the feature registry into memory, see app/payments/features.py
+FULL_SCANS_ALLOWED = {'features'}
+
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def database_url(backend):
+    if backend == 'sqlite':
+        return 'sqlite:///:memory:'
+    url = os.environ.get('BENCHMARK_DATABASE_URL')
+    if not url:
+        pytest.skip('Set BENCHMARK_DATABASE_URL to check query plans on Postgres')
+    return url
+
+
+@pytest.fixture(params=BACKENDS)
+def plan_app(request):
+    """An app with one user, customer and active subscription on the given backend."""
+    class PlanConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = database_url(request.param)
+
+    app = create_app(PlanConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(email='plans@example.com', name='Plans')
+        user.set_password('password123')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Customer(user_id=user.id, stripe_customer_id='cus_plans'))
+        db.session.flush()
+        db.session.add(Subscription(stripe_customer_id='cus_plans', stripe_subscription_id='sub_plans',
+                                    status='active', product_id='prod_1', price_id='price_1'))
+        db.session.commit()
+        app.config['PLAN_USER_ID'] = user.id
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def plan_client(plan_app):
+    client = plan_app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(plan_app.config['PLAN_USER_ID'])
+        sess['_fresh'] = True
+    return client
+
+
+@pytest.fixture
+def stripe_stub():
+    stub = StripeStub()
+    stub.add_entitlements('cus_plans', 'test-access')
+    with stub.patch():
+        yield stub
+
+
+def assert_no_full_scans(statements):
+    """Explain every captured read, update and delete, and fail listing any that scans a table."""
+    explained = [
+        (statement, parameters) for statement, parameters in statements
+        if statement.lstrip().split(None, 1)[0].upper() in EXPLAINED
+    ]
+    assert explained, 'nothing to explain'
+
+    scans = {}
+    for statement, parameters in explained:
+        found = [line for table, line in full_scans(statement, parameters) if table not in FULL_SCANS_ALLOWED]
+        if found:
+            scans[' '.join(statement.split())] = found
+    assert not scans, scans
+
+
+class TestAccessCheckPlans:
+    """Plans of the queries behind load_user and @requires_feature."""
+
+    def test_gated_page_for_a_synced_customer(self, plan_app, plan_client):
+        with plan_app.app_context():
+            replace_entitlements('cus_plans', [{'lookup_key': 'test-access'}], utc_datetime())
+            db.session.commit()
+            with capture_queries() as statements:
+                assert plan_client.get('/premium').status_code == 200
+
+            assert_no_full_scans(statements)
+
+    def test_gated_page_for_a_stale_customer(self, plan_app, plan_client, stripe_stub):
+        """Test that a customer whose entitlements are not in sync is answered from the stored ones."""
+        with plan_app.app_context():
+            replace_entitlements('cus_plans', [{'lookup_key': 'test-access'}], utc_datetime())
+            mark_entitlements_stale('cus_plans', utc_datetime())
+            db.session.commit()
+            with capture_queries() as statements:
+                assert plan_client.get('/premium').status_code == 200
+
+            assert not stripe_stub.calls
+            assert_no_full_scans(statements)
+
+    def test_refresh_from_stripe(self, plan_app, stripe_stub):
+        """Test the lookups and writes made when a stale customer's entitlements are refreshed."""
+        with plan_app.app_context():
+            with capture_queries() as statements:
+                refresh_entitlements('cus_plans')
+
+            assert stripe_stub.calls['ActiveEntitlement.list'] == 1
+            assert_no_full_scans(statements)
+
+    def test_has_active_access(self, plan_app):
+        with plan_app.app_context():
+            user = db.session.get(User, plan_app.config['PLAN_USER_ID'])
+            with capture_queries() as statements:
+                assert has_active_access(user)
+
+            assert_no_full_scans(statements)
+
+    def test_active_subscribers(self, plan_app):
+        with plan_app.app_context(), capture_queries() as statements:
+            db.session.scalar(
+                db.select(db.func.count()).select_from(Subscription).where(Subscription.status.in_(ACTIVE_STATUSES))
+            )
+
+            assert_no_full_scans(statements)
+
+
+class TestWebhookHandlerPlans:
+    """Plans of the queries the webhook handlers run."""
+
+    def checkout_session(self, plan_app):
+        session = mock_checkout_session(customer_id='cus_new', subscription_id='sub_new',
+                                        client_reference_id=str(plan_app.config['PLAN_USER_ID']))
+        session['customer'] = mock_stripe_customer(customer_id='cus_new')
+        session['subscription'] = mock_subscription(subscription_id='sub_new', customer_id='cus_new')
+        return session
+
+    @pytest.mark.parametrize('event_type, data_object', [
+        ('customer.subscription.deleted', {'id': 'sub_plans', 'customer': 'cus_plans'}),
+        ('invoice.payment_failed', {'id': 'in_plans', 'subscription': 'sub_plans', 'customer': 'cus_plans'}),
+        # Unknown subscription, so the handler also looks it up
+        ('invoice.payment_failed', {'id': 'in_unknown', 'subscription': 'sub_unknown', 'customer': 'cus_plans'}),
+        ('invoice.paid', mock_invoice(subscription_id='sub_plans', customer_id='cus_plans')),
+        ('customer.subscription.updated', mock_subscription(subscription_id='sub_plans', customer_id='cus_plans')),
+        ('customer.subscription.trial_will_end', mock_subscription(
+            subscription_id='sub_plans', customer_id='cus_plans', status='trialing'
+        )),
+        ('entitlements.active_entitlement_summary.updated', {
+            'customer': 'cus_plans', 'entitlements': {'data': [{'lookup_key': 'test-access'}]}
+        }),
+    ])
+    def test_handler(self, plan_app, event_type, data_object):
+        with plan_app.app_context():
+            with capture_queries() as statements:
+                dispatcher.dispatch(mock_webhook_event(event_type, data_object))
+                db.session.commit()
+
+            assert_no_full_scans(statements)
+
+    def test_checkout_session_completed(self, plan_app):
+        with plan_app.app_context():
+            with capture_queries() as statements:
+                dispatcher.dispatch(mock_webhook_event('checkout.session.completed', self.checkout_session(plan_app)))
+                db.session.commit()
+
+            assert_no_full_scans(statements)
+
+
+class TestExportPlans:
+    """Plans of the keyset query behind the streaming export."""
+
+    def test_resumed_export_reads_in_index_order(self, plan_app):
+        """Test that resuming from a cursor seeks to it and needs no sort."""
+        with plan_app.app_context():
+            customer_id = db.session.scalar(db.select(Customer.id))
+            with capture_queries() as statements:
+                ''.join(export_chunks(after=(customer_id, 0), header=False))
+
+            assert_no_full_scans(statements)
+            assert not sorts(*statements[0])
@@ -0,0 +1,359 @@
+"""
+Unit tests for the MRR, ARR and churn analytics in app/analytics/revenue.py.
+"""
+from datetime import date, datetime
+from unittest.mock import patch
+import polars as pl
+import pytest
+from app import db
+from app.analytics import revenue
+from app.analytics.revenue import (
+    PLAN_CHANGES_SCHEMA,
+    SUBSCRIPTIONS_SCHEMA,
+    load_plan_changes,
+    load_subscriptions,
+    revenue_movements,
+    revenue_report,
+    split_at_plan_changes,
+    unix_seconds
+)
+from app.models import Subscription, SubscriptionPrice
+from app.payments.dispatcher import dispatcher
+from tests.fixtures.queries import capture_queries
+from tests.fixtures.stripe_fixtures import mock_subscription, mock_webhook_event
+
+JAN, FEB, MAR = date(2026, 1, 1), date(2026, 2, 1), date(2026, 3, 1)
+DEC = date(2025, 12, 1)
+
+
+def at(day):
+    return unix_seconds(day)
+
+
+def subscriptions(*rows):
+    """
+    A frame as load_subscriptions returns it, from rows giving only the columns that matter to the test.
+
+    Customers are named in the rows and numbered in order of appearance. Subscriptions are
+    named sub_1, sub_2 and so on unless the rows name them.
+    """
+    defaults = dict(customer='cus_1', customer_created=at(DEC), status='active', product_id='prod_1',
+                    price_id='price_1', amount=1000, currency='usd',
+                    billing_interval='month', billing_interval_count=1, created=at(DEC), trial_end=None,
+                    ended=None, period_end=None, plan_from=None, plan_until=None)
+    customers = {}
+    rows = [{**defaults, 'subscription': f'sub_{number}', **row} for number, row in enumerate(rows, 1)]
+    for row in rows:
+        row['customer'] = customers.setdefault(row['customer'], len(customers) + 1)
+    return pl.DataFrame(rows, schema=SUBSCRIPTIONS_SCHEMA)
+
+
+def plan_changes(*rows):
+    """A frame as load_plan_changes returns it, from rows giving only the columns that matter to the test."""
+    defaults = dict(product_id='prod_1', price_id='price_1', amount=1000, currency='usd',
+                    billing_interval='month', billing_interval_count=1)
+    return pl.DataFrame([{**defaults, **row} for row in rows], schema=PLAN_CHANGES_SCHEMA)
+
+
+def only_period(frame):
+    assert frame.height == 1
+    return frame.row(0, named=True)
+
+
+class TestRevenueMovements:
+    """Tests for MRR and its movements between the start and end of a range."""
+
+    def test_classifies_each_customers_change(self):
+        frame = subscriptions(
+            # Unchanged
+            dict(customer='cus_steady'),
+            # New in the range
+            dict(customer='cus_new', amount=2000, created=at(date(2026, 1, 15))),
+            # Churned in the range
+            dict(customer='cus_gone', amount=500, status='cancelled', ended=at(date(2026, 1, 10))),
+            # Upgraded by replacing their subscription
+            dict(customer='cus_up', status='cancelled', ended=at(date(2026, 1, 20))),
+            dict(customer='cus_up', amount=3000, created=at(date(2026, 1, 20))),
+            # Moved from a yearly plan worth 1000 a month to 500 a month
+            dict(customer='cus_down', amount=12000, billing_interval='year', status='cancelled',
+                 ended=at(date(2026, 1, 5))),
+            dict(customer='cus_down', amount=500, created=at(date(2026, 1, 5))),
+        )
+
+        period = only_period(revenue_movements(frame, JAN, FEB))
+
+        assert period['mrr_start'] == 1000 + 500 + 1000 + 1000
+        assert period['mrr_end'] == 1000 + 2000 + 3000 + 500
+        assert period['arr'] == period['mrr_end'] * 12
+        assert (period['new_mrr'], period['expansion_mrr']) == (2000, 2000)
+        assert (period['contraction_mrr'], period['churned_mrr']) == (500, 500)
+        assert period['mrr_end'] == (period['mrr_start'] + period['new_mrr'] + period['expansion_mrr']
+                                     - period['contraction_mrr'] - period['churned_mrr'])
+        assert (period['customers_start'], period['customers_end']) == (4, 4)
+        assert (period['new_customers'], period['churned_customers']) == (1, 1)
+        assert period['logo_churn'] == 0.25
+
+    def test_plan_changes_in_place_are_expansion_and_contraction(self):
+        frame = subscriptions(
+            dict(customer='cus_up', subscription='sub_up', amount=3000),
+            dict(customer='cus_down', subscription='sub_down', amount=400),
+            dict(customer='cus_steady'),
+        )
+        changes = plan_changes(
+            dict(subscription='sub_up', effective=at(DEC)),
+            dict(subscription='sub_up', effective=at(date(2026, 1, 20)), price_id='price_3', amount=3000),
+            dict(subscription='sub_down', effective=at(DEC)),
+            dict(subscription='sub_down', effective=at(date(2026, 1, 5)), price_id='price_4', amount=400),
+        )
+
+        period = only_period(revenue_movements(split_at_plan_changes(frame, changes), JAN, FEB))
+
+        assert (period['mrr_start'], period['mrr_end']) == (3000, 3000 + 400 + 1000)
+        assert (period['expansion_mrr'], period['contraction_mrr']) == (2000, 600)
+        assert (period['new_mrr'], period['churned_mrr']) == (0, 0)
+
+    def test_each_plan_is_billed_until_the_next_takes_effect(self):
+        frame = subscriptions(dict(subscription='sub_up', amount=3000))
+        changes = plan_changes(
+            dict(subscription='sub_up', effective=at(DEC)),
+            dict(subscription='sub_up', effective=at(date(2026, 2, 10)), amount=3000),
+        )
+
+        report = revenue_movements(split_at_plan_changes(frame, changes), JAN, MAR, by='month')
+
+        assert report['mrr_end'].to_list() == [1000, 3000]
+        assert report['expansion_mrr'].to_list() == [0, 2000]
+
+    def test_billing_intervals_are_spread_over_months(self):
+        frame = subscriptions(
+            dict(customer='cus_year', amount=12000, billing_interval='year'),
+            dict(customer='cus_quarter', amount=3000, billing_interval_count=3),
+            dict(customer='cus_week', amount=100, billing_interval='week'),
+        )
+
+        period = only_period(revenue_movements(frame, JAN, FEB))
+
+        assert period['mrr_end'] == pytest.approx(1000 + 1000 + 100 * 52 / 12, abs=0.01)
+
+    def test_trials_count_from_their_end(self):
+        frame = subscriptions(
+            dict(customer='cus_converted', status='active', trial_end=at(date(2026, 1, 14))),
+            dict(customer='cus_trialing', status='trialing', trial_end=at(date(2026, 2, 14))),
+            dict(customer='cus_quit_in_trial', status='cancelled', trial_end=at(date(2026, 1, 14)),
+                 ended=at(date(2026, 1, 7))),
+        )
+
+        period = only_period(revenue_movements(frame, JAN, FEB))
+
+        assert (period['mrr_start'], period['new_mrr'], period['mrr_end']) == (0, 1000, 1000)
+
+    def test_unbilled_subscriptions_are_left_out(self):
+        frame = subscriptions(
+            dict(customer='cus_incomplete', status='incomplete'),
+            dict(customer='cus_unpriced', amount=None, billing_interval=None),
+            dict(customer='cus_paid'),
+        )
+
+        assert only_period(revenue_movements(frame, JAN, FEB))['customers_end'] == 1
+
+    def test_cancelled_rows_without_an_end_time_end_with_their_period(self):
+        frame = subscriptions(dict(status='cancelled', period_end=at(date(2026, 1, 20))))
+
+        period = only_period(revenue_movements(frame, JAN, FEB))
+
+        assert (period['mrr_start'], period['churned_mrr'], period['mrr_end']) == (1000, 1000, 0)
+
+    def test_currencies_are_kept_apart(self):
+        frame = subscriptions(dict(customer='cus_us'), dict(customer='cus_eu', currency='eur', amount=800))
+
+        report = revenue_movements(frame, JAN, FEB)
+
+        assert dict(report.select('currency', 'mrr_end').iter_rows()) == {'eur': 800, 'usd': 1000}
+
+    def test_range_broken_down_by_month(self):
+        frame = subscriptions(
+            dict(customer='cus_jan', created=at(date(2026, 1, 15))),
+            dict(customer='cus_feb', created=at(date(2026, 2, 15)), status='cancelled', ended=at(date(2026, 2, 20))),
+            dict(customer='cus_feb', created=at(date(2026, 2, 25))),
+        )
+
+        report = revenue_movements(frame, JAN, MAR, by='month')
+
+        assert report['start'].to_list() == [JAN, FEB]
+        assert report['end'].to_list() == [FEB, MAR]
+        assert report['mrr_start'].to_list() == [0, 1000]
+        assert report['mrr_end'].to_list() == [1000, 2000]
+        # Left and came back within February, so only its state at the boundaries counts
+        assert report['new_customers'].to_list() == [1, 1]
+
+    def test_partial_last_period(self):
+        report = revenue_movements(subscriptions({}), JAN, date(2026, 1, 10), by='week')
+
+        assert report['end'].to_list()[-1] == date(2026, 1, 10)
+        assert report.height == 2
+
+    def test_empty_range(self):
+        with pytest.raises(ValueError):
+            revenue_movements(subscriptions({}), FEB, JAN)
+
+
+class TestLoadSubscriptions:
+    """Tests for reading subscriptions into a frame."""
+
+    def test_reads_timestamps_as_unix_seconds(self, app, sample_customer):
+        with app.app_context():
+            db.session.add(Subscription(
+                stripe_customer_id=sample_customer.stripe_customer_id, stripe_subscription_id='sub_loaded',
+                status='cancelled', product_id='prod_1', price_id='price_1', amount=999, currency='usd',
+                billing_interval='month', billing_interval_count=1, created_at=datetime(2026, 1, 2, 3, 4, 5),
+                ended_at=datetime(2026, 2, 1)
+            ))
+            db.session.commit()
+
+            row = load_subscriptions().row(0, named=True)
+
+        assert row['created'] == at(date(2026, 1, 2)) + 3 * 3600 + 4 * 60 + 5
+        assert row['ended'] == at(FEB)
+        assert row['trial_end'] is None
+        assert (row['customer'], row['amount'], row['currency']) == (sample_customer.id, 999, 'usd')
+        assert row['customer_created'] is not None
+
+    def test_sees_subscriptions_not_yet_flushed(self, app, sample_customer):
+        with app.app_context():
+            db.session.add(Subscription(
+                stripe_customer_id=sample_customer.stripe_customer_id, stripe_subscription_id='sub_pending',
+                status='active', product_id='prod_1', price_id='price_1'
+            ))
+
+            assert load_subscriptions().height == 1
+
+    def test_billed_since_goes_through_the_bind_processors(self, app, sample_customer):
+        """Test that the cutoff reaches the driver as the column type stores it, not via sqlite3's own adapter."""
+        with app.app_context():
+            for suffix, ended_at in (('old', datetime(2026, 1, 31, 23, 59)), ('kept', datetime(2026, 2, 1))):
+                db.session.add(Subscription(
+                    stripe_customer_id=sample_customer.stripe_customer_id, stripe_subscription_id=f'sub_{suffix}',
+                    status='cancelled', product_id='prod_1', price_id='price_1', ended_at=ended_at
+                ))
+            db.session.commit()
+
+            with capture_queries() as statements:
+                loaded = load_subscriptions(billed_since=datetime(2026, 2, 1))
+
+        assert loaded['subscription'].to_list() == ['sub_kept']
+        parameters = [value for _, params in statements for value in params]
+        if db.engines[None].dialect.name == 'sqlite':
+            assert '2026-02-01 00:00:00.000000' in parameters
+        else:
+            assert datetime(2026, 2, 1) in parameters
+
+    def test_no_subscriptions(self, app):
+        with app.app_context():
+            assert load_subscriptions().is_empty()
+
+
+@pytest.fixture
+def priced_subscription(app, sample_customer):
+    with app.app_context():
+        db.session.add(Subscription(
+            stripe_customer_id=sample_customer.stripe_customer_id, stripe_subscription_id='sub_priced',
+            status='active', product_id='prod_1', price_id='price_1', amount=999, currency='usd',
+            billing_interval='month', billing_interval_count=1, created_at=datetime(2026, 1, 15)
+        ))
+        db.session.commit()
+
+
+class TestPriceHistory:
+    """Tests for recording plan changes and reporting them from the price history."""
+
+    def upgrade(self, day):
+        subscription = mock_subscription(subscription_id='sub_priced', product_id='prod_1', price_id='price_2')
+        subscription['items']['data'][0]['price']['unit_amount'] = 2999
+        event = mock_webhook_event('customer.subscription.updated', subscription)
+        event['created'] = at(day)
+        dispatcher.dispatch(event)
+
+    def test_plan_change_is_recorded_when_it_took_effect(self, app, priced_subscription):
+        with app.app_context():
+            self.upgrade(date(2026, 2, 10))
+
+            history = db.session.execute(
+                db.select(SubscriptionPrice.effective_at, SubscriptionPrice.price_id, SubscriptionPrice.amount)
+                .order_by(SubscriptionPrice.effective_at)
+            ).all()
+
+        assert history == [(datetime(2026, 1, 15), 'price_1', 999), (datetime(2026, 2, 10), 'price_2', 2999)]
+
+    def test_report_counts_the_change_as_expansion(self, app, priced_subscription):
+        with app.app_context():
+            self.upgrade(date(2026, 2, 10))
+
+            report = revenue_report(JAN, MAR, by='month')
+
+        assert [(p['mrr_end'], p['expansion_mrr']) for p in report] == [(999.0, 0.0), (2999.0, 2000.0)]
+
+    def test_report_reads_subscriptions_billed_since_its_start(self, app, priced_subscription):
+        with app.app_context(), patch.object(revenue, 'load_subscriptions', wraps=load_subscriptions) as loaded:
+            revenue_report(FEB, MAR)
+
+        assert loaded.call_args.kwargs['billed_since'] == datetime(2026, 2, 1)
+
+    def test_history_of_subscriptions_ended_before_is_left_out(self, app, priced_subscription):
+        with app.app_context():
+            self.upgrade(date(2026, 2, 10))
+            db.session.execute(db.update(Subscription).values(status='cancelled', ended_at=datetime(2026, 3, 1)))
+
+            assert load_plan_changes(datetime(2026, 3, 1)).height == 2
+            assert load_plan_changes(datetime(2026, 3, 2)).is_empty()
+
+
+class TestRevenueEndpoint:
+    """Tests for GET /analytics/revenue."""
+
+    URL = '/analytics/revenue?start=2026-01-01&end=2026-03-01&by=month'
+
+    def test_returns_periods(self, app, authenticated_client, priced_subscription):
+        app.config['ADMIN_EMAILS'] = ['test@example.com']
+
+        response = authenticated_client.get(self.URL)
+
+        assert response.status_code == 200
+        periods = response.get_json()['periods']
+        assert [(p['start'], p['mrr_end'], p['new_customers']) for p in periods] == [
+            ('2026-01-01', 999.0, 1), ('2026-02-01', 999.0, 0)
+        ]
+
+    def test_requires_login(self, client):
+        assert client.get(self.URL).status_code == 401
+
+    def test_requires_an_admin(self, authenticated_client):
+        assert authenticated_client.get(self.URL).status_code == 403
+
+    @pytest.mark.parametrize('query', ['start=2026-01-01', 'start=2026-13-01&end=2026-02-01',
+                                       'start=2026-01-01&end=2026-02-01&by=year'])
+    def test_bad_query(self, app, authenticated_client, query):
+        app.config['ADMIN_EMAILS'] = ['test@example.com']
+
+        response = authenticated_client.get(f'/analytics/revenue?{query}')
+
+        assert response.status_code == 400
+        assert 'error' in response.get_json()
+
+
+class TestRevenueCommand:
+    """Tests for `flask analytics revenue`."""
+
+    def test_prints_each_period(self, runner, priced_subscription):
+        result = runner.invoke(args=['analytics', 'revenue', '--start', '2026-01-01', '--end', '2026-03-01',
+                                     '--by', 'month'])
+
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        assert len(lines) == 3
+        assert lines[1].split()[:4] == ['usd', '2026-01-01', '2026-02-01', '999.00']
+
+    def test_no_revenue(self, runner):
+        result = runner.invoke(args=['analytics', 'revenue', '--start', '2026-01-01', '--end', '2026-02-01'])
+
+        assert result.exit_code == 0
+        assert 'No recurring revenue' in result.output
@@ -0,0 +1,252 @@
+"""
+Unit tests for the daily revenue rollups in app/analytics/rollups.py.
+"""
+from datetime import date, datetime
+import pytest
+from app import db
+from app.analytics.revenue import unix_seconds
+from app.analytics.rollups import daily_revenue, rebuild_rollups
+from app.models import DailyRevenue, Subscription
+from app.payments.dispatcher import dispatcher
+from tests.fixtures.queries import count_queries
+from tests.fixtures.stripe_fixtures import (
+    mock_checkout_session,
+    mock_stripe_customer,
+    mock_subscription,
+    mock_webhook_event
+)
+
+
+def noon(day):
+    return unix_seconds(day) + 12 * 3600
+
+
+def rollup_rows():
+    return set(db.session.execute(db.select(
+        DailyRevenue.day, DailyRevenue.currency, DailyRevenue.product_id, DailyRevenue.price_id,
+        DailyRevenue.mrr_change, DailyRevenue.subscriptions_change
+    ).where(db.or_(DailyRevenue.mrr_change != 0, DailyRevenue.subscriptions_change != 0))).all())
+
+
+class Events:
+    """Dispatches webhook events created at noon on given days, in order."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.sent = 0
+
+    def send(self, event_type, data_object, day):
+        self.sent += 1
+        event = mock_webhook_event(event_type, data_object, event_id=f'evt_rollups_{self.sent}')
+        event['created'] = noon(day)
+        dispatcher.dispatch(event)
+
+    def checkout(self, subscription, day):
+        session = mock_checkout_session(client_reference_id=str(self.user_id))
+        session['customer'] = mock_stripe_customer(customer_id=subscription['customer'])
+        session['subscription'] = subscription
+        self.send('checkout.session.completed', session, day)
+
+
+def stripe_subscription(subscription_id, day, status='active', price_id='price_monthly', amount=999,
+                        interval='month', **fields):
+    subscription = mock_subscription(subscription_id=subscription_id, customer_id=f'cus_{subscription_id}',
+                                     status=status, product_id='prod_1', price_id=price_id)
+    price = subscription['items']['data'][0]['price']
+    price.update(unit_amount=amount, recurring={'interval': interval, 'interval_count': 1})
+    subscription.update(created=noon(day), **fields)
+    return subscription
+
+
+@pytest.fixture
+def events(app, sample_user):
+    return Events(sample_user.id)
+
+
+class TestIncrementalRollups:
+    """Tests for keeping the rollups up to date from the webhook handlers."""
+
+    def test_checkout_adds_the_subscription_from_its_first_day(self, app, events):
+        with app.app_context():
+            events.checkout(stripe_subscription('sub_a', date(2026, 1, 10)), date(2026, 1, 10))
+
+            assert rollup_rows() == {(date(2026, 1, 10), 'usd', 'prod_1', 'price_monthly', 99900, 1)}
+
+    def test_matches_a_rebuild_after_a_history_of_changes(self, app, events):
+        with app.app_context():
+            events.checkout(stripe_subscription('sub_a', date(2026, 1, 10)), date(2026, 1, 10))
+            events.checkout(stripe_subscription('sub_b', date(2026, 1, 12), status='trialing',
+                                                trial_end=noon(date(2026, 1, 26))), date(2026, 1, 12))
+            events.checkout(stripe_subscription('sub_c', date(2026, 1, 12)), date(2026, 1, 12))
+            # An upgrade in place to a yearly price
+            events.send('customer.subscription.updated',
+                        stripe_subscription('sub_a', date(2026, 1, 10), price_id='price_yearly', amount=10000,
+                                            interval='year'),
+                        date(2026, 2, 1))
+            events.send('customer.subscription.deleted',
+                        {'id': 'sub_b', 'customer': 'cus_sub_b', 'ended_at': noon(date(2026, 2, 10))},
+                        date(2026, 2, 10))
+            events.send('invoice.payment_failed', {'id': 'in_c', 'subscription': 'sub_c', 'customer': 'cus_sub_c'},
+                        date(2026, 2, 11))
+            # Cancelled during its trial, so never billed
+            events.checkout(stripe_subscription('sub_d', date(2026, 2, 1), status='trialing',
+                                                trial_end=noon(date(2026, 2, 15))), date(2026, 2, 1))
+            events.send('customer.subscription.deleted',
+                        {'id': 'sub_d', 'customer': 'cus_sub_d', 'ended_at': noon(date(2026, 2, 5))},
+                        date(2026, 2, 5))
+
+            incremental = rollup_rows()
+            rebuild_rollups()
+
+            assert rollup_rows() == incremental
+            # The upgrade moved sub_a from the monthly to the yearly price on the day it was made
+            assert (date(2026, 1, 10), 'usd', 'prod_1', 'price_monthly', 99900, 1) in incremental
+            assert (date(2026, 2, 1), 'usd', 'prod_1', 'price_monthly', -99900, -1) in incremental
+            assert (date(2026, 2, 1), 'usd', 'prod_1', 'price_yearly', 83333, 1) in incremental
+            assert (date(2026, 2, 10), 'usd', 'prod_1', 'price_monthly', -99900, -1) in incremental
+
+    def test_plan_changes_leave_earlier_days_alone(self, app, events):
+        with app.app_context():
+            events.checkout(stripe_subscription('sub_a', date(2026, 1, 10)), date(2026, 1, 10))
+            events.send('customer.subscription.updated',
+                        stripe_subscription('sub_a', date(2026, 1, 10), price_id='price_pro', amount=1999),
+                        date(2026, 2, 1))
+            events.send('customer.subscription.updated',
+                        stripe_subscription('sub_a', date(2026, 1, 10), price_id='price_team', amount=4999),
+                        date(2026, 3, 1))
+            events.send('customer.subscription.deleted',
+                        {'id': 'sub_a', 'customer': 'cus_sub_a', 'ended_at': noon(date(2026, 3, 20))},
+                        date(2026, 3, 20))
+
+            incremental = rollup_rows()
+            rebuild_rollups()
+
+            assert rollup_rows() == incremental
+            assert incremental == {
+                (date(2026, 1, 10), 'usd', 'prod_1', 'price_monthly', 99900, 1),
+                (date(2026, 2, 1), 'usd', 'prod_1', 'price_monthly', -99900, -1),
+                (date(2026, 2, 1), 'usd', 'prod_1', 'price_pro', 199900, 1),
+                (date(2026, 3, 1), 'usd', 'prod_1', 'price_pro', -199900, -1),
+                (date(2026, 3, 1), 'usd', 'prod_1', 'price_team', 499900, 1),
+                (date(2026, 3, 20), 'usd', 'prod_1', 'price_team', -499900, -1),
+            }
+
+    def test_stale_events_leave_the_rollups_alone(self, app, events):
+        with app.app_context():
+            events.checkout(stripe_subscription('sub_a', date(2026, 1, 10)), date(2026, 1, 10))
+            events.send('customer.subscription.updated',
+                        stripe_subscription('sub_a', date(2026, 1, 10), amount=1999), date(2026, 2, 1))
+            before = rollup_rows()
+
+            events.send('customer.subscription.deleted', {'id': 'sub_a', 'customer': 'cus_sub_a'}, date(2026, 1, 20))
+
+            assert rollup_rows() == before
+
+    def test_status_changes_that_keep_billing_write_nothing(self, app, events):
+        with app.app_context():
+            events.checkout(stripe_subscription('sub_a', date(2026, 1, 10)), date(2026, 1, 10))
+
+            with count_queries() as statements:
+                events.send('invoice.payment_failed', {'id': 'in_a', 'subscription': 'sub_a', 'customer': 'cus_sub_a'},
+                            date(2026, 2, 1))
+
+            assert not [s for s in statements if 'daily_revenue' in s]
+
+
+@pytest.fixture
+def rollups(app, sample_customer):
+    """Rollups for a monthly plan from 10 January and a yearly one billed 1 to 20 February."""
+    with app.app_context():
+        db.session.add_all([
+            Subscription(stripe_customer_id=sample_customer.stripe_customer_id, stripe_subscription_id='sub_monthly',
+                         status='active', product_id='prod_1', price_id='price_monthly', amount=999, currency='usd',
+                         billing_interval='month', billing_interval_count=1, created_at=datetime(2026, 1, 10, 9)),
+            Subscription(stripe_customer_id=sample_customer.stripe_customer_id, stripe_subscription_id='sub_yearly',
+                         status='cancelled', product_id='prod_1', price_id='price_yearly', amount=12000,
+                         currency='usd', billing_interval='year', billing_interval_count=1,
+                         created_at=datetime(2026, 2, 1), ended_at=datetime(2026, 2, 20)),
+        ])
+        rebuild_rollups()
+        db.session.commit()
+
+
+class TestDailyRevenue:
+    """Tests for reading MRR and active subscriptions per day from the rollups."""
+
+    def test_carries_totals_over_days_without_changes(self, app, rollups):
+        with app.app_context():
+            days = daily_revenue(date(2026, 1, 9), date(2026, 3, 1))
+
+        by_day = {row['day']: row for row in days.to_dicts()}
+        assert len(by_day) == 51
+        assert (by_day[date(2026, 1, 9)]['mrr'], by_day[date(2026, 1, 9)]['subscriptions']) == (0, 0)
+        assert (by_day[date(2026, 1, 31)]['mrr'], by_day[date(2026, 1, 31)]['subscriptions']) == (999, 1)
+        assert (by_day[date(2026, 2, 19)]['mrr'], by_day[date(2026, 2, 19)]['subscriptions']) == (1999, 2)
+        assert by_day[date(2026, 2, 19)]['arr'] == 1999 * 12
+        assert by_day[date(2026, 2, 28)]['mrr'] == 999
+
+    def test_per_plan(self, app, rollups):
+        with app.app_context():
+            days = daily_revenue(date(2026, 2, 25), date(2026, 2, 26), per_plan=True)
+
+        # The yearly plan had no revenue in the range
+        assert days.select('price_id', 'mrr', 'subscriptions').rows() == [('price_monthly', 999, 1)]
+
+    def test_reads_only_the_rollups(self, app, rollups):
+        with app.app_context(), count_queries() as statements:
+            daily_revenue(date(2026, 1, 1), date(2026, 3, 1))
+
+        assert len(statements) == 1
+        assert 'FROM daily_revenue' in statements[0]
+        assert 'FROM subscriptions' not in statements[0]
+
+    def test_empty_range(self, app):
+        with app.app_context(), pytest.raises(ValueError):
+            daily_revenue(date(2026, 2, 1), date(2026, 2, 1))
+
+
+class TestDailyEndpoint:
+    """Tests for GET /analytics/daily."""
+
+    URL = '/analytics/daily?start=2026-02-19&end=2026-02-21'
+
+    def test_returns_days(self, app, authenticated_client, rollups):
+        app.config['ADMIN_EMAILS'] = ['test@example.com']
+
+        response = authenticated_client.get(self.URL)
+
+        assert response.status_code == 200
+        assert [(d['day'], d['mrr'], d['subscriptions']) for d in response.get_json()['days']] == [
+            ('2026-02-19', 1999.0, 2), ('2026-02-20', 999.0, 1)
+        ]
+
+    def test_per_plan(self, app, authenticated_client, rollups):
+        app.config['ADMIN_EMAILS'] = ['test@example.com']
+
+        days = authenticated_client.get(f'{self.URL}&per_plan=1').get_json()['days']
+
+        assert {d['price_id'] for d in days} == {'price_monthly', 'price_yearly'}
+
+    def test_requires_an_admin(self, authenticated_client):
+        assert authenticated_client.get(self.URL).status_code == 403
+
+    def test_bad_query(self, app, authenticated_client):
+        app.config['ADMIN_EMAILS'] = ['test@example.com']
+
+        assert authenticated_client.get('/analytics/daily?start=2026-02-19').status_code == 400
+
+
+class TestRebuildCommand:
+    """Tests for `flask analytics rebuild-rollups`."""
+
+    def test_replaces_the_rollups(self, app, runner, rollups):
+        with app.app_context():
+            db.session.execute(db.update(DailyRevenue).values(mrr_change=0))
+            db.session.commit()
+
+        result = runner.invoke(args=['analytics', 'rebuild-rollups'])
+
+        assert result.exit_code == 0
+        assert '3 rows' in result.output
+        with app.app_context():
+            assert daily_revenue(date(2026, 1, 31), date(2026, 2, 1))['mrr'].to_list() == [999]
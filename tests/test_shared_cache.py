@@ -0,0 +1,230 @@
+"""
+Unit tests for the entitlement cache shared by worker processes through a SQLite file.
+"""
+import os
+import random
+import subprocess
+import sys
+import tracemalloc
+import pytest
+from app import create_app, db
+from app.models import Customer, User
+from app.payments.entitlements import _EntitlementCache, _SharedEntitlementCache, entitlement_cache
+from config import TestConfig
+from tests.fixtures.queries import count_queries
+from tests.fixtures.stripe_stub import StripeStub
+from tests.test_entitlement_cache import store_entitlements
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'entitlement_cache.db')
+
+
+def worker(cache_path, **kwargs):
+    """The cache as one gunicorn worker on the host opens it."""
+    return _SharedEntitlementCache(cache_path, kwargs.pop('maxsize', 100), kwargs.pop('ttl', 60), **kwargs)
+
+
+def lookup(cache, customer_id, mask=0b1):
+    """Read through the cache the way EntitlementCache.mask does; True on a hit."""
+    cached, version = cache.get(customer_id)
+    if cached is None:
+        cache.put(customer_id, mask, version)
+    return cached is not None
+
+
+class TestSharedEntitlementCache:
+    """Tests for sharing, expiry and invalidation across processes."""
+
+    def test_workers_share_entries(self, cache_path):
+        """Test that an entry loaded by one worker is a hit in another."""
+        first, second = worker(cache_path), worker(cache_path)
+
+        assert not lookup(first, 'cus_shared', 2 ** 63 - 1)
+        assert second.get('cus_shared') == (2 ** 63 - 1, None)
+        assert second.stats()['size'] == 1
+
+    def test_invalidation_reaches_other_processes(self, cache_path):
+        """Test that a webhook handled by another process drops the entry for this one."""
+        cache = worker(cache_path)
+        lookup(cache, 'cus_webhook')
+
+        subprocess.run(
+            [sys.executable, '-c',
+             'import sys; from app.payments.entitlements import _SharedEntitlementCache; '
+             '_SharedEntitlementCache(sys.argv[1], 100, 60).invalidate("cus_webhook")',
+             cache_path],
+            cwd=ROOT, check=True
+        )
+
+        mask, version = cache.get('cus_webhook')
+        assert mask is None
+        assert version == cache.version('cus_webhook') != 0
+
+    def test_lookup_racing_an_invalidation_in_another_worker_is_not_stored(self, cache_path):
+        first, second = worker(cache_path), worker(cache_path)
+        _, version = first.get('cus_race')
+        second.invalidate('cus_race')
+
+        first.put('cus_race', 0b1, version)
+
+        assert first.stats()['size'] == 0
+        assert lookup(first, 'cus_race') is False
+        assert second.get('cus_race')[0] == 0b1
+
+    def test_versions_are_pruned_after_version_ttl(self, cache_path):
+        clock = FakeClock()
+        cache = worker(cache_path, ttl=60, version_ttl=120, clock=clock)
+        cache.invalidate('cus_old')
+
+        clock.now += 119
+        lookup(cache, 'cus_1')
+        assert cache.version('cus_old') != 0
+        clock.now += 2
+        lookup(cache, 'cus_2')
+
+        assert cache.version('cus_old') == 0
+        rows, = cache._connection().execute('SELECT count(*) FROM invalidations').fetchone()
+        assert rows == 0
+
+    def test_versions_do_not_repeat_once_pruned(self, cache_path):
+        """Test that a copy kept from before a pruned invalidation is still out of date after the next one."""
+        clock = FakeClock()
+        cache = worker(cache_path, ttl=60, clock=clock)
+        cache.invalidate('cus_again')
+        kept = cache.version('cus_again')
+
+        clock.now += 61
+        cache.invalidate('cus_other')
+        assert cache.version('cus_again') == 0
+        cache.invalidate('cus_again')
+
+        assert cache.version('cus_again') not in (0, kept)
+
+    def test_entries_expire_after_ttl(self, cache_path):
+        clock = FakeClock()
+        cache = worker(cache_path, ttl=60, clock=clock)
+        lookup(cache, 'cus_ttl')
+
+        clock.now += 59
+        assert lookup(cache, 'cus_ttl')
+        clock.now += 2
+        assert not lookup(cache, 'cus_ttl')
+
+    def test_size_is_bounded(self, cache_path):
+        """Test that the entries closest to expiry are evicted once the cache is full."""
+        clock = FakeClock()
+        cache = worker(cache_path, maxsize=2, clock=clock)
+        for customer_id in ['cus_1', 'cus_2', 'cus_3']:
+            clock.now += 1
+            lookup(cache, customer_id)
+
+        assert cache.stats()['size'] == 2
+        assert cache.get('cus_1')[0] is None
+        assert cache.get('cus_3')[0] == 0b1
+
+
+class TestSharedBackend:
+    """Tests for selecting the backend through the app config."""
+
+    def make_app(self, cache_path, tmp_path):
+        """An app as one worker runs it, on the database the workers share."""
+        class WorkerConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'app.db')
+            ENTITLEMENT_CACHE_BACKEND = 'sqlite'
+            ENTITLEMENT_CACHE_PATH = cache_path
+
+        app = create_app(WorkerConfig)
+        with app.app_context():
+            db.create_all()
+        return app
+
+    def test_second_worker_does_not_query_the_database(self, cache_path, tmp_path):
+        """Test that a customer looked up in one worker is answered from the file in the next."""
+        first, second = self.make_app(cache_path, tmp_path), self.make_app(cache_path, tmp_path)
+        with first.app_context():
+            user = User(email='tabs@example.com', name='Tabs')
+            user.set_password('password123')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Customer(user_id=user.id, stripe_customer_id='cus_tabs'))
+            store_entitlements('cus_tabs', 'test-access')
+
+        stub = StripeStub()
+        with stub.patch():
+            for app in (first, second):
+                with app.app_context():
+                    with count_queries() as statements:
+                        assert entitlement_cache.lookup_keys('cus_tabs') == {'test-access'}
+                    stats = entitlement_cache.stats()
+
+        assert not [statement for statement in statements if 'customer' in statement]
+        assert not stub.calls
+        assert (stats['backend'], stats['hits'], stats['misses']) == ('sqlite', 1, 0)
+
+    def test_unknown_backend(self):
+        class BadConfig(TestConfig):
+            ENTITLEMENT_CACHE_BACKEND = 'redis'
+
+        with pytest.raises(ValueError):
+            create_app(BadConfig)
+
+
+class TestComparedWithPerProcessCaches:
+    """Hit rate and memory of one shared cache against a cache in each worker."""
+
+    WORKERS = 4
+    CUSTOMERS = 500
+    LOOKUPS = 8000
+
+    def trace(self):
+        """Lookups skewed towards a few busy customers, each served by a random worker."""
+        rng = random.Random(5803)
+        customers = [f'cus_{i:05d}' for i in range(self.CUSTOMERS)]
+        weights = [1 / (rank + 1) for rank in range(self.CUSTOMERS)]
+        return [
+            (rng.randrange(self.WORKERS), customer_id)
+            for customer_id in rng.choices(customers, weights, k=self.LOOKUPS)
+        ]
+
+    def replay(self, caches, trace):
+        hits = sum(lookup(caches[worker_index], customer_id) for worker_index, customer_id in trace)
+        return hits / len(trace)
+
+    def test_shared_cache_loads_each_customer_once(self, cache_path):
+        trace = self.trace()
+        unique_customers = len({customer_id for _, customer_id in trace})
+
+        tracemalloc.start()
+        per_process = [_EntitlementCache(10000, 60) for _ in range(self.WORKERS)]
+        per_process_hit_ratio = self.replay(per_process, trace)
+        per_process_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        shared = [worker(cache_path, maxsize=10000) for _ in range(self.WORKERS)]
+        shared_hit_ratio = self.replay(shared, trace)
+        shared[0]._connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        shared_bytes = os.path.getsize(cache_path)
+
+        per_process_loads = sum(cache.misses for cache in per_process)
+        shared_loads = sum(cache.misses for cache in shared)
+        print(f'\n{self.WORKERS} workers, {self.LOOKUPS} lookups of {unique_customers} customers: '
+              f'per-process {per_process_hit_ratio:.1%} hits, {per_process_loads} loads, '
+              f'{sum(len(cache._entries) for cache in per_process)} entries, {per_process_bytes} bytes of heap; '
+              f'shared {shared_hit_ratio:.1%} hits, {shared_loads} loads, '
+              f'{shared[0].stats()["size"]} entries, {shared_bytes} bytes of file')
+
+        assert shared_loads == unique_customers
+        assert per_process_loads > shared_loads
+        assert shared_hit_ratio > per_process_hit_ratio
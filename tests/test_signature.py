@@ -0,0 +1,146 @@
+"""
+Unit tests and a microbenchmark for the webhook signature fast path.
+"""
+import json
+import time
+import tracemalloc
+import pytest
+import stripe
+from unittest.mock import patch
+from app.payments.signature import construct_event, sign_payload, verify_signature
+from tests.fixtures.stripe_fixtures import (
+    mock_checkout_session,
+    mock_stripe_customer,
+    mock_subscription,
+    mock_webhook_event
+)
+
+SECRET = 'whsec_test'
+
+
+def checkout_payload():
+    """A realistically sized checkout.session.completed body with expanded objects."""
+    session = mock_checkout_session()
+    session['customer'] = mock_stripe_customer()
+    session['subscription'] = mock_subscription()
+    return json.dumps(mock_webhook_event('checkout.session.completed', session)).encode('utf-8')
+
+
+class TestVerifySignature:
+    """Tests for verifying Stripe-Signature headers against the raw body."""
+
+    def test_matches_the_stripe_sdk(self):
+        """Test that headers are interchangeable with the SDK's in both directions."""
+        payload = checkout_payload()
+        timestamp = int(time.time())
+        sdk_signature = stripe.WebhookSignature._compute_signature(f'{timestamp}.{payload.decode()}', SECRET)
+
+        verify_signature(payload, f't={timestamp},v1={sdk_signature}', SECRET)
+        assert stripe.WebhookSignature.verify_header(payload.decode(), sign_payload(payload, SECRET), SECRET)
+
+    def test_accepts_any_matching_signature(self):
+        """Test that a header carrying a rotated-out secret's signature still verifies."""
+        payload = checkout_payload()
+        header = sign_payload(payload, SECRET)
+        verify_signature(payload, f"{header},v1={'0' * 64},v0=legacy", SECRET)
+
+    @pytest.mark.parametrize('header', [
+        None,
+        '',
+        'v1=abc',
+        't=notanumber,v1=abc',
+        't=1700000000',
+        't=1700000000,v1=abc',
+    ])
+    def test_rejects_bad_headers(self, header):
+        """Test that malformed or non-matching headers raise SignatureVerificationError."""
+        with pytest.raises(stripe.error.SignatureVerificationError):
+            verify_signature(checkout_payload(), header, SECRET, tolerance=None)
+
+    def test_rejects_tampered_body(self):
+        """Test that the signature covers every byte of the body."""
+        payload = checkout_payload()
+        header = sign_payload(payload, SECRET)
+
+        with pytest.raises(stripe.error.SignatureVerificationError):
+            verify_signature(payload + b' ', header, SECRET)
+
+    def test_rejects_old_timestamps(self):
+        """Test the replay window."""
+        payload = checkout_payload()
+        header = sign_payload(payload, SECRET, timestamp=int(time.time()) - 301)
+
+        with pytest.raises(stripe.error.SignatureVerificationError):
+            verify_signature(payload, header, SECRET)
+
+
+class TestConstructEvent:
+    """Tests for the single-parse event constructor."""
+
+    def test_returns_plain_dicts(self):
+        """Test that the body is parsed into ordinary dicts, not StripeObjects."""
+        payload = checkout_payload()
+
+        event = construct_event(payload, sign_payload(payload, SECRET), SECRET)
+
+        assert type(event) is dict
+        assert type(event['data']['object']) is dict
+        assert event == json.loads(payload)
+
+    def test_bad_signature_is_rejected_before_parsing(self):
+        """Test that no JSON is decoded for a request that fails verification."""
+        with patch('app.payments.signature.json.loads') as mock_loads, \
+             pytest.raises(stripe.error.SignatureVerificationError):
+            construct_event(checkout_payload(), 't=1,v1=abc', SECRET)
+
+        mock_loads.assert_not_called()
+
+    def test_invalid_json_raises_value_error(self):
+        """Test that a correctly signed but malformed body is reported as a bad payload."""
+        payload = b'{"id": '
+
+        with pytest.raises(ValueError):
+            construct_event(payload, sign_payload(payload, SECRET), SECRET)
+
+
+class TestVerificationBenchmark:
+    """Compare the fast path against stripe.Webhook.construct_event."""
+
+    EVENTS = 2000
+
+    def measure(self, construct, payload, header):
+        started = time.process_time()
+        for _ in range(self.EVENTS):
+            construct(payload, header, SECRET)
+        cpu_us = (time.process_time() - started) / self.EVENTS * 1e6
+
+        tracemalloc.start()
+        for _ in range(100):
+            construct(payload, header, SECRET)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Allocations made while building one event, kept alive by the result
+        tracemalloc.start()
+        event = construct(payload, header, SECRET)
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del event
+        return cpu_us, peak, retained
+
+    def test_fast_path_uses_less_cpu_and_memory(self):
+        """Test that verifying and parsing once is cheaper per event than the SDK."""
+        payload = checkout_payload()
+        header = sign_payload(payload, SECRET)
+
+        sdk_cpu, sdk_peak, sdk_retained = self.measure(stripe.Webhook.construct_event, payload, header)
+        fast_cpu, fast_peak, fast_retained = self.measure(construct_event, payload, header)
+
+        print(
+            f'\nper event: sdk {sdk_cpu:.0f}us / {sdk_retained} bytes, '
+            f'fast path {fast_cpu:.0f}us / {fast_retained} bytes '
+            f'(peak {sdk_peak} vs {fast_peak} bytes)'
+        )
+        assert fast_cpu < sdk_cpu
+        assert fast_retained < sdk_retained
+        assert fast_peak < sdk_peak
@@ -0,0 +1,376 @@
+"""
+Unit tests for the Stripe circuit breaker, single-flight reads and stale-while-revalidate entitlement lookups.
+"""
+import json
+import threading
+import time
+import pytest
+import stripe
+from unittest.mock import MagicMock, patch
+from app import create_app, db
+from app.models import Customer, Subscription, User
+from app.payments.entitlements import entitlement_cache, replace_entitlements, utc_datetime
+from app.payments.stripe_client import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    SingleFlight,
+    stripe_client
+)
+from config import TestConfig
+from tests.fixtures.stripe_stub import StripeStub
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def outage():
+    return stripe.error.APIConnectionError('Stripe is down')
+
+
+def call(breaker, method):
+    """Call through a bare breaker the way StripeClient.call does."""
+    breaker.before_call()
+    try:
+        result = method()
+    except stripe.error.APIConnectionError:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    return result
+
+
+class TestCircuitBreaker:
+    """Tests for the closed/open/half-open state machine."""
+
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    @pytest.fixture
+    def breaker(self, clock):
+        return CircuitBreaker(failure_threshold=3, reset_timeout=30, half_open_probes=1, clock=clock)
+
+    def trip(self, breaker):
+        for _ in range(breaker.failure_threshold):
+            with pytest.raises(stripe.error.APIConnectionError):
+                call(breaker, MagicMock(side_effect=outage()))
+
+    def test_opens_after_consecutive_failures(self, breaker):
+        """Test that the breaker stops calling Stripe once the threshold is reached."""
+        self.trip(breaker)
+        method = MagicMock()
+
+        with pytest.raises(CircuitOpenError):
+            call(breaker, method)
+
+        method.assert_not_called()
+        assert breaker.state == OPEN
+        assert breaker.stats()['short_circuited'] == 1
+
+    def test_success_resets_the_failure_count(self, breaker):
+        for _ in range(5):
+            with pytest.raises(stripe.error.APIConnectionError):
+                call(breaker, MagicMock(side_effect=outage()))
+            call(breaker, MagicMock())
+
+        assert breaker.state == CLOSED
+
+    def test_half_open_probe_success_closes(self, breaker, clock):
+        """Test that after the reset timeout one probe is let through and closes the breaker."""
+        self.trip(breaker)
+        clock.now += 30
+
+        breaker.before_call()
+        assert breaker.state == HALF_OPEN
+        # Only one probe at a time
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record_success()
+
+        assert breaker.state == CLOSED
+        assert breaker.stats()['transitions'] == {'closed->open': 1, 'open->half_open': 1, 'half_open->closed': 1}
+
+    def test_half_open_probe_failure_reopens(self, breaker, clock):
+        self.trip(breaker)
+        clock.now += 30
+
+        with pytest.raises(stripe.error.APIConnectionError):
+            call(breaker, MagicMock(side_effect=outage()))
+
+        assert breaker.state == OPEN
+        clock.now += 29
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+
+class TestStripeClient:
+    """Tests for the facade the app's Stripe reads go through."""
+
+    def test_errors_stripe_answered_with_do_not_trip(self, app):
+        """Test that a missing object is not mistaken for an outage."""
+        app.extensions['stripe_client'].failure_threshold = 1
+        with app.app_context(), patch('stripe.CustomerService.retrieve') as mock_retrieve:
+            mock_retrieve.side_effect = stripe.error.InvalidRequestError('No such customer', 'id')
+            for _ in range(3):
+                with pytest.raises(stripe.error.InvalidRequestError):
+                    stripe_client.retrieve_customer('cus_missing')
+
+            assert stripe_client.stats()['state'] == CLOSED
+
+    def test_open_breaker_fails_background_refreshes_fast(self, swr_app):
+        """Test that refreshes scheduled by premium checks stop calling Stripe once the breaker opens."""
+        swr_app.extensions['stripe_client'].failure_threshold = 2
+        client = swr_app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(swr_app.config['SWR_USER_ID'])
+            sess['_fresh'] = True
+
+        with patch('stripe.entitlements.ActiveEntitlementService.list', side_effect=outage()) as mock_list:
+            for _ in range(4):
+                assert client.get('/premium').status_code == 200
+                wait_for_refresh(swr_app)
+                entitlement_cache.invalidate('cus_stale')
+
+        assert mock_list.call_count == 2
+        assert stripe_client.stats()['short_circuited'] == 2
+
+    def test_other_errors_give_back_the_probe(self, app):
+        """Test that a half-open probe raising something other than a Stripe error does not jam the breaker."""
+        breaker = app.extensions['stripe_client']
+        breaker.failure_threshold = 1
+        with app.app_context(), patch('stripe.CustomerService.retrieve') as mock_retrieve:
+            mock_retrieve.side_effect = outage()
+            with pytest.raises(stripe.error.APIConnectionError):
+                stripe_client.retrieve_customer('cus_probe')
+            breaker._opened_at -= breaker.reset_timeout
+
+            mock_retrieve.side_effect = TypeError('bug')
+            with pytest.raises(TypeError):
+                stripe_client.retrieve_customer('cus_probe')
+            assert breaker.state == HALF_OPEN
+
+            mock_retrieve.side_effect = None
+            stripe_client.retrieve_customer('cus_probe')
+
+        assert breaker.state == CLOSED
+
+    def test_timeout_is_the_apps_own(self, app):
+        """Test that STRIPE_TIMEOUT applies to the app's client and leaves the SDK's global default alone."""
+        class SlowConfig(TestConfig):
+            STRIPE_TIMEOUT = 99
+
+        default_http_client = stripe.default_http_client
+        with patch('stripe.new_default_http_client', wraps=stripe.new_default_http_client) as new_http_client:
+            other = create_app(SlowConfig)
+
+        new_http_client.assert_called_once_with(timeout=99)
+        assert other.extensions['stripe_sdk_client'] is not app.extensions['stripe_sdk_client']
+        assert stripe.default_http_client is default_http_client
+
+    def test_metrics_expose_breaker_state(self, app, admin_client):
+        """Test that the breaker state and transitions are served from /payments/metrics."""
+        app.extensions['stripe_client'].failure_threshold = 1
+        with app.app_context(), patch('stripe.CustomerService.retrieve', side_effect=outage()):
+            with pytest.raises(stripe.error.APIConnectionError):
+                stripe_client.retrieve_customer('cus_down')
+
+        metrics = json.loads(admin_client.get('/payments/metrics').data)
+
+        assert metrics['stripe_client']['state'] == OPEN
+        assert metrics['stripe_client']['transitions'] == {'closed->open': 1}
+        assert metrics['entitlement_cache']['stale_served'] == 0
+
+
+@pytest.fixture
+def swr_app(tmp_path):
+    """An app refreshing stale entitlements in the background, backed by a SQLite file for the threads."""
+    class RefreshConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'swr.db')
+        ENTITLEMENT_REFRESH_WORKERS = 1
+
+    app = create_app(RefreshConfig)
+    with app.app_context():
+        db.create_all()
+        user = User(email='swr@example.com', name='SWR')
+        user.set_password('password123')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Customer(user_id=user.id, stripe_customer_id='cus_stale'))
+        db.session.flush()
+        db.session.add(Subscription(stripe_customer_id='cus_stale', stripe_subscription_id='sub_stale', status='active',
+                                    product_id='prod_test123', price_id='price_test123'))
+        db.session.commit()
+        replace_entitlements('cus_stale', [{'lookup_key': 'test-access'}], utc_datetime())
+        # Marked stale by a subscription change
+        db.session.execute(db.update(Customer).values(entitlements_synced_at=None))
+        db.session.commit()
+        app.config['SWR_USER_ID'] = user.id
+        yield app
+        app.extensions['entitlement_refresher'].executor.shutdown(wait=True)
+        db.session.remove()
+        db.drop_all()
+
+
+def wait_for_refresh(app):
+    """Wait for the background entitlement refreshes to finish."""
+    refresher = app.extensions['entitlement_refresher']
+    deadline = time.monotonic() + 5
+    while refresher.stats()['pending'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestStaleWhileRevalidate:
+    """Tests for serving stored entitlements while Stripe is slow or down."""
+
+    def test_stale_value_is_served_without_waiting_for_stripe(self, swr_app):
+        """Test that a slow Stripe does not hold up the lookup, and the refresh lands afterwards."""
+        stub = StripeStub(latency=0.5)
+        stub.add_entitlements('cus_stale', 'test-access', 'reports')
+
+        with stub.patch():
+            started = time.perf_counter()
+            assert entitlement_cache.lookup_keys('cus_stale') == {'test-access'}
+            elapsed = time.perf_counter() - started
+            wait_for_refresh(swr_app)
+
+        assert elapsed < 0.25
+        db.session.expire_all()
+        assert entitlement_cache.lookup_keys('cus_stale') == {'test-access', 'reports'}
+        stats = entitlement_cache.stats()
+        assert stats['stale_served'] == 1
+        assert stats['background_refreshes'] == {'scheduled': 1, 'refreshed': 1, 'failed': 0, 'pending': 0}
+
+    def test_one_refresh_per_customer_at_a_time(self, swr_app):
+        """Test that lookups while a refresh is running do not start another."""
+        stub = StripeStub(latency=0.3)
+        stub.add_entitlements('cus_stale', 'test-access')
+
+        with stub.patch():
+            for _ in range(5):
+                entitlement_cache.invalidate('cus_stale')
+                entitlement_cache.lookup_keys('cus_stale')
+            wait_for_refresh(swr_app)
+
+        assert stub.calls['ActiveEntitlement.list'] == 1
+        assert entitlement_cache.stats()['stale_served'] == 5
+
+    def test_premium_latency_is_bounded_during_an_outage(self, swr_app):
+        """Test that premium pages keep answering from stored entitlements while Stripe times out."""
+        client = swr_app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(swr_app.config['SWR_USER_ID'])
+            sess['_fresh'] = True
+
+        def timeout(params, options=None):
+            time.sleep(0.5)
+            raise stripe.error.APIConnectionError('Request timed out')
+
+        timings = []
+        with patch('stripe.entitlements.ActiveEntitlementService.list', side_effect=timeout):
+            for _ in range(5):
+                started = time.perf_counter()
+                assert client.get('/premium').status_code == 200
+                timings.append(time.perf_counter() - started)
+                entitlement_cache.invalidate('cus_stale')
+            wait_for_refresh(swr_app)
+
+        assert max(timings) < 0.25
+        assert entitlement_cache.stats()['background_refreshes']['failed'] >= 1
+
+
+def run_concurrently(threads, target):
+    """Start target on several threads at once and return what each returned or raised."""
+    barrier = threading.Barrier(threads)
+    outcomes = [None] * threads
+
+    def run(i):
+        barrier.wait()
+        try:
+            outcomes[i] = target()
+        except Exception as e:
+            outcomes[i] = e
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=10)
+    return outcomes
+
+
+class TestSingleFlight:
+    """Stress tests for coalescing concurrent identical Stripe reads."""
+
+    THREADS = 32
+
+    def test_concurrent_calls_share_one_result(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return object()
+
+        single_flight = SingleFlight()
+        results = run_concurrently(self.THREADS, lambda: single_flight.do('cus_popular', fetch))
+
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert single_flight.stats() == {'calls': 1, 'shared': self.THREADS - 1, 'in_flight': 0}
+
+    def test_errors_are_shared_and_not_remembered(self):
+        """Test that waiters get the leader's error, and the next call tries again."""
+        single_flight = SingleFlight()
+
+        def fail():
+            time.sleep(0.2)
+            raise outage()
+
+        errors = run_concurrently(self.THREADS, lambda: single_flight.do('cus_down', fail))
+
+        assert all(isinstance(error, stripe.error.APIConnectionError) for error in errors)
+        assert single_flight.stats()['calls'] == 1
+        assert single_flight.do('cus_down', lambda: 'recovered') == 'recovered'
+
+    def test_different_calls_are_not_coalesced(self, app):
+        stub = StripeStub(latency=0.1)
+        stub.add_customer('cus_a')
+        stub.add_customer('cus_b')
+
+        def retrieve(customer_id, **params):
+            with app.app_context():
+                return stripe_client.retrieve_customer(customer_id, **params)
+
+        with stub.patch():
+            run_concurrently(4, lambda: retrieve('cus_a'))
+            run_concurrently(4, lambda: retrieve('cus_b'))
+            run_concurrently(4, lambda: retrieve('cus_a', expand=['subscriptions']))
+
+        assert stub.calls['Customer.retrieve'] == 3
+
+    def test_concurrent_lookups_call_stripe_once(self, swr_app):
+        """Test that many requests for a stale customer schedule one Stripe call, not one each."""
+        stub = StripeStub(latency=1.0)
+        stub.add_entitlements('cus_stale', 'test-access')
+
+        def lookup():
+            with swr_app.app_context():
+                try:
+                    return entitlement_cache.lookup_keys('cus_stale')
+                finally:
+                    db.session.remove()
+
+        with stub.patch():
+            results = run_concurrently(self.THREADS, lookup)
+            wait_for_refresh(swr_app)
+
+        assert stub.calls['ActiveEntitlement.list'] == 1
+        assert results == [{'test-access'}] * self.THREADS
@@ -0,0 +1,310 @@
+"""
+Unit tests for the webhook inbox and its worker pool.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+import pytest
+from unittest.mock import patch, MagicMock
+from app import create_app, db
+from app.models import WebhookEvent
+from app.models import Subscription
+from app.payments.dispatcher import current_event, dispatcher
+from app.payments.inbox import record_event, process_event, shard_for, PENDING, PROCESSED, FAILED
+from config import TestConfig
+from app.payments.signature import sign_payload
+from tests.fixtures.queries import count_queries
+from tests.fixtures.stripe_fixtures import (
+    mock_checkout_session,
+    mock_stripe_customer,
+    mock_subscription,
+    mock_webhook_event
+)
+
+
+def post_event(client, event, signature=None):
+    payload = json.dumps(event)
+    return client.post(
+        '/payments/event',
+        data=payload,
+        content_type='application/json',
+        headers={'stripe-signature': signature or sign_payload(payload, 'whsec_test')}
+    )
+
+
+@pytest.fixture
+def threaded_app(tmp_path):
+    """An app with a real worker pool, backed by a SQLite file so threads get their own connections."""
+    class ThreadedConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'inbox.db')
+        WEBHOOK_WORKERS = 2
+        WEBHOOK_POLL_INTERVAL = 0.05
+
+    app = create_app(ThreadedConfig)
+    with app.app_context():
+        db.create_all()
+        yield app
+        app.extensions['webhook_inbox'].stop(timeout=5)
+        db.session.remove()
+        db.drop_all()
+
+
+class TestWebhookEndpoint:
+    """Tests for how POST /payments/event uses the inbox."""
+
+    def test_stores_raw_event_in_inbox(self, app, client):
+        """Test that the raw payload is stored and processed."""
+        with app.app_context():
+            event = mock_webhook_event('customer.created', {'id': 'cus_inbox'}, event_id='evt_inbox_1')
+
+            with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}):
+                response = post_event(client, event)
+
+            assert response.status_code == 200
+            webhook_event = db.session.scalar(
+                db.select(WebhookEvent).where(WebhookEvent.stripe_event_id == 'evt_inbox_1')
+            )
+            assert webhook_event.event_type == 'customer.created'
+            assert json.loads(webhook_event.payload) == event
+            assert webhook_event.status == PROCESSED
+            assert webhook_event.attempts == 1
+            assert webhook_event.processed_at is not None
+
+    def test_redelivery_is_acknowledged_once(self, app, client):
+        """Test that a redelivered event is acknowledged but not stored or handled again."""
+        with app.app_context():
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_x'}, event_id='evt_dupe')
+
+            mock_handler = MagicMock()
+            with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}), \
+                 patch.dict(dispatcher.handlers, {'invoice.payment_failed': mock_handler}):
+                assert post_event(client, event).status_code == 200
+                assert post_event(client, event).status_code == 200
+
+            assert mock_handler.call_count == 1
+            assert db.session.scalar(db.select(db.func.count(WebhookEvent.id))) == 1
+
+    def test_redelivery_missing_the_cache_is_one_insert(self, app):
+        """Test that a redelivered event the LRU no longer holds is skipped by the insert itself, without a rollback."""
+        with app.app_context():
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_x'}, event_id='evt_dupe_db')
+            stored = record_event(event['id'], event['type'], json.dumps(event), created=100)
+            rollbacks = []
+
+            with count_queries() as statements, \
+                 patch.object(db.session, 'rollback', side_effect=lambda: rollbacks.append(1)):
+                assert record_event(event['id'], event['type'], json.dumps(event), created=100) is None
+
+            assert len(statements) == 1
+            assert statements[0].lstrip().upper().startswith('INSERT')
+            assert rollbacks == []
+            assert db.session.get(WebhookEvent, stored.id).status == PENDING
+
+    def test_rejects_invalid_signature(self, app, client):
+        """Test that events failing signature verification are not stored."""
+        with app.app_context():
+            event = mock_webhook_event('customer.created', {'id': 'cus_inbox'})
+
+            with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}):
+                response = post_event(client, event, signature='t=1,v1=test_sig')
+
+            assert response.status_code == 400
+            assert db.session.scalar(db.select(db.func.count(WebhookEvent.id))) == 0
+
+
+class TestProcessEvent:
+    """Tests for retry bookkeeping in process_event."""
+
+    def test_failure_is_recorded_and_retried_later(self, app):
+        """Test that a failing handler leaves the event pending with a backoff."""
+        with app.app_context():
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_x'}, event_id='evt_fail')
+            webhook_event = record_event(event['id'], event['type'], json.dumps(event))
+
+            mock_handler = MagicMock()
+            with patch.dict(dispatcher.handlers, {'invoice.payment_failed': mock_handler}):
+                mock_handler.side_effect = RuntimeError('Stripe is down')
+                assert process_event(webhook_event.id) is False
+                # Not due yet, so a second attempt is not claimed
+                assert process_event(webhook_event.id) is False
+
+            webhook_event = db.session.get(WebhookEvent, webhook_event.id)
+            assert webhook_event.status == PENDING
+            assert webhook_event.attempts == 1
+            assert webhook_event.last_error == 'RuntimeError: Stripe is down'
+            assert mock_handler.call_count == 1
+
+    def test_gives_up_after_max_attempts(self, app):
+        """Test that an event is marked failed once it runs out of attempts."""
+        app.config['WEBHOOK_MAX_ATTEMPTS'] = 2
+        app.config['WEBHOOK_RETRY_BACKOFF'] = 0
+        with app.app_context():
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_x'}, event_id='evt_fail')
+            webhook_event = record_event(event['id'], event['type'], json.dumps(event))
+
+            mock_handler = MagicMock()
+            with patch.dict(dispatcher.handlers, {'invoice.payment_failed': mock_handler}):
+                mock_handler.side_effect = RuntimeError('boom')
+                process_event(webhook_event.id)
+                process_event(webhook_event.id)
+
+            webhook_event = db.session.get(WebhookEvent, webhook_event.id)
+            assert webhook_event.status == FAILED
+            assert webhook_event.attempts == 2
+
+    def test_cancellation_before_checkout_is_retried(self, app, sample_user):
+        """Test that a cancellation delivered before its checkout is applied once the checkout is."""
+        with app.app_context():
+            cancelled = mock_webhook_event(
+                'customer.subscription.deleted',
+                mock_subscription(subscription_id='sub_early', customer_id='cus_early', status='canceled'),
+                event_id='evt_cancelled'
+            )
+            session = mock_checkout_session(client_reference_id=str(sample_user.id))
+            session['customer'] = mock_stripe_customer(customer_id='cus_early')
+            session['subscription'] = mock_subscription(subscription_id='sub_early', customer_id='cus_early')
+            completed = mock_webhook_event('checkout.session.completed', session, event_id='evt_completed')
+            completed['created'] = cancelled['created'] - 10
+
+            cancelled_id = record_event(cancelled['id'], cancelled['type'], json.dumps(cancelled)).id
+            assert process_event(cancelled_id) is False
+            assert db.session.get(WebhookEvent, cancelled_id).last_error.startswith('EventNotReady')
+
+            completed_id = record_event(completed['id'], completed['type'], json.dumps(completed)).id
+            assert process_event(completed_id) is True
+
+            db.session.get(WebhookEvent, cancelled_id).next_attempt_at = datetime.now(timezone.utc)
+            db.session.commit()
+            assert process_event(cancelled_id) is True
+
+            subscription = db.session.scalar(
+                db.select(Subscription).where(Subscription.stripe_subscription_id == 'sub_early')
+            )
+            assert subscription.status == 'cancelled'
+            assert subscription.last_event_created == cancelled['created']
+
+    def test_processed_event_is_not_claimed_again(self, app):
+        """Test that process_event is a no-op for an already processed event."""
+        with app.app_context():
+            event = mock_webhook_event('customer.created', {'id': 'cus_x'})
+            webhook_event = record_event(event['id'], event['type'], json.dumps(event))
+
+            assert process_event(webhook_event.id) is True
+            assert process_event(webhook_event.id) is False
+
+
+class TestWorkerPool:
+    """Tests for the background worker pool."""
+
+    def test_ack_does_not_wait_for_slow_handler(self, threaded_app):
+        """Test that the endpoint acknowledges before the handler has finished."""
+        client = threaded_app.test_client()
+        event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_slow'}, event_id='evt_slow')
+        release = threading.Event()
+
+        def slow_handler(session):
+            release.wait(5)
+
+        with patch.dict(os.environ, {'TEST_STRIPE_WEBHOOK_SECRET': 'whsec_test'}), \
+             patch.dict(dispatcher.handlers, {'invoice.payment_failed': slow_handler}):
+            started = time.perf_counter()
+            response = post_event(client, event)
+            elapsed = time.perf_counter() - started
+
+            assert response.status_code == 200
+            assert elapsed < 0.5
+            release.set()
+            threaded_app.extensions['webhook_inbox'].join()
+
+        db.session.expire_all()
+        webhook_event = db.session.scalar(
+            db.select(WebhookEvent).where(WebhookEvent.stripe_event_id == 'evt_slow')
+        )
+        assert webhook_event.status == PROCESSED
+
+    def test_sweep_picks_up_orphaned_events(self, threaded_app):
+        """Test that events stored without being queued are drained by the pool."""
+        event = mock_webhook_event('customer.created', {'id': 'cus_orphan'}, event_id='evt_orphan')
+        webhook_event_id = record_event(event['id'], event['type'], json.dumps(event)).id
+
+        pool = threaded_app.extensions['webhook_inbox']
+        pool.start()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            db.session.expire_all()
+            if db.session.get(WebhookEvent, webhook_event_id).status == PROCESSED:
+                break
+            time.sleep(0.05)
+
+        assert db.session.get(WebhookEvent, webhook_event_id).status == PROCESSED
+
+    def test_sweep_does_not_queue_an_event_twice(self, threaded_app):
+        """Test that an event still waiting in a queue is not queued again by the next sweeps."""
+        event = mock_webhook_event('customer.created', {'id': 'cus_queued'}, event_id='evt_queued')
+        webhook_event_id = record_event(event['id'], event['type'], json.dumps(event)).id
+        pool = threaded_app.extensions['webhook_inbox']
+
+        for _ in range(3):
+            pool._sweep()
+        assert sum(shard.qsize() for shard in pool._queues) == 1
+
+        # Once a worker has finished with it, a sweep may queue it again for a retry
+        pool._done(webhook_event_id)
+        pool._sweep()
+        assert sum(shard.qsize() for shard in pool._queues) == 2
+
+    def test_sweep_runs_while_every_worker_is_busy(self, threaded_app):
+        """Test that retries are still found when no worker is ever idle."""
+        pool = threaded_app.extensions['webhook_inbox']
+        release = threading.Event()
+        customers = {shard_for(f'cus_busy_{i}', pool.workers): f'cus_busy_{i}' for i in range(20)}
+        assert len(customers) == pool.workers
+
+        with patch.dict(dispatcher.handlers, {'invoice.payment_failed': lambda obj: release.wait(5)}), \
+             patch.object(pool, '_sweep') as mock_sweep:
+            for customer_id in customers.values():
+                event = mock_webhook_event('invoice.payment_failed', {'id': 'sub_busy', 'customer': customer_id},
+                                           event_id=f'evt_{customer_id}')
+                webhook_event = record_event(event['id'], event['type'], json.dumps(event), customer_id=customer_id)
+                pool.submit(webhook_event.id, customer_id)
+            time.sleep(0.5)
+            release.set()
+            pool.join()
+
+        assert mock_sweep.call_count >= 3
+
+    def test_customer_events_run_in_created_order(self, threaded_app):
+        """Test that a customer's events delivered out of order are applied oldest first."""
+        pool = threaded_app.extensions['webhook_inbox']
+        pool.reorder_delay = 0.5
+        applied = []
+        delivered = []
+        for event_id, created in [('evt_newer', 200), ('evt_older', 100), ('evt_newest', 300)]:
+            event = mock_webhook_event(
+                'invoice.payment_failed',
+                {'id': 'sub_order', 'customer': 'cus_order'},
+                event_id=event_id
+            )
+            event['created'] = created
+            webhook_event = record_event(
+                event['id'], event['type'], json.dumps(event),
+                customer_id='cus_order', created=created
+            )
+            delivered.append((webhook_event.id, created))
+
+        with patch.dict(dispatcher.handlers, {'invoice.payment_failed': lambda obj: applied.append(current_event()['id'])}):
+            for webhook_event_id, created in delivered:
+                pool.submit(webhook_event_id, 'cus_order', created)
+                # Deliveries a moment apart, as Stripe would send them
+                time.sleep(0.1)
+            pool.join()
+
+        assert applied == ['evt_older', 'evt_newer', 'evt_newest']
+
+    def test_customers_are_pinned_to_a_shard(self):
+        """Test that a customer always maps to the same worker."""
+        assert shard_for('cus_abc', 4) == shard_for('cus_abc', 4)
+        assert {shard_for(f'cus_{i}', 4) for i in range(50)} == {0, 1, 2, 3}
+        assert shard_for(None, 4) == 0
@@ -1,10 +1,16 @@
 """
 Unit tests for Stripe webhook handlers.
 """
+import time
+from datetime import date, datetime, timezone
 import pytest
 from unittest.mock import patch, MagicMock
 from app import db
-from app.models import User, Customer, Subscription
+from app.analytics.rollups import rebuild_rollups
+from app.models import User, Customer, DailyRevenue, Subscription, SubscriptionPrice
+from app.payments.dispatcher import EventNotReady, dispatcher
+from app.payments.billing import has_active_access
+from app.payments.entitlements import replace_entitlements, utc_datetime
 from app.payments.webhook_helpers import (
     handle_checkout_session,
     handle_subscription_cancelled,
@@ -12,9 +18,29 @@ from app.payments.webhook_helpers import (
 )
 from tests.fixtures.stripe_fixtures import (
     mock_checkout_session,
+    mock_invoice,
     mock_stripe_customer,
-    mock_subscription
+    mock_subscription,
+    mock_webhook_event
 )
+from tests.fixtures.stripe_stub import StripeStub
+
+
+@pytest.fixture
+def new_york_time(monkeypatch):
+    """Run the test on a host whose local time is behind UTC."""
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def rollup_rows():
+    return db.session.execute(
+        db.select(DailyRevenue.day, DailyRevenue.mrr_change, DailyRevenue.subscriptions_change)
+        .order_by(DailyRevenue.day)
+    ).all()
 
 
 class TestHandleCheckoutSession:
@@ -31,8 +57,8 @@ class TestHandleCheckoutSession:
                 client_reference_id=str(user.id)
             )
             
-            with patch('stripe.Customer.retrieve') as mock_cust_retrieve, \
-                 patch('stripe.Subscription.retrieve') as mock_sub_retrieve:
+            with patch('stripe.CustomerService.retrieve') as mock_cust_retrieve, \
+                 patch('stripe.SubscriptionService.retrieve') as mock_sub_retrieve:
                 
                 mock_cust_retrieve.return_value = mock_stripe_customer(
                     customer_id='cus_new123',
@@ -65,8 +91,8 @@ class TestHandleCheckoutSession:
                 client_reference_id=str(user.id)
             )
             
-            with patch('stripe.Customer.retrieve') as mock_cust_retrieve, \
-                 patch('stripe.Subscription.retrieve') as mock_sub_retrieve:
+            with patch('stripe.CustomerService.retrieve') as mock_cust_retrieve, \
+                 patch('stripe.SubscriptionService.retrieve') as mock_sub_retrieve:
                 
                 mock_cust_retrieve.return_value = mock_stripe_customer(customer_id='cus_sub_test')
                 mock_sub_retrieve.return_value = mock_subscription(
@@ -88,6 +114,27 @@ class TestHandleCheckoutSession:
                 assert subscription.product_id == 'prod_premium'
                 assert subscription.price_id == 'price_monthly'
 
+    def test_creation_times_are_stored_in_utc(self, app, sample_user, new_york_time):
+        """Test that a checkout handled on a host outside UTC stores the same times, and rollup days, as one in UTC."""
+        created = int(datetime(2026, 3, 1, 2, 0, tzinfo=timezone.utc).timestamp())
+        customer = {**mock_stripe_customer(customer_id='cus_tz'), 'created': created}
+        subscription = {**mock_subscription(subscription_id='sub_tz', customer_id='cus_tz'), 'created': created}
+        session = mock_checkout_session(customer_id='cus_tz', subscription_id='sub_tz',
+                                        client_reference_id=str(sample_user.id))
+        with app.app_context():
+            with patch('stripe.CustomerService.retrieve', return_value=customer), \
+                 patch('stripe.SubscriptionService.retrieve', return_value=subscription):
+                handle_checkout_session(session)
+            db.session.commit()
+            incremental = rollup_rows()
+            rebuild_rollups()
+
+            assert db.session.scalar(db.select(Customer.created_at).where(Customer.stripe_customer_id == 'cus_tz')) \
+                == datetime(2026, 3, 1, 2, 0)
+            assert stored_subscription('sub_tz').created_at == datetime(2026, 3, 1, 2, 0)
+            assert incremental[0].day == date(2026, 3, 1)
+            assert rollup_rows() == incremental
+
     def test_updates_existing_customer_name(self, app, sample_user, sample_customer):
         """Test that existing customer name is updated on checkout."""
         with app.app_context():
@@ -102,8 +149,8 @@ class TestHandleCheckoutSession:
                 client_reference_id=str(sample_user.id)
             )
             
-            with patch('stripe.Customer.retrieve') as mock_cust_retrieve, \
-                 patch('stripe.Subscription.retrieve') as mock_sub_retrieve:
+            with patch('stripe.CustomerService.retrieve') as mock_cust_retrieve, \
+                 patch('stripe.SubscriptionService.retrieve') as mock_sub_retrieve:
                 
                 mock_cust_retrieve.return_value = mock_stripe_customer(
                     customer_id=original_customer_id,
@@ -123,6 +170,88 @@ class TestHandleCheckoutSession:
                 assert updated_customer.customer_name == 'Updated Name'
 
 
+class TestCheckoutHydration:
+    """Tests for how many Stripe calls handle_checkout_session makes."""
+
+    def test_one_expanded_call_for_subscription_checkout(self, app, sample_user):
+        """Test that the customer is expanded from the subscription rather than fetched separately."""
+        with app.app_context():
+            stub = StripeStub()
+            stub.add_customer('cus_hydrate', name='Hydrated Name')
+            stub.add_subscription('sub_hydrate', 'cus_hydrate')
+            session = mock_checkout_session(
+                customer_id='cus_hydrate',
+                subscription_id='sub_hydrate',
+                client_reference_id=str(sample_user.id)
+            )
+
+            with stub.patch():
+                handle_checkout_session(session)
+
+            assert stub.calls == {'Subscription.retrieve': 1}
+            customer = db.session.scalar(
+                db.select(Customer).where(Customer.stripe_customer_id == 'cus_hydrate')
+            )
+            assert customer.customer_name == 'Hydrated Name'
+            assert db.session.scalar(
+                db.select(Subscription).where(Subscription.stripe_subscription_id == 'sub_hydrate')
+            ) is not None
+
+    def test_no_calls_when_payload_is_expanded(self, app, sample_user):
+        """Test that expanded objects in the payload are used without calling Stripe."""
+        with app.app_context():
+            stub = StripeStub()
+            session = mock_checkout_session(client_reference_id=str(sample_user.id))
+            session['customer'] = mock_stripe_customer(customer_id='cus_expanded')
+            session['subscription'] = mock_subscription(subscription_id='sub_expanded', customer_id='cus_expanded')
+
+            with stub.patch():
+                handle_checkout_session(session)
+
+            assert stub.total_calls == 0
+            subscription = db.session.scalar(
+                db.select(Subscription).where(Subscription.stripe_subscription_id == 'sub_expanded')
+            )
+            assert subscription.stripe_customer_id == 'cus_expanded'
+
+    def test_customer_only_checkout_fetches_customer(self, app, sample_user):
+        """Test that a checkout without a subscription only retrieves the customer."""
+        with app.app_context():
+            stub = StripeStub()
+            stub.add_customer('cus_no_sub')
+            session = mock_checkout_session(
+                customer_id='cus_no_sub',
+                subscription_id=None,
+                client_reference_id=str(sample_user.id)
+            )
+
+            with stub.patch():
+                handle_checkout_session(session)
+
+            assert stub.calls == {'Customer.retrieve': 1}
+
+    def test_each_checkout_is_one_round_trip(self, app, sample_user):
+        """Test that every checkout waits on a single Stripe call, so its latency is one round trip."""
+        with app.app_context():
+            stub = StripeStub()
+
+            with stub.patch():
+                for i in range(20):
+                    stub.add_customer(f'cus_latency_{i}')
+                    stub.add_subscription(f'sub_latency_{i}', f'cus_latency_{i}')
+                    session = mock_checkout_session(
+                        customer_id=f'cus_latency_{i}',
+                        subscription_id=f'sub_latency_{i}',
+                        client_reference_id=str(sample_user.id)
+                    )
+                    calls = stub.total_calls
+                    handle_checkout_session(session)
+                    assert stub.total_calls - calls == 1
+
+            # Retrieving the customer after the subscription would be a second round trip
+            assert stub.calls == {'Subscription.retrieve': 20}
+
+
 class TestHandleSubscriptionCancelled:
     """Tests for handle_subscription_cancelled webhook handler."""
 
@@ -140,36 +269,282 @@ class TestHandleSubscriptionCancelled:
             updated_subscription = db.session.get(Subscription, subscription.id)
             assert updated_subscription.status == 'cancelled'
 
+    def test_records_when_the_subscription_ended(self, app, sample_subscription):
+        with app.app_context():
+            handle_subscription_cancelled({'id': sample_subscription.stripe_subscription_id, 'ended_at': 1_700_000_000})
+
+            assert stored_subscription().ended_at == utc_datetime(1_700_000_000)
+
     def test_handles_nonexistent_subscription(self, app):
-        """Test graceful handling of non-existent subscription."""
+        """Test that cancelling a subscription that is not stored yet is left for a retry."""
         with app.app_context():
             session = {'id': 'sub_nonexistent'}
             
-            # Should not raise an exception
-            handle_subscription_cancelled(session)
+            # The checkout that creates it may not have been delivered yet
+            with pytest.raises(EventNotReady):
+                handle_subscription_cancelled(session)
+
+
+class TestOutOfOrderEvents:
+    """Tests for events that Stripe delivers after newer events for the same subscription."""
+
+    def cancel(self, subscription_id, created):
+        event = mock_webhook_event('customer.subscription.deleted', {'id': subscription_id})
+        event['created'] = created
+        dispatcher.dispatch(event)
+
+    def test_stale_payment_failure_does_not_reopen_cancelled_subscription(self, app, sample_subscription):
+        """Test that an older invoice.payment_failed is skipped after a newer cancellation."""
+        with app.app_context():
+            subscription_id = sample_subscription.stripe_subscription_id
+            self.cancel(subscription_id, created=2000)
+
+            event = mock_webhook_event('invoice.payment_failed', {'id': 'in_stale', 'subscription': subscription_id})
+            event['created'] = 1000
+            dispatcher.dispatch(event)
+
+            subscription = db.session.get(Subscription, sample_subscription.id)
+            assert subscription.status == 'cancelled'
+            assert subscription.last_event_created == 2000
+
+    def test_stale_checkout_does_not_overwrite_status(self, app, sample_user):
+        """Test that a checkout delivered after the subscription's cancellation leaves it cancelled."""
+        with app.app_context():
+            session = mock_checkout_session(
+                customer_id='cus_late',
+                subscription_id='sub_late',
+                client_reference_id=str(sample_user.id)
+            )
+            session['customer'] = mock_stripe_customer(customer_id='cus_late')
+            session['subscription'] = mock_subscription(subscription_id='sub_late', customer_id='cus_late')
+            event = mock_webhook_event('checkout.session.completed', session)
+            event['created'] = 1000
+            dispatcher.dispatch(event)
+            self.cancel('sub_late', created=2000)
+
+            # The same checkout redelivered late
+            dispatcher.dispatch(event)
+
+            subscription = db.session.scalar(
+                db.select(Subscription).where(Subscription.stripe_subscription_id == 'sub_late')
+            )
+            assert subscription.status == 'cancelled'
+
+    def test_update_created_before_a_paid_invoice_is_applied_after_it(self, app, sample_subscription):
+        """Test that a subscription update delivered after a newer invoice.paid still changes the plan."""
+        with app.app_context():
+            subscription_id = sample_subscription.stripe_subscription_id
+            paid = mock_webhook_event('invoice.paid', mock_invoice(subscription_id=subscription_id))
+            paid['created'] = 2000
+            dispatcher.dispatch(paid)
+
+            updated = mock_webhook_event('customer.subscription.updated', mock_subscription(
+                subscription_id=subscription_id, status='past_due', price_id='price_upgraded'
+            ))
+            updated['created'] = 1000
+            dispatcher.dispatch(updated)
+
+            subscription = stored_subscription()
+            assert (subscription.status, subscription.price_id) == ('past_due', 'price_upgraded')
+            assert subscription.last_event_created == 1000
 
 
 class TestHandleInvoicePaymentFailed:
     """Tests for handle_invoice_payment_failed webhook handler."""
 
     def test_updates_subscription_status_to_past_due(self, app, sample_subscription):
-        """Test that subscription status is updated to past_due."""
+        """Test that the subscription the invoice bills, not one with the invoice's ID, becomes past_due."""
         with app.app_context():
             subscription = db.session.get(Subscription, sample_subscription.id)
             assert subscription.status == 'active'
             
-            session = {'id': subscription.stripe_subscription_id}
+            invoice = mock_invoice(invoice_id='in_failed', subscription_id=subscription.stripe_subscription_id,
+                                   status='open')
             
-            handle_invoice_payment_failed(session)
+            handle_invoice_payment_failed(invoice)
             
             # Re-fetch and verify status
             updated_subscription = db.session.get(Subscription, subscription.id)
             assert updated_subscription.status == 'past_due'
 
+    def test_ends_access(self, app, sample_user, sample_subscription):
+        """Test that a failed renewal ends access before the recorded period does."""
+        with app.app_context():
+            subscription = db.session.get(Subscription, sample_subscription.id)
+            subscription.current_period_end = utc_datetime(int(time.time()) + 10 * 24 * 3600)
+            db.session.commit()
+            user = db.session.get(User, sample_user.id)
+            assert has_active_access(user)
+
+            handle_invoice_payment_failed(mock_invoice(status='open'))
+
+            assert not has_active_access(user)
+
+    def test_reads_the_subscription_from_the_invoice_parent(self, app, sample_subscription):
+        """Test newer Stripe API versions, which move the subscription under the invoice's parent."""
+        with app.app_context():
+            invoice = mock_invoice(status='open')
+            del invoice['subscription']
+            invoice['parent'] = {'subscription_details': {'subscription': 'sub_test123456'}}
+
+            handle_invoice_payment_failed(invoice)
+
+            assert db.session.get(Subscription, sample_subscription.id).status == 'past_due'
+
     def test_handles_nonexistent_subscription(self, app):
         """Test graceful handling of non-existent subscription."""
         with app.app_context():
-            session = {'id': 'sub_nonexistent'}
+            invoice = mock_invoice(subscription_id='sub_nonexistent', status='open')
             
             # Should not raise an exception
-            handle_invoice_payment_failed(session)
+            handle_invoice_payment_failed(invoice)
+
+    def test_ignores_one_off_invoices(self, app, sample_subscription):
+        with app.app_context():
+            handle_invoice_payment_failed(mock_invoice(subscription_id=None, status='open'))
+
+            assert db.session.get(Subscription, sample_subscription.id).status == 'active'
+
+
+def stored_subscription(stripe_subscription_id='sub_test123456'):
+    return db.session.scalar(
+        db.select(Subscription).where(Subscription.stripe_subscription_id == stripe_subscription_id)
+    )
+
+
+class TestHandleInvoicePaid:
+    """Tests for moving the billing period on when an invoice is paid."""
+
+    def test_records_the_period_paid_for(self, app, sample_subscription):
+        with app.app_context():
+            invoice = mock_invoice()
+            period = invoice['lines']['data'][0]['period']
+
+            dispatcher.dispatch(mock_webhook_event('invoice.paid', invoice))
+
+            subscription = stored_subscription()
+            assert subscription.current_period_start == utc_datetime(period['start'])
+            assert subscription.current_period_end == utc_datetime(period['end'])
+            assert subscription.status == 'active'
+
+    def test_reactivates_a_past_due_subscription(self, app, sample_subscription):
+        with app.app_context():
+            dispatcher.dispatch(mock_webhook_event('invoice.payment_failed', mock_invoice(status='open')))
+            dispatcher.dispatch(mock_webhook_event('invoice.paid', mock_invoice()))
+
+            assert stored_subscription().status == 'active'
+
+    def test_trial_invoice_keeps_the_subscription_trialing(self, app, sample_subscription):
+        with app.app_context():
+            stored_subscription().status = 'trialing'
+            db.session.commit()
+
+            dispatcher.dispatch(mock_webhook_event('invoice.paid', mock_invoice()))
+
+            assert stored_subscription().status == 'trialing'
+
+    def test_reads_the_subscription_from_the_invoice_parent(self, app, sample_subscription):
+        """Test the invoice shape of newer Stripe API versions."""
+        with app.app_context():
+            invoice = mock_invoice()
+            del invoice['subscription']
+            invoice['parent'] = {'subscription_details': {'subscription': 'sub_test123456'}}
+
+            dispatcher.dispatch(mock_webhook_event('invoice.paid', invoice))
+
+            assert stored_subscription().current_period_end is not None
+
+    def test_one_off_invoice_is_ignored(self, app, sample_subscription):
+        with app.app_context():
+            invoice = mock_invoice(subscription_id=None)
+
+            dispatcher.dispatch(mock_webhook_event('invoice.paid', invoice))
+
+            assert stored_subscription().current_period_end is None
+
+    def test_invoice_for_unknown_subscription_is_retried(self, app):
+        with app.app_context(), pytest.raises(EventNotReady):
+            dispatcher.dispatch(mock_webhook_event('invoice.paid', mock_invoice(subscription_id='sub_unknown')))
+
+
+class TestHandleSubscriptionUpdated:
+    """Tests for keeping a subscription's status, plan, period and trial in step with Stripe."""
+
+    def test_records_period_trial_and_cancellation(self, app, sample_subscription):
+        with app.app_context():
+            replace_entitlements('cus_test123456', [{'lookup_key': 'test-access'}], utc_datetime(1000))
+            stripe_subscription = mock_subscription(status='trialing', price_id='price_yearly')
+            stripe_subscription.update(trial_end=stripe_subscription['current_period_end'], cancel_at_period_end=True)
+
+            dispatcher.dispatch(mock_webhook_event('customer.subscription.updated', stripe_subscription))
+
+            subscription = stored_subscription()
+            assert subscription.status == 'trialing'
+            assert subscription.price_id == 'price_yearly'
+            assert subscription.current_period_end == utc_datetime(stripe_subscription['current_period_end'])
+            assert subscription.trial_end == subscription.current_period_end
+            assert subscription.cancel_at_period_end is True
+            # The plan may have changed, so the next check resyncs
+            assert subscription.customer.entitlements_synced_at is None
+
+    def test_records_the_amount_summed_over_items(self, app, sample_subscription):
+        with app.app_context():
+            stripe_subscription = mock_subscription()
+            item = stripe_subscription['items']['data'][0]
+            item['price']['recurring'] = {'interval': 'year', 'interval_count': 1}
+            stripe_subscription['items']['data'].append({**item, 'quantity': 3})
+
+            dispatcher.dispatch(mock_webhook_event('customer.subscription.updated', stripe_subscription))
+
+            subscription = stored_subscription()
+            assert (subscription.amount, subscription.currency) == (999 * 4, 'usd')
+            assert (subscription.billing_interval, subscription.billing_interval_count) == ('year', 1)
+
+    def test_reads_the_period_from_the_subscription_item(self, app, sample_subscription):
+        """Test the subscription shape of newer Stripe API versions."""
+        with app.app_context():
+            stripe_subscription = mock_subscription()
+            item = stripe_subscription['items']['data'][0]
+            item['current_period_start'] = stripe_subscription.pop('current_period_start')
+            item['current_period_end'] = stripe_subscription.pop('current_period_end')
+
+            dispatcher.dispatch(mock_webhook_event('customer.subscription.updated', stripe_subscription))
+
+            assert stored_subscription().current_period_end == utc_datetime(item['current_period_end'])
+
+    def test_changes_that_keep_the_plan_record_no_price_history(self, app, sample_subscription):
+        with app.app_context():
+            dispatcher.dispatch(mock_webhook_event('customer.subscription.updated', mock_subscription()))
+            dispatcher.dispatch(mock_webhook_event('customer.subscription.updated', mock_subscription(status='past_due')))
+
+            assert db.session.scalar(db.select(db.func.count(SubscriptionPrice.id))) == 0
+
+    def test_stripe_cancellation_is_stored_as_cancelled(self, app, sample_subscription):
+        with app.app_context():
+            dispatcher.dispatch(mock_webhook_event('customer.subscription.updated', mock_subscription(status='canceled')))
+
+            assert stored_subscription().status == 'cancelled'
+
+    def test_stale_update_is_skipped(self, app, sample_subscription):
+        with app.app_context():
+            newer = mock_webhook_event('customer.subscription.updated', mock_subscription(status='past_due'))
+            newer['created'] = 2000
+            older = mock_webhook_event('customer.subscription.updated', mock_subscription(status='active'))
+            older['created'] = 1000
+
+            dispatcher.dispatch(newer)
+            dispatcher.dispatch(older)
+
+            assert stored_subscription().status == 'past_due'
+
+    def test_trial_will_end_records_the_trial_end(self, app, sample_subscription):
+        with app.app_context():
+            stripe_subscription = mock_subscription(status='trialing')
+            stripe_subscription['trial_end'] = stripe_subscription['current_period_end']
+
+            dispatcher.dispatch(mock_webhook_event('customer.subscription.trial_will_end', stripe_subscription))
+
+            subscription = stored_subscription()
+            assert subscription.trial_end == utc_datetime(stripe_subscription['trial_end'])
+            # Stripe reports the trial ending with customer.subscription.updated
+            assert subscription.status == 'trialing'